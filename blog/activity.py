@@ -0,0 +1,105 @@
+from django.db import IntegrityError, router, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .caching import bump_generation
+from .models import DailyActivity, Post, Profile
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def rollup_key(author_id, subject_id, created_date, status, review_status):
+    return (author_id, subject_id, timezone.localdate(created_date), status, review_status)
+
+
+def post_rollup_key(post):
+    return rollup_key(post.author_id, post.subject_id, post.created_date, post.status, post.review_status)
+
+
+def _key_filter(key):
+    author_id, subject_id, day, status, review_status = key
+    # Every row for an author carries the same family, so the family isn't part of the lookup.
+    return {'author_id': author_id, 'subject_id': subject_id, 'day': day, 'status': status, 'review_status': review_status}
+
+
+def increment(key):
+    lookup = _key_filter(key)
+    if DailyActivity.objects.filter(**lookup).update(count=F('count') + 1):
+        return
+    family_id = Profile.objects.filter(user_id=lookup['author_id']).values_list('family_id', flat=True).first()
+    try:
+        with transaction.atomic(using=router.db_for_write(DailyActivity)):
+            DailyActivity.objects.create(family_id=family_id, count=1, **lookup)
+    except IntegrityError:
+        # Another writer created the row first.
+        DailyActivity.objects.filter(**lookup).update(count=F('count') + 1)
+
+
+def decrement(key):
+    lookup = _key_filter(key)
+    DailyActivity.objects.filter(**lookup).update(count=F('count') - 1)
+    DailyActivity.objects.filter(count__lte=0, **lookup).delete()
+
+
+def stored_rollup_key(post_id):
+    row = Post.objects.filter(pk=post_id).values_list('author_id', 'subject_id', 'created_date', 'status', 'review_status').first()
+    return rollup_key(*row) if row else None
+
+
+def set_author_family(user_id, family_id):
+    DailyActivity.objects.filter(author_id=user_id).exclude(family_id=family_id).update(family_id=family_id)
+
+
+def rebuild():
+    """Recompute the whole rollup from Post. Returns the number of rollup rows written."""
+    day = TruncDate('created_date', tzinfo=timezone.get_current_timezone())
+    totals = (
+        Post.objects.annotate(day=day)
+        .values('author_id', 'family_id', 'subject_id', 'day', 'status', 'review_status')
+        .annotate(total=Count('id'))
+        .order_by()
+    )
+    written = 0
+    with transaction.atomic(using=router.db_for_write(DailyActivity)):
+        DailyActivity.objects.all().delete()
+        batch = []
+        for row in totals.iterator():
+            batch.append(DailyActivity(
+                family_id=row['family_id'],
+                author_id=row['author_id'],
+                subject_id=row['subject_id'],
+                day=row['day'],
+                status=row['status'],
+                review_status=row['review_status'],
+                count=row['total'],
+            ))
+            if len(batch) >= REBUILD_BATCH_SIZE:
+                DailyActivity.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+        DailyActivity.objects.bulk_create(batch)
+        written += len(batch)
+    # Totals cached from the old rollup are stale for every family.
+    bump_generation()
+    return written
+
+
+def subject_totals(source):
+    """{subject_id: post count} from either a DailyActivity or a Post queryset."""
+    total = Sum('count') if source.model is DailyActivity else Count('id')
+    return dict(source.values('subject_id').annotate(total=total).order_by().values_list('subject_id', 'total'))
+
+
+def daily_totals(source, start_date):
+    """{day: post count} since start_date from either a DailyActivity or a Post queryset."""
+    if source.model is DailyActivity:
+        rows = source.filter(day__gte=start_date).values('day').annotate(total=Sum('count'))
+    else:
+        rows = (
+            source.filter(created_date__date__gte=start_date)
+            .annotate(day=TruncDate('created_date'))
+            .values('day')
+            .annotate(total=Count('id'))
+        )
+    return dict(rows.order_by().values_list('day', 'total'))
@@ -0,0 +1,55 @@
+import time
+from functools import partial
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+SHARED = 'shared'
+
+
+def _generation_key(family_id):
+    return f'generation:{SHARED if family_id is None else family_id}'
+
+
+def _start_generation(key):
+    # Start from the clock rather than zero: a counter that was evicted or cleared can't come
+    # back at a generation that fragments cached before are still stored under.
+    cache.add(key, time.time_ns(), timeout=None)
+    return cache.get(key, 0)
+
+
+def _bump(family_id):
+    try:
+        cache.incr(_generation_key(family_id))
+    except ValueError:
+        # No counter yet, so nothing was cached under one either.
+        pass
+
+
+def bump_generation(family_id=None, using=DEFAULT_DB_ALIAS):
+    """
+    Make every fragment cached for `family_id` stale, or for every family when it's
+    None, without finding or deleting them.
+
+    The bump waits for the transaction on `using` to commit. Until then other processes
+    still read the old rows, and would cache them under the new generation.
+    """
+    transaction.on_commit(partial(_bump, family_id), using=using)
+
+
+def cache_version(family_id):
+    """
+    A token that changes whenever a family's posts, presentations, portfolios or
+    announcements change, or any tag does. Put it in the key of anything cached
+    from that family's content.
+    """
+    keys = [_generation_key(family_id), _generation_key(None)]
+    found = cache.get_many(keys)
+    family, shared = (found[key] if key in found else _start_generation(key) for key in keys)
+    return f'{family_id}.{family}.{shared}'
+
+
+def cached(name, family_id, compute, *vary_on, timeout=None):
+    """Return compute()'s result for this family and `vary_on`, computing it once per cache_version."""
+    key = ':'.join(['fragment', name, cache_version(family_id), *map(str, vary_on)])
+    return cache.get_or_set(key, compute, timeout)
@@ -1,25 +1,15 @@
-from .models import Notification, Profile
-
 def theme(request):
-    if request.user.is_authenticated:
-        try:
-            profile = request.user.profile
-            return {'theme': profile.theme}
-        except Profile.DoesNotExist:
-            return {'theme': 'light'}
-    return {'theme': 'light'}
+    profile = request.user_context.profile
+    return {'theme': profile.theme if profile else 'light'}
 
 def user_roles(request):
-    is_teacher = False
-    if request.user.is_authenticated:
-        is_teacher = request.user.groups.filter(name='Teachers').exists()
-    return {'is_teacher': is_teacher}
+    return {'is_teacher': request.user_context.is_teacher}
 
 def notifications(request):
     if request.user.is_authenticated:
-        unread_notifications = Notification.objects.filter(recipient=request.user, read=False).order_by('-created_date')
+        user_context = request.user_context
         return {
-            'notifications': unread_notifications,
-            'notification_count': unread_notifications.count(),
+            'notifications': user_context.unread_notifications,
+            'notification_count': user_context.unread_notification_count,
         }
     return {}
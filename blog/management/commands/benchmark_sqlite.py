@@ -0,0 +1,119 @@
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+SCHEMA = [
+    'CREATE TABLE post (id INTEGER PRIMARY KEY, title TEXT, content TEXT, view_count INTEGER, created_date REAL)',
+    'CREATE INDEX post_created ON post (created_date)',
+    'CREATE TABLE post_view (id INTEGER PRIMARY KEY, post_id INTEGER, created_date REAL)',
+]
+READ_QUERY = 'SELECT id, title, view_count FROM post ORDER BY created_date DESC LIMIT 20'
+
+
+def _connect(path, pragmas):
+    # SQLite's own default is to fail at once on a locked database; Python's sqlite3 would wait 5s.
+    timeout = pragmas.get('busy_timeout', 0) / 1000
+    connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    for name, value in pragmas.items():
+        connection.execute(f'PRAGMA {name}={value}')
+    return connection
+
+
+def _reader(path, pragmas, start, deadline, results):
+    connection = _connect(path, pragmas)
+    reads = errors = 0
+    start.wait()
+    while time.time() < deadline.value:
+        try:
+            connection.execute(READ_QUERY).fetchall()
+            reads += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    results.put(('read', reads, errors))
+
+
+def _writer(path, pragmas, start, deadline, results, rows):
+    # Mirrors post_detail's record_view: one INSERT into the view buffer, in its own transaction.
+    connection = _connect(path, pragmas)
+    writes = errors = 0
+    start.wait()
+    while time.time() < deadline.value:
+        post_id = writes % rows + 1
+        try:
+            connection.execute('INSERT INTO post_view (post_id, created_date) VALUES (?, ?)', (post_id, time.time()))
+            writes += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    results.put(('write', writes, errors))
+
+
+class Command(BaseCommand):
+    help = ('Measure read throughput on a scratch SQLite database while other processes write to it, '
+            'with SQLite defaults and with the production pragmas from settings.SQLITE_PRAGMAS.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4, help='Number of reading processes.')
+        parser.add_argument('--writers', type=int, default=2, help='Number of writing processes.')
+        parser.add_argument('--duration', type=float, default=5.0, help='Seconds to run each profile.')
+        parser.add_argument('--rows', type=int, default=2000, help='Posts to seed the scratch database with.')
+
+    def handle(self, *args, **options):
+        profiles = [
+            ('default', {}),
+            ('production', settings.SQLITE_PRAGMAS),
+        ]
+        for name, pragmas in profiles:
+            reads, read_errors, writes, write_errors = self.run_profile(pragmas, options)
+            seconds = options['duration']
+            self.stdout.write(
+                f'{name:>10}: {reads / seconds:9.0f} reads/s  {writes / seconds:7.0f} writes/s  '
+                f'{read_errors + write_errors} locked errors'
+            )
+
+    def run_profile(self, pragmas, options):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'benchmark.sqlite3')
+            self.seed(path, pragmas, options['rows'])
+
+            start = multiprocessing.Event()
+            deadline = multiprocessing.Value('d', 0.0)
+            results = multiprocessing.Queue()
+            processes = [
+                multiprocessing.Process(target=_reader, args=(path, pragmas, start, deadline, results))
+                for _ in range(options['readers'])
+            ] + [
+                multiprocessing.Process(target=_writer, args=(path, pragmas, start, deadline, results, options['rows']))
+                for _ in range(options['writers'])
+            ]
+            for process in processes:
+                process.start()
+            # Give every process time to connect before the clock starts.
+            time.sleep(0.2)
+            deadline.value = time.time() + options['duration']
+            start.set()
+
+            totals = {'read': [0, 0], 'write': [0, 0]}
+            for _ in processes:
+                kind, count, errors = results.get()
+                totals[kind][0] += count
+                totals[kind][1] += errors
+            for process in processes:
+                process.join()
+        return totals['read'][0], totals['read'][1], totals['write'][0], totals['write'][1]
+
+    def seed(self, path, pragmas, rows):
+        connection = _connect(path, pragmas)
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.execute('BEGIN')
+        connection.executemany(
+            'INSERT INTO post (title, content, view_count, created_date) VALUES (?, ?, 0, ?)',
+            ((f'Post {i}', 'x' * 2000, time.time() - i) for i in range(rows)),
+        )
+        connection.execute('COMMIT')
+        connection.close()
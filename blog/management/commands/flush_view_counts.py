@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from blog.sharding import each_database
+from blog.view_counts import flush_view_counts
+
+
+class Command(BaseCommand):
+    help = 'Fold buffered post views into Post.view_count.'
+
+    def handle(self, *args, **options):
+        flushed = sum(flush_view_counts() for _ in each_database())
+        self.stdout.write(self.style.SUCCESS(f'Flushed {flushed} views.'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from blog.renditions import RENDITION_SOURCES, create_renditions
+from blog.sharding import each_database
+
+
+class Command(BaseCommand):
+    help = 'Generate and record missing thumbnail renditions for post photos and profile images.'
+
+    def handle(self, *args, **options):
+        names = set()
+        for _ in each_database():
+            for kind, (model, field) in RENDITION_SOURCES.items():
+                missing = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True}).filter(
+                    **{f'{field}_renditions': []}
+                )
+                names.update((name, kind) for name in missing.values_list(field, flat=True).distinct())
+        # create_renditions only writes files that are missing and records them for every database.
+        for name, kind in sorted(names):
+            create_renditions(name, kind)
+        self.stdout.write(self.style.SUCCESS(f'Generated renditions for {len(names)} images.'))
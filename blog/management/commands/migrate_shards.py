@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from blog import search
+from blog.models import Family
+from blog.sharding import (
+    TEMPLATE_ALIAS, move_central_rows, provision_shard, register_alias, shard_family_ids, template_path,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Migrate the shard template and every family shard (see DATABASE_SHARDING), creating '
+        'shards for families that have none. With --move-data, move the families\' rows out of '
+        'the central database into their shards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--family', type=int, action='append', dest='families',
+                            help='Only this family id; repeat for several (default: every family).')
+        parser.add_argument('--move-data', action='store_true',
+                            help='Move the families\' posts and related rows from the central database to their shards.')
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_SHARDING:
+            raise CommandError('DATABASE_SHARDING is off; set it to True to use family shards.')
+
+        template_path().parent.mkdir(parents=True, exist_ok=True)
+        self._migrate(register_alias(TEMPLATE_ALIAS, template_path()))
+        self.stdout.write('Migrated the shard template.')
+
+        family_ids = options['families'] or list(Family.objects.order_by('pk').values_list('pk', flat=True))
+        existing = set(shard_family_ids())
+        for family_id in family_ids:
+            alias = provision_shard(family_id)
+            if family_id in existing:
+                self._migrate(alias)
+                self.stdout.write(f'Migrated shard {alias}.')
+            else:
+                self.stdout.write(f'Created shard {alias}.')
+            if options['move_data']:
+                moved = move_central_rows(family_id)
+                self.stdout.write(f'Moved {moved} rows into {alias}.')
+        self.stdout.write(self.style.SUCCESS(f'{len(family_ids)} family shards up to date.'))
+
+    def _migrate(self, alias):
+        call_command('migrate', database=alias, interactive=False, verbosity=0)
+        # Data migrations don't run on shards, including the one that creates the search index.
+        search.ensure_index_table(alias)
+        # The schema editor turns foreign key checks back on; reconnect to get the shard's settings again.
+        connections[alias].close()
@@ -0,0 +1,50 @@
+import io
+import pstats
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from blog.profiling import PROFILE_HEADER, profiles_by_view, sign_profile_header
+
+
+class Command(BaseCommand):
+    help = 'Merge the saved cProfile stats per view and print where the time went.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help='Profile directory (default PYTHON_PROFILE_DIR).')
+        parser.add_argument('--view', action='append', help='Only report this view name; repeatable.')
+        parser.add_argument('--limit', type=int, default=20, help='Functions to show per view.')
+        parser.add_argument('--sort', default='cumulative', choices=['cumulative', 'tottime', 'ncalls'])
+        parser.add_argument('--header', action='store_true',
+                            help=f'Print a signed {PROFILE_HEADER} header that makes a request get profiled.')
+
+    def handle(self, *args, **options):
+        if options['header']:
+            if not settings.PYTHON_PROFILE_HEADER:
+                self.stderr.write('PYTHON_PROFILE_HEADER is off, so the server will ignore this header.')
+            self.stdout.write(f'{PROFILE_HEADER}: {sign_profile_header()}')
+            return
+
+        profiles = profiles_by_view(options['dir'])
+        if options['view']:
+            unknown = set(options['view']) - set(profiles)
+            if unknown:
+                raise CommandError(f"No profiles saved for: {', '.join(sorted(unknown))}")
+            profiles = {view: profiles[view] for view in options['view']}
+        if not profiles:
+            self.stdout.write(f"No profiles in {options['dir'] or settings.PYTHON_PROFILE_DIR}.")
+            return
+
+        # Views with the most total time first.
+        merged = {view: pstats.Stats(*map(str, paths)) for view, paths in profiles.items()}
+        for view, stats in sorted(merged.items(), key=lambda item: item[1].total_tt, reverse=True):
+            count = len(profiles[view])
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f'{view}: {count} profiles, {stats.total_tt / count * 1000:.1f}ms mean'
+            ))
+            report = io.StringIO()
+            stats.stream = report
+            # print_stats() would otherwise start by listing every merged file.
+            stats.files = []
+            stats.strip_dirs().sort_stats(options['sort']).print_stats(options['limit'])
+            self.stdout.write(report.getvalue(), ending='')
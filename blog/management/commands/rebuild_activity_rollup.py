@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from blog.activity import rebuild
+from blog.sharding import each_database
+
+
+class Command(BaseCommand):
+    help = 'Recompute the per-author daily activity rollup from all posts, in every shard.'
+
+    def handle(self, *args, **options):
+        written = sum(rebuild() for _ in each_database())
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} rollup rows.'))
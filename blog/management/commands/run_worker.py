@@ -0,0 +1,53 @@
+import os
+import signal
+import socket
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from blog import metrics
+from blog.task_queue import Worker, autodiscover, seed_periodic_tasks
+
+
+class Command(BaseCommand):
+    help = 'Run queued background tasks from the database task queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.TASK_WORKER_CONCURRENCY,
+                            help='Number of worker threads.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--burst', action='store_true',
+                            help='Run until the queue is empty, then exit.')
+
+    def handle(self, *args, **options):
+        autodiscover()
+        seed_periodic_tasks()
+        prefix = f'{socket.gethostname()}:{os.getpid()}'
+        workers = [Worker(f'{prefix}:{i}') for i in range(options['concurrency'])]
+
+        if options['burst']:
+            for worker in workers:
+                worker.drain()
+            self.stdout.write(self.style.SUCCESS('Queue drained.'))
+            return
+
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        threads = [
+            threading.Thread(target=worker.run_forever, args=(stop_event, options['poll_interval']), name=worker.worker_id)
+            for worker in workers
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f'Started {len(threads)} worker(s).')
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=1)
+                metrics.maybe_flush()
+        except KeyboardInterrupt:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
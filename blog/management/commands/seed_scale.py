@@ -0,0 +1,61 @@
+import time
+from datetime import date, datetime, time as day_time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from blog.models import Family
+from blog.seeding import rebuild_derived_data, seed_family, shared_password_hash, SEED_PASSWORD
+
+
+class Command(BaseCommand):
+    help = 'Bulk-insert families of students with posts, tags, comments and more for load testing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--families', type=int, default=10)
+        parser.add_argument('--students', type=int, default=30, help='Students per family.')
+        parser.add_argument('--posts', type=int, default=40, help='Posts per student.')
+        parser.add_argument('--tags', type=int, default=100, help='Tags per family.')
+        parser.add_argument('--comments', type=int, default=2, help='Comments per post.')
+        parser.add_argument('--notifications', type=int, default=20, help='Notifications per student.')
+        parser.add_argument('--presentations', type=int, default=2, help='Presentations per student.')
+        parser.add_argument('--assessments', type=int, default=3, help='Rubric-assessed posts per student.')
+        parser.add_argument('--seed', type=int, default=0, help='Same seed and counts give the same data.')
+        parser.add_argument('--end-date', type=date.fromisoformat, default=None,
+                            help='Posts are dated in the year up to this day (YYYY-MM-DD, default today).')
+        parser.add_argument('--prefix', default='scale', help='Prefix for family names and usernames.')
+
+    def handle(self, *args, **options):
+        names = [f"{options['prefix']} {options['seed']} family {i}" for i in range(options['families'])]
+        if Family.objects.filter(name__in=names).exists():
+            raise CommandError('These families already exist; pick another --prefix or --seed.')
+
+        end_date = options['end_date'] or timezone.localdate()
+        end_date = timezone.make_aware(datetime.combine(end_date, day_time(23, 59)))
+        password = shared_password_hash()
+        started = time.monotonic()
+        for i, name in enumerate(names):
+            seed_family(
+                name,
+                students=options['students'],
+                posts_per_student=options['posts'],
+                tag_count=options['tags'],
+                comments_per_post=options['comments'],
+                notifications_per_student=options['notifications'],
+                presentations_per_student=options['presentations'],
+                assessments_per_student=min(options['assessments'], options['posts']),
+                seed=options['seed'],
+                password=password,
+                end_date=end_date,
+            )
+            self.stdout.write(f'Seeded {name} ({i + 1}/{len(names)}) after {time.monotonic() - started:.1f}s')
+
+        self.stdout.write('Rebuilding search index, activity rollup and tag counts...')
+        rebuild_derived_data()
+
+        posts = options['families'] * options['students'] * options['posts']
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {options['families']} families, {options['families'] * options['students']} students "
+            f'and {posts} posts in {time.monotonic() - started:.1f}s. '
+            f"Every seeded user's password is '{SEED_PASSWORD}'."
+        ))
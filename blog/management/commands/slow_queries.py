@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from blog.slow_queries import aggregate, read_log
+
+
+class Command(BaseCommand):
+    help = 'Summarise the slow-query log by SQL shape, with the views that ran each and its query plan.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', default=None, help='Log file to read (default SLOW_QUERY_LOG).')
+        parser.add_argument('--limit', type=int, default=10, help='Number of query shapes to show.')
+        parser.add_argument('--since', default=None, help='Only count queries logged at or after this ISO timestamp.')
+
+    def handle(self, *args, **options):
+        records = read_log(options['log'])
+        if options['since']:
+            records = (record for record in records if record['time'] >= options['since'])
+        shapes = aggregate(records)
+        if not shapes:
+            self.stdout.write(f"No slow queries logged in {options['log'] or settings.SLOW_QUERY_LOG}.")
+            return
+
+        for rank, (shape, stats) in enumerate(shapes[:options['limit']], start=1):
+            slowest = stats['slowest']
+            views = ', '.join(f'{view} ({count})' for view, count in stats['views'].most_common(5))
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f"#{rank}: {stats['count']} queries, {stats['total_ms']:.0f}ms total, "
+                f"{stats['total_ms'] / stats['count']:.1f}ms mean, {stats['max_ms']:.1f}ms max"
+            ))
+            self.stdout.write(f'  SQL:   {shape}')
+            self.stdout.write(f'  Views: {views}')
+            self.stdout.write(f"  Slowest params: {', '.join(slowest['params'])}")
+            for step in slowest['plan']:
+                self.stdout.write(f'  Plan:  {step}')
+        if len(shapes) > options['limit']:
+            self.stdout.write(f"...and {len(shapes) - options['limit']} more shapes; raise --limit to see them.")
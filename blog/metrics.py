@@ -0,0 +1,249 @@
+import atexit
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+# A process's file not written for this many flush intervals is removed once the process is gone.
+STALE_FLUSH_INTERVALS = 3
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'blog_http_requests_total': ('counter', 'Requests handled, by URL name, method and status.', None),
+    'blog_http_request_duration_seconds': ('histogram', 'Request latency by URL name.', LATENCY_BUCKETS),
+    'blog_http_request_queries': ('histogram', 'SQL queries per request by URL name.', QUERY_BUCKETS),
+    'blog_upload_bytes_total': ('counter', 'Bytes of uploaded files received, by URL name.', None),
+    'blog_posts_created_total': ('counter', 'Posts created.', None),
+    'blog_notifications_fanned_out_total': ('counter', 'Notifications sent by fan-out tasks, retried batches included.', None),
+}
+
+
+class Registry:
+    """
+    This process's metric values, keyed by (name, sorted label pairs).
+
+    Counters hold a number; histograms hold per-bucket counts (the last one
+    being +Inf), then the sum of observed values.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.pid = os.getpid()
+        self.process_id = f'{self.pid}-{uuid.uuid4().hex[:8]}'
+        self.last_flush = time.monotonic()
+        self.dirty = False
+
+    def _check_fork(self):
+        # Gunicorn forks workers from a master that may have imported this module already;
+        # each worker starts from zero under its own file.
+        if os.getpid() != self.pid:
+            self.__init__()
+
+    def inc(self, name, amount=1, **labels):
+        self._check_fork()
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+            self.dirty = True
+
+    def observe(self, name, value, **labels):
+        self._check_fork()
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * (len(buckets) + 1) + [0.0])
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+            self.dirty = True
+
+    def snapshot(self):
+        with self.lock:
+            return [[name, dict(labels), value] for (name, labels), value in self.values.items()]
+
+
+registry = Registry()
+_flush_lock = threading.Lock()
+# [queries run so far] for the request being handled (see MetricsMiddleware), else None.
+_request_queries = ContextVar('metrics_request_queries', default=None)
+
+
+def inc(name, amount=1, **labels):
+    registry.inc(name, amount, **labels)
+    maybe_flush()
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+    maybe_flush()
+
+
+def count_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install(connection):
+    """
+    Add count_query to every query `connection` runs, once. It's installed as connections
+    are opened, so a family shard first used halfway through a request is counted too.
+    """
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+@contextmanager
+def counting_queries():
+    """Count the queries run inside the block, on any connection, into the yielded [count]."""
+    queries = [0]
+    token = _request_queries.set(queries)
+    try:
+        yield queries
+    finally:
+        _request_queries.reset(token)
+
+
+def _process_file():
+    return Path(settings.METRICS_DIR) / f'{registry.process_id}.json'
+
+
+def flush():
+    """Write this process's values to METRICS_DIR for the other workers' /metrics to include."""
+    if not settings.METRICS_DIR or not registry.dirty:
+        return
+    # Another thread is already writing the file; its snapshot is recent enough.
+    if not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        registry.dirty = False
+        registry.last_flush = time.monotonic()
+        path = _process_file()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_suffix('.tmp')
+        temporary.write_text(json.dumps(registry.snapshot()))
+        os.replace(temporary, path)
+    finally:
+        _flush_lock.release()
+
+
+def maybe_flush():
+    if time.monotonic() - registry.last_flush >= settings.METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+atexit.register(flush)
+
+
+def _process_running(path):
+    try:
+        pid = int(path.stem.split('-', 1)[0])
+    except ValueError:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _is_stale(path):
+    """
+    Whether `path` belongs to a process that has exited. An idle process doesn't rewrite
+    its file, so age alone isn't enough; the process must also be gone.
+    """
+    try:
+        age = time.time() - path.stat().st_mtime
+    except OSError:
+        return False
+    return age > STALE_FLUSH_INTERVALS * settings.METRICS_FLUSH_INTERVAL and not _process_running(path)
+
+
+def collect():
+    """Every process's values summed: this one's live, the others' from their last flush."""
+    snapshots = [registry.snapshot()]
+    if settings.METRICS_DIR:
+        own = _process_file()
+        for path in Path(settings.METRICS_DIR).glob('*.json'):
+            if path == own:
+                continue
+            if _is_stale(path):
+                path.unlink(missing_ok=True)
+                continue
+            try:
+                snapshots.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                continue
+
+    totals = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(sorted(labels.items())))
+            if isinstance(value, list):
+                current = totals.get(key)
+                totals[key] = value if current is None else [a + b for a, b in zip(current, value)]
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def render(totals):
+    """Format collect()'s totals in the Prometheus text exposition format."""
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for (metric, labels), value in sorted(totals.items()):
+            if metric != name:
+                continue
+            if kind == 'counter':
+                lines.append(f'{name}{_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip([*buckets, '+Inf'], value[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {value[-1]}')
+            lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def _authorised(request):
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    token = settings.METRICS_TOKEN
+    supplied = request.headers.get('Authorization', '').encode()
+    return bool(token) and hmac.compare_digest(supplied, f'Bearer {token}'.encode())
+
+
+def metrics_view(request):
+    if not _authorised(request):
+        raise PermissionDenied
+    return HttpResponse(render(collect()), content_type=CONTENT_TYPE)
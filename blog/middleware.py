@@ -0,0 +1,234 @@
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.models import Count, Exists, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils.functional import SimpleLazyObject, cached_property
+
+from . import metrics
+from .caching import cache_version
+from .models import Notification, Profile
+from .profiling import cprofile, has_profile_header, profile_request, profile_view_name, save_cprofile
+from .routers import allow_writes, read_only
+from .sharding import use_family_shard
+from .slow_queries import query_origin
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Other methods are counted as 'other' so clients can't create unbounded metric labels.
+METRIC_METHODS = {'GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'PATCH', 'DELETE'}
+
+profiling_logger = logging.getLogger('blog.profiling')
+
+
+class UserContext:
+    """
+    Everything a page needs to know about the requesting user.
+
+    The profile, family, role flags and unread-notification count come back
+    from a single query; the unread notification list is only fetched if a
+    template actually renders it.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.profile = None
+        self.is_teacher = False
+        self.is_student = False
+        self.unread_notification_count = 0
+        if user.is_authenticated:
+            self._load()
+
+    def _profile_queryset(self):
+        queryset = Profile.objects.select_related('family').annotate(
+            in_teachers=Exists(Group.objects.filter(user=OuterRef('user_id'), name='Teachers')),
+            in_students=Exists(Group.objects.filter(user=OuterRef('user_id'), name='Students')),
+        )
+        if settings.DATABASE_SHARDING:
+            # Notifications live in the family's shard, which the profile query can't see.
+            return queryset
+        unread = (
+            Notification.objects.filter(recipient=OuterRef('user_id'), read=False)
+            .values('recipient')
+            .annotate(total=Count('id'))
+            .values('total')
+        )
+        return queryset.annotate(unread_count=Coalesce(Subquery(unread), Value(0)))
+
+    def _load(self):
+        profile = self._profile_queryset().filter(user=self.user).first()
+        if profile is None:
+            # Users created before the profile signal existed have no profile yet.
+            with allow_writes():
+                Profile.objects.get_or_create(user=self.user)
+            profile = self._profile_queryset().get(user=self.user)
+
+        self.profile = profile
+        self.is_teacher = profile.in_teachers
+        self.is_student = profile.in_students
+        if settings.DATABASE_SHARDING:
+            with use_family_shard(profile.family_id):
+                self.unread_notification_count = Notification.objects.filter(recipient=self.user, read=False).count()
+        else:
+            self.unread_notification_count = profile.unread_count
+
+        # Templates read user.profile directly; reuse the instance loaded here.
+        self.user.profile = profile
+
+    @property
+    def family(self):
+        return self.profile.family if self.profile else None
+
+    @cached_property
+    def cache_version(self):
+        """Vary cached fragments of family content on this (see blog.caching)."""
+        return cache_version(self.profile.family_id if self.profile else None)
+
+    @cached_property
+    def unread_notifications(self):
+        if not self.unread_notification_count:
+            return []
+        return list(
+            Notification.objects.filter(recipient=self.user, read=False).order_by('-created_date')
+        )
+
+
+class UserContextMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.user_context = SimpleLazyObject(lambda: UserContext(request.user))
+        return self.get_response(request)
+
+
+class ReadOnlyRequestMiddleware:
+    """Handle safe-method requests in read-only mode so blog.routers reads from the replica."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method not in SAFE_METHODS:
+            return self.get_response(request)
+        with read_only():
+            return self.get_response(request)
+
+
+class FamilyShardMiddleware:
+    """Handle a signed-in user's requests against their family's shard (see blog.sharding)."""
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_SHARDING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # Runs after UserContextMiddleware, so the profile it loads anyway decides the shard.
+        profile = request.user_context.profile
+        with use_family_shard(profile.family_id if profile else None):
+            return self.get_response(request)
+
+
+class RequestProfilingMiddleware:
+    """
+    Profile a sample of requests: SQL count and time, template render time, view
+    time and response size go out as a Server-Timing header and a JSON log line.
+
+    Requests that run the same SQL REQUEST_PROFILING_REPEAT_THRESHOLD times or more
+    are logged as warnings, since that is usually a query inside a loop.
+    """
+
+    def __init__(self, get_response):
+        self.sample_rate = settings.REQUEST_PROFILING_SAMPLE_RATE
+        if self.sample_rate <= 0:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        with profile_request(request) as profile:
+            response = self.get_response(request)
+        profile.finish(response)
+        response['Server-Timing'] = profile.server_timing()
+
+        record = profile.as_dict()
+        repeats = record['repeated_queries']
+        if repeats and max(repeats.values()) >= settings.REQUEST_PROFILING_REPEAT_THRESHOLD:
+            profiling_logger.warning('Repeated queries %s', json.dumps(record))
+        else:
+            profiling_logger.info('Request profile %s', json.dumps(record))
+        return response
+
+
+class PythonProfilingMiddleware:
+    """
+    Run cProfile on a sample of requests, and on requests with a signed
+    X-Profile-Request header, saving the stats for `manage.py profile_report`.
+    """
+
+    def __init__(self, get_response):
+        self.sample_rate = settings.PYTHON_PROFILE_SAMPLE_RATE
+        if self.sample_rate <= 0 and not settings.PYTHON_PROFILE_HEADER:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def _wanted(self, request):
+        if settings.PYTHON_PROFILE_HEADER and has_profile_header(request):
+            return True
+        return random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if not self._wanted(request):
+            return self.get_response(request)
+        with cprofile() as profiler:
+            response = self.get_response(request)
+        if profiler is not None:
+            save_cprofile(profiler, profile_view_name(request))
+        return response
+
+
+class SlowQueryOriginMiddleware:
+    """Let blog.slow_queries record which view and path ran each slow query."""
+
+    def __init__(self, get_response):
+        if not settings.SLOW_QUERY_THRESHOLD_MS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with query_origin(request):
+            return self.get_response(request)
+
+
+class MetricsMiddleware:
+    """Count requests, their latency, their SQL queries and uploaded bytes per URL name for /metrics."""
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with metrics.counting_queries() as queries:
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        method = request.method if request.method in METRIC_METHODS else 'other'
+        metrics.inc('blog_http_requests_total', method=method, status=str(response.status_code), view=view)
+        metrics.observe('blog_http_request_duration_seconds', duration, view=view)
+        metrics.observe('blog_http_request_queries', queries[0], view=view)
+        if request.method == 'POST' and request.content_type == 'multipart/form-data':
+            uploaded = sum(upload.size for name in request.FILES for upload in request.FILES.getlist(name))
+            if uploaded:
+                metrics.inc('blog_upload_bytes_total', uploaded, view=view)
+        return response
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS blog_post_search USING fts5("
+        "title, content, media_description, photo_caption, tags, family_id UNINDEXED, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+    schema_editor.execute(
+        "INSERT INTO blog_post_search (rowid, title, content, media_description, photo_caption, tags, family_id) "
+        "SELECT p.id, p.title, p.content, COALESCE(p.media_description, ''), COALESCE(p.photo_caption, ''), "
+        "COALESCE((SELECT group_concat(t.name, ' ') FROM blog_post_tags pt "
+        "JOIN blog_tag t ON t.id = pt.tag_id WHERE pt.post_id = p.id), ''), pr.family_id "
+        "FROM blog_post p LEFT JOIN blog_profile pr ON pr.user_id = p.author_id"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS blog_post_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0035_post_rubric'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 04:29
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0036_post_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingPostView',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_views', to='blog.post')),
+            ],
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.6 on 2026-10-18 04:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+def backfill_daily_activity(apps, schema_editor):
+    Post = apps.get_model('blog', 'Post')
+    DailyActivity = apps.get_model('blog', 'DailyActivity')
+    totals = (
+        Post.objects.annotate(day=TruncDate('created_date'))
+        .values('author_id', 'author__profile__family_id', 'subject_id', 'day', 'status', 'review_status')
+        .annotate(total=Count('id'))
+        .order_by()
+    )
+    DailyActivity.objects.bulk_create(
+        [
+            DailyActivity(
+                family_id=row['author__profile__family_id'],
+                author_id=row['author_id'],
+                subject_id=row['subject_id'],
+                day=row['day'],
+                status=row['status'],
+                review_status=row['review_status'],
+                count=row['total'],
+            )
+            for row in totals
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0039_task_queue'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.CharField(choices=[('draft', 'Draft'), ('published', 'Published')], max_length=10)),
+                ('review_status', models.CharField(choices=[('needs_review', 'Needs Review'), ('revision_requested', 'Revision Requested'), ('approved', 'Approved')], max_length=20)),
+                ('count', models.IntegerField(default=0)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('family', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='blog.family')),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='blog.subject')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['family', 'day'], name='blog_activity_family_day'), models.Index(fields=['author', 'day'], name='blog_activity_author_day')],
+                'constraints': [models.UniqueConstraint(fields=('family', 'author', 'subject', 'day', 'status', 'review_status'), name='unique_daily_activity')],
+            },
+        ),
+        migrations.RunPython(backfill_daily_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.6 on 2026-10-18 04:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0040_dailyactivity'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='announcement',
+            index=models.Index(fields=['author', 'created_date'], name='blog_announce_author_created'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('read', False)), fields=['recipient', 'created_date'], name='blog_notif_recipient_unread'),
+        ),
+        migrations.AddIndex(
+            model_name='peerreviewrequest',
+            index=models.Index(fields=['reviewer', 'status'], name='blog_review_reviewer_status'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['status', 'created_date'], name='blog_post_status_created'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['author', 'created_date'], name='blog_post_author_created'),
+        ),
+    ]
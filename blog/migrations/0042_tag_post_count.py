@@ -0,0 +1,26 @@
+# Generated by Django 5.2.6 on 2026-10-18 04:53
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_post_counts(apps, schema_editor):
+    Tag = apps.get_model('blog', 'Tag')
+    for tag in Tag.objects.annotate(total=Count('post')):
+        Tag.objects.filter(pk=tag.pk).update(post_count=tag.total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0041_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='post_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_post_counts, migrations.RunPython.noop),
+    ]
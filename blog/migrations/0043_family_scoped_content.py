@@ -0,0 +1,54 @@
+# Generated by Django 5.2.6 on 2026-10-18 05:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_families(apps, schema_editor):
+    Profile = apps.get_model('blog', 'Profile')
+    for model_name, owner in (('Post', 'author'), ('Presentation', 'author'), ('Announcement', 'author'), ('Notification', 'recipient')):
+        model = apps.get_model('blog', model_name)
+        family = Profile.objects.filter(user_id=OuterRef(f'{owner}_id')).values('family_id')[:1]
+        model.objects.update(family_id=Subquery(family))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0042_tag_post_count'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='announcement',
+            name='family',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='blog.family'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='family',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='blog.family'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='family',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='blog.family'),
+        ),
+        migrations.AddField(
+            model_name='presentation',
+            name='family',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='blog.family'),
+        ),
+        migrations.AddIndex(
+            model_name='announcement',
+            index=models.Index(fields=['family', 'created_date'], name='blog_announce_family_created'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['family', 'created_date'], name='blog_post_family_created'),
+        ),
+        migrations.RunPython(backfill_families, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.6 on 2026-10-18 06:00
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_rows(apps, schema_editor):
+    # Family-less authors could get several rows for one key; fold them into the oldest.
+    DailyActivity = apps.get_model('blog', 'DailyActivity')
+    key = ('author_id', 'subject_id', 'day', 'status', 'review_status')
+    duplicates = (
+        DailyActivity.objects.values(*key)
+        .annotate(rows=Count('id'), keep=Min('id'), total=Sum('count'))
+        .filter(rows__gt=1)
+    )
+    for row in duplicates:
+        lookup = {field: row[field] for field in key}
+        DailyActivity.objects.filter(**lookup).exclude(pk=row['keep']).delete()
+        DailyActivity.objects.filter(pk=row['keep']).update(count=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0043_family_scoped_content'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_rows, migrations.RunPython.noop, hints={'model_name': 'dailyactivity'}),
+        migrations.RemoveConstraint(
+            model_name='dailyactivity',
+            name='unique_daily_activity',
+        ),
+        migrations.AddConstraint(
+            model_name='dailyactivity',
+            constraint=models.UniqueConstraint(fields=('author', 'subject', 'day', 'status', 'review_status'), name='unique_daily_activity'),
+        ),
+    ]
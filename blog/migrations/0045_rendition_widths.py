@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 06:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0044_daily_activity_unique_without_family'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='photo_renditions',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='image_renditions',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
@@ -1,8 +1,10 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 from urllib.parse import urlparse, parse_qs
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.db.backends.signals import connection_created
 from django.dispatch import receiver
 
 class Family(models.Model):
@@ -24,9 +26,14 @@ from django.utils.text import slugify
 class Tag(models.Model):
     name = models.CharField(max_length=100, unique=True)
     slug = models.SlugField(max_length=100, unique=True, editable=False)
+    # Number of posts carrying the tag, kept current by blog.tags for tag clouds.
+    post_count = models.PositiveIntegerField(default=0, editable=False)
 
     def save(self, *args, **kwargs):
         self.slug = slugify(self.name)
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # post_count moves with F() updates; saving a stale copy must not overwrite it.
+            kwargs['update_fields'] = ['name', 'slug']
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -65,6 +72,41 @@ class Level(models.Model):
     def __str__(self):
         return self.name
 
+class FamilyScopedQuerySet(models.QuerySet):
+    def for_family(self, family):
+        """
+        Rows belonging to `family` (a Family, its id, or None), read from the
+        model's own indexed family column instead of joining through the
+        owner's profile. Users without a family see nothing.
+        """
+        if family is None:
+            return self.none()
+        return self.filter(family=family)
+
+FamilyScopedManager = models.Manager.from_queryset(FamilyScopedQuerySet)
+
+class PostQuerySet(FamilyScopedQuerySet):
+    """Querysets shaped for the templates that render them, so loops over posts don't query per row."""
+
+    def for_listing(self):
+        # Timeline cards show the title, photo, date and tags.
+        return self.select_related('author', 'subject').prefetch_related('tags')
+
+    def for_detail(self):
+        comments = Comment.objects.select_related('author__profile').prefetch_related('author__groups')
+        return self.select_related('author__profile', 'subject', 'rubric').prefetch_related(
+            'tags',
+            models.Prefetch('comments', queryset=comments),
+        )
+
+    def for_presentation(self, presentation):
+        """The presentation's posts in slide order, with the subjects the outline groups them by."""
+        return (
+            self.filter(presentationpost__presentation=presentation)
+            .select_related('subject')
+            .order_by('presentationpost__order')
+        )
+
 class Post(models.Model):
     POST_TYPE_CHOICES = (
         ('journal', 'Journal'),
@@ -80,12 +122,16 @@ class Post(models.Model):
         ('revision_requested', 'Revision Requested'),
         ('approved', 'Approved'),
     )
+    # The family column copies this user's profile family (see set_content_family).
+    FAMILY_SOURCE = 'author'
     post_type = models.CharField(max_length=10, choices=POST_TYPE_CHOICES, default='journal')
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     subject = models.ForeignKey(Subject, on_delete=models.PROTECT)
     title = models.CharField(max_length=200)
     content = models.TextField()
     photo = models.ImageField(upload_to='photos/', blank=True, null=True)
+    # Widths blog.renditions has written for this photo, so templates needn't look on disk.
+    photo_renditions = models.JSONField(default=list, blank=True, editable=False)
     photo_caption = models.CharField(max_length=255, blank=True, null=True)
     audio_file = models.FileField(upload_to='audio/', blank=True, null=True)
     youtube_url = models.URLField(blank=True, null=True)
@@ -98,6 +144,17 @@ class Post(models.Model):
     review_status = models.CharField(max_length=20, choices=REVIEW_STATUS_CHOICES, default='needs_review')
     tags = models.ManyToManyField(Tag, blank=True)
     rubric = models.ForeignKey(Rubric, on_delete=models.SET_NULL, null=True, blank=True)
+    # Indexed by blog_post_family_created rather than a single-column index.
+    family = models.ForeignKey(Family, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', db_index=False)
+
+    objects = FamilyScopedManager.from_queryset(PostQuerySet)()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_date'], name='blog_post_status_created'),
+            models.Index(fields=['author', 'created_date'], name='blog_post_author_created'),
+            models.Index(fields=['family', 'created_date'], name='blog_post_family_created'),
+        ]
 
     def get_youtube_embed_url(self):
         if not self.youtube_url:
@@ -127,6 +184,41 @@ class Post(models.Model):
     def __str__(self):
         return self.title
 
+class PendingPostView(models.Model):
+    # Append-only buffer of post_detail hits; blog.view_counts folds these into Post.view_count.
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='pending_views')
+    created_date = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'View of {self.post_id}'
+
+class DailyActivity(models.Model):
+    # Per-author daily post counts, kept current by blog.activity so dashboards never scan Post.
+    family = models.ForeignKey(Family, on_delete=models.SET_NULL, null=True, blank=True)
+    author = models.ForeignKey(User, on_delete=models.CASCADE)
+    subject = models.ForeignKey(Subject, on_delete=models.CASCADE)
+    day = models.DateField()
+    status = models.CharField(max_length=10, choices=Post.STATUS_CHOICES)
+    review_status = models.CharField(max_length=20, choices=Post.REVIEW_STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # The family follows from the author, and a nullable column here would let SQLite
+            # treat family-less rows as distinct and duplicate them.
+            models.UniqueConstraint(
+                fields=['author', 'subject', 'day', 'status', 'review_status'],
+                name='unique_daily_activity',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['family', 'day'], name='blog_activity_family_day'),
+            models.Index(fields=['author', 'day'], name='blog_activity_author_day'),
+        ]
+
+    def __str__(self):
+        return f'{self.author_id} on {self.day}: {self.count}'
+
 class Assessment(models.Model):
     post = models.OneToOneField(Post, on_delete=models.CASCADE, related_name='assessment')
     rubric = models.ForeignKey(Rubric, on_delete=models.PROTECT)
@@ -164,11 +256,15 @@ class Presentation(models.Model):
         ('project', 'Project'),
         ('showcase', 'Showcase'),
     ]
+    FAMILY_SOURCE = 'author'
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     title = models.CharField(max_length=200)
     posts = models.ManyToManyField(Post, through='PresentationPost')
     type = models.CharField(max_length=20, choices=TYPE_CHOICES, default='project')
     created_date = models.DateTimeField(default=timezone.now)
+    family = models.ForeignKey(Family, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    objects = FamilyScopedManager()
 
     def __str__(self):
         return self.title
@@ -203,6 +299,9 @@ class PeerReviewRequest(models.Model):
 
     class Meta:
         unique_together = ('post', 'reviewer')
+        indexes = [
+            models.Index(fields=['reviewer', 'status'], name='blog_review_reviewer_status'),
+        ]
 
     def __str__(self):
         return f'Request for {self.post} from {self.requester} to {self.reviewer}'
@@ -223,6 +322,7 @@ class Profile(models.Model):
     family = models.ForeignKey(Family, on_delete=models.SET_NULL, related_name='members', null=True, blank=True)
     theme = models.CharField(max_length=10, choices=THEME_CHOICES, default='light')
     image = models.ImageField(default='default.jpg', upload_to='profile_pics')
+    image_renditions = models.JSONField(default=list, blank=True, editable=False)
 
     def __str__(self):
         return f'{self.user.username} Profile'
@@ -232,25 +332,213 @@ def create_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
 
+@receiver(pre_save, sender=Profile)
+def reset_avatar_renditions(sender, instance, **kwargs):
+    # Only a new profile or a fresh upload needs renditions; other saves leave them alone.
+    instance._queue_renditions = instance._state.adding or not instance.image._committed
+    if instance._queue_renditions:
+        instance.image_renditions = []
+
+@receiver(post_save, sender=Profile)
+def queue_avatar_renditions(sender, instance, **kwargs):
+    from .renditions import create_renditions
+    from .task_queue import enqueue
+    if instance.image and instance._queue_renditions:
+        enqueue(create_renditions, instance.image.name, 'avatar')
+
+@receiver(pre_save, sender=Post)
+def reset_photo_renditions(sender, instance, **kwargs):
+    instance._queue_renditions = bool(instance.photo) and not instance.photo._committed
+    if instance._queue_renditions:
+        instance.photo_renditions = []
+
+@receiver(post_save, sender=Post)
+def queue_photo_renditions(sender, instance, **kwargs):
+    from .renditions import create_renditions
+    from .task_queue import enqueue
+    if instance._queue_renditions:
+        enqueue(create_renditions, instance.photo.name, 'photo')
+
+@receiver(pre_save, sender=Profile)
+def remember_previous_family(sender, instance, **kwargs):
+    from .sharding import FamilyChangeBetweenShards
+    instance._previous_family_id = None if instance._state.adding else (
+        Profile.objects.filter(pk=instance.pk).values_list('family_id', flat=True).first()
+    )
+    # The user's content is already in the old family's shard, and shards can't be joined to move it.
+    if settings.DATABASE_SHARDING and instance._previous_family_id not in (None, instance.family_id):
+        raise FamilyChangeBetweenShards(
+            f'{instance} is in family {instance._previous_family_id}; members of a family '
+            'can\'t move to another one while DATABASE_SHARDING is on.'
+        )
+
+@receiver(post_save, sender=Profile)
+def update_author_family(sender, instance, created, **kwargs):
+    from . import activity, search
+    from .caching import bump_generation
+    from .sharding import move_central_rows, use_family_shard
+    # Theme and avatar edits save the profile too; only a change of family touches the content.
+    if created or instance.family_id == getattr(instance, '_previous_family_id', instance.family_id):
+        return
+    # A user without a family keeps their content in the central database.
+    with use_family_shard(None):
+        search.set_author_family(instance.user_id, instance.family_id)
+        activity.set_author_family(instance.user_id, instance.family_id)
+        relabelled = 0
+        for model in (Post, Presentation, Announcement, Notification):
+            relabelled += model.objects.filter(**{f'{model.FAMILY_SOURCE}_id': instance.user_id}).exclude(
+                family_id=instance.family_id
+            ).update(family_id=instance.family_id)
+        has_content = relabelled or any(
+            model.objects.filter(author_id=instance.user_id).exists() for model in (Portfolio, Rubric)
+        )
+    if settings.DATABASE_SHARDING and has_content:
+        # Now labelled with the family they joined, the rows can follow it into its shard.
+        family_id = instance.family_id
+        transaction.on_commit(lambda: move_central_rows(family_id))
+    # update() sends no signals, so both families' fragments are made stale here, once the
+    # central database's updates above commit.
+    bump_generation(instance._previous_family_id)
+    bump_generation(instance.family_id)
+
+@receiver(pre_save, sender=Post)
+def remember_activity_key(sender, instance, **kwargs):
+    from .activity import stored_rollup_key
+    instance._previous_rollup_key = None if instance._state.adding else stored_rollup_key(instance.pk)
+
+@receiver(post_save, sender=Post)
+def update_daily_activity(sender, instance, **kwargs):
+    from .activity import decrement, increment, post_rollup_key
+    previous_key = getattr(instance, '_previous_rollup_key', None)
+    current_key = post_rollup_key(instance)
+    if previous_key == current_key:
+        return
+    if previous_key is not None:
+        decrement(previous_key)
+    increment(current_key)
+
+@receiver(post_delete, sender=Post)
+def remove_daily_activity(sender, instance, **kwargs):
+    from .activity import decrement, post_rollup_key
+    decrement(post_rollup_key(instance))
+
+@receiver(post_save, sender=Post)
+def index_post_for_search(sender, instance, **kwargs):
+    from .search import index_post
+    index_post(instance)
+
+@receiver(post_delete, sender=Post)
+def remove_post_from_search(sender, instance, **kwargs):
+    from .search import remove_post
+    remove_post(instance.pk)
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def reindex_post_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    from .search import index_post
+    if reverse and action == 'pre_clear':
+        # A clear from the tag side doesn't report which posts lost it.
+        instance._search_cleared_post_ids = list(instance.post_set.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        if action == 'post_clear':
+            pk_set = getattr(instance, '_search_cleared_post_ids', [])
+        for post in Post.objects.filter(pk__in=pk_set or []):
+            index_post(post)
+    else:
+        index_post(instance)
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def update_tag_post_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    from .tags import adjust_post_counts
+    related = instance.post_set if reverse else instance.tags
+    if action == 'pre_clear':
+        instance._unlinked_ids = list(related.values_list('pk', flat=True))
+        return
+    if action == 'pre_remove':
+        # remove() reports every id it was given, including ones that were never linked.
+        instance._unlinked_ids = list(related.filter(pk__in=pk_set).values_list('pk', flat=True)) if pk_set else []
+        return
+    if action == 'post_add':
+        # add() only reports the links it actually created.
+        changed, delta = pk_set or [], 1
+    elif action in ('post_remove', 'post_clear'):
+        changed, delta = getattr(instance, '_unlinked_ids', []), -1
+    else:
+        return
+    if not changed:
+        return
+    if reverse:
+        # The ids are posts here: the one tag gained or lost that many.
+        adjust_post_counts([instance.pk], delta * len(changed))
+    else:
+        adjust_post_counts(changed, delta)
+
+@receiver(pre_delete, sender=Post)
+def release_tag_post_counts(sender, instance, **kwargs):
+    # Deleting a post drops its M2M rows without an m2m_changed signal.
+    from .tags import adjust_post_counts
+    adjust_post_counts(list(instance.tags.values_list('pk', flat=True)), -1)
+
+@receiver(post_save, sender=Tag)
+def reindex_tagged_posts(sender, instance, created, **kwargs):
+    from .search import index_post
+    if not created:
+        for post in instance.post_set.all():
+            index_post(post)
+
 class Notification(models.Model):
+    FAMILY_SOURCE = 'recipient'
     recipient = models.ForeignKey(User, related_name='notifications', on_delete=models.CASCADE)
     sender = models.ForeignKey(User, related_name='sent_notifications', on_delete=models.CASCADE, null=True)
     post = models.ForeignKey(Post, on_delete=models.CASCADE, null=True, blank=True)
     message = models.TextField()
     read = models.BooleanField(default=False)
     created_date = models.DateTimeField(default=timezone.now)
+    # Set by blog.notifications fan-out so a retried delivery can't notify anyone twice.
+    batch_key = models.CharField(max_length=64, blank=True, default='')
+    family = models.ForeignKey(Family, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    objects = FamilyScopedManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['recipient', 'batch_key'],
+                condition=~models.Q(batch_key=''),
+                name='unique_notification_per_batch',
+            ),
+        ]
+        indexes = [
+            # Partial index: Django compiles read=False to NOT "read", which a plain index on read can't serve.
+            models.Index(
+                fields=['recipient', 'created_date'],
+                condition=models.Q(read=False),
+                name='blog_notif_recipient_unread',
+            ),
+        ]
 
     def __str__(self):
         return f'Notification for {self.recipient.username}'
 
 class Announcement(models.Model):
+    FAMILY_SOURCE = 'author'
     title = models.CharField(max_length=200)
     content = models.TextField()
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     created_date = models.DateTimeField(default=timezone.now)
+    # Indexed by blog_announce_family_created rather than a single-column index.
+    family = models.ForeignKey(Family, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', db_index=False)
+
+    objects = FamilyScopedManager()
 
     class Meta:
         ordering = ['-created_date']
+        indexes = [
+            models.Index(fields=['author', 'created_date'], name='blog_announce_author_created'),
+            models.Index(fields=['family', 'created_date'], name='blog_announce_family_created'),
+        ]
 
     def __str__(self):
         return self.title
@@ -267,3 +555,128 @@ class Portfolio(models.Model):
 
     def __str__(self):
         return self.title
+
+class Task(models.Model):
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    )
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='blog_task_status_run_at'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.status})'
+
+class TaskRun(models.Model):
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='runs')
+    worker = models.CharField(max_length=100)
+    started_date = models.DateTimeField()
+    duration_ms = models.FloatField()
+    succeeded = models.BooleanField()
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Run of {self.task.name} on {self.worker}'
+
+class PeriodicTask(models.Model):
+    name = models.CharField(max_length=200, unique=True)
+    next_run_at = models.DateTimeField(default=timezone.now)
+    last_run_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+@receiver(post_save, sender=Post)
+def count_created_post(sender, instance, created, **kwargs):
+    from .metrics import inc
+    if created:
+        inc('blog_posts_created_total')
+
+@receiver(pre_save, sender=Post)
+@receiver(pre_save, sender=Presentation)
+@receiver(pre_save, sender=Announcement)
+@receiver(pre_save, sender=Notification)
+def set_content_family(sender, instance, **kwargs):
+    # Views set the family from the request's user context; this covers everything else.
+    if instance._state.adding and instance.family_id is None:
+        owner_id = getattr(instance, f'{sender.FAMILY_SOURCE}_id')
+        instance.family_id = Profile.objects.filter(user_id=owner_id).values_list('family_id', flat=True).first()
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Presentation)
+@receiver(post_delete, sender=Presentation)
+@receiver(post_save, sender=Announcement)
+@receiver(post_delete, sender=Announcement)
+def bump_content_generation(sender, instance, using, **kwargs):
+    from .caching import bump_generation
+    bump_generation(instance.family_id, using=using)
+
+@receiver(post_save, sender=Portfolio)
+@receiver(post_delete, sender=Portfolio)
+@receiver(m2m_changed, sender=Portfolio.posts.through)
+@receiver(m2m_changed, sender=Portfolio.presentations.through)
+def bump_portfolio_generation(sender, instance, using, action=None, **kwargs):
+    from .caching import bump_generation
+    if action is not None and not action.startswith('post_'):
+        return
+    # From the post or presentation side of the M2M, the instance carries the family itself.
+    family_id = getattr(instance, 'family_id', None)
+    if isinstance(instance, Portfolio):
+        family_id = Profile.objects.filter(user_id=instance.author_id).values_list('family_id', flat=True).first()
+    bump_generation(family_id, using=using)
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(m2m_changed, sender=Post.tags.through)
+def bump_tag_generation(sender, instance, using, action=None, reverse=False, pk_set=None, **kwargs):
+    from .caching import bump_generation
+    if action is not None and not action.startswith('post_'):
+        return
+    if action is None or (reverse and pk_set is None):
+        # A renamed or deleted tag shows in every family's fragments, and a tag cleared
+        # from all its posts doesn't say which families those were.
+        bump_generation(using=using)
+    elif not reverse:
+        bump_generation(instance.family_id, using=using)
+    else:
+        family_ids = set(Post.objects.filter(pk__in=pk_set).values_list('family_id', flat=True))
+        for family_id in family_ids:
+            bump_generation(family_id, using=using)
+
+@receiver(connection_created)
+def install_write_guard(sender, connection, **kwargs):
+    from .routers import install_write_guard
+    install_write_guard(connection)
+
+@receiver(connection_created)
+def install_slow_query_log(sender, connection, **kwargs):
+    from .slow_queries import install
+    if settings.SLOW_QUERY_THRESHOLD_MS:
+        install(connection)
+
+@receiver(connection_created)
+def install_request_query_count(sender, connection, **kwargs):
+    from .metrics import install
+    install(connection)
+
+@receiver(connection_created)
+def install_request_profiler(sender, connection, **kwargs):
+    from .profiling import install
+    install(connection)
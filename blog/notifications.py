@@ -0,0 +1,71 @@
+import uuid
+from contextlib import nullcontext
+from itertools import groupby
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from . import metrics
+from .models import Notification, Profile
+from .sharding import use_family_shard
+from .task_queue import task
+
+FAN_OUT_CHUNK_SIZE = 500
+
+
+def new_batch_key(prefix):
+    return f'{prefix}:{uuid.uuid4().hex}'
+
+
+def _create_batch(recipient_ids, family_id, **fields):
+    if family_id is None:
+        # bulk_create skips the pre_save receiver that fills in the family, so look them up per chunk.
+        families = dict(Profile.objects.filter(user_id__in=recipient_ids).values_list('user_id', 'family_id'))
+    notifications = [
+        Notification(
+            recipient_id=recipient_id,
+            family_id=family_id if family_id is not None else families.get(recipient_id),
+            **fields,
+        )
+        for recipient_id in recipient_ids
+    ]
+    if family_id is not None or not settings.DATABASE_SHARDING:
+        Notification.objects.bulk_create(notifications, ignore_conflicts=True)
+        return
+    # bulk_create gives the router no instance to go by, so write each family's rows in its own shard.
+    notifications.sort(key=lambda notification: notification.family_id or 0)
+    for recipient_family_id, group in groupby(notifications, key=lambda notification: notification.family_id):
+        with use_family_shard(recipient_family_id):
+            Notification.objects.bulk_create(list(group), ignore_conflicts=True)
+
+
+@task
+def fan_out_notifications(recipient_ids, message, batch_key, sender_id=None, post_id=None, family_id=None):
+    """
+    Create one notification per recipient with chunked bulk inserts.
+
+    Rows are unique per (recipient, batch_key), so running the same batch
+    again only fills in whatever an earlier attempt didn't get to. Pass
+    family_id when every recipient is in that family to skip looking it up.
+    """
+    fields = {'sender_id': sender_id, 'post_id': post_id, 'message': message, 'batch_key': batch_key}
+    batch = []
+    sent = 0
+    with use_family_shard(family_id) if family_id is not None else nullcontext():
+        for recipient_id in recipient_ids:
+            batch.append(recipient_id)
+            if len(batch) >= FAN_OUT_CHUNK_SIZE:
+                _create_batch(batch, family_id, **fields)
+                sent += len(batch)
+                batch = []
+        if batch:
+            _create_batch(batch, family_id, **fields)
+            sent += len(batch)
+    metrics.inc('blog_notifications_fanned_out_total', sent)
+
+
+@task
+def notify_family_students(family_id, message, batch_key, sender_id=None):
+    students = User.objects.filter(groups__name='Students', profile__family_id=family_id)
+    recipient_ids = students.values_list('id', flat=True).iterator(chunk_size=FAN_OUT_CHUNK_SIZE)
+    fan_out_notifications(recipient_ids, message, batch_key, sender_id=sender_id, family_id=family_id)
@@ -0,0 +1,108 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+from .sharding import across_families
+
+
+class CursorPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """
+    Keyset pagination over (created_date, id).
+
+    Each page is fetched with a WHERE clause on the last seen key instead of
+    an OFFSET, so every page costs the same and no COUNT(*) is needed.
+    """
+
+    def __init__(self, queryset, per_page, descending=True, across_shards=False):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.descending = descending
+        # Read from every family's shard too (see DATABASE_SHARDING), not just the current one.
+        self.across_shards = across_shards
+
+    @staticmethod
+    def encode_cursor(post):
+        raw = f'{post.created_date.isoformat()}|{post.pk}'
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            created, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+            return datetime.fromisoformat(created), int(pk)
+        except (ValueError, TypeError, UnicodeDecodeError):
+            return None
+
+    def _ordering(self, descending):
+        if descending:
+            return ('-created_date', '-id')
+        return ('created_date', 'id')
+
+    def _seek(self, queryset, key, descending):
+        created, pk = key
+        if descending:
+            return queryset.filter(Q(created_date__lt=created) | Q(created_date=created, id__lt=pk))
+        return queryset.filter(Q(created_date__gt=created) | Q(created_date=created, id__gt=pk))
+
+    def _rows(self, queryset, descending, limit):
+        queryset = queryset.order_by(*self._ordering(descending))[:limit]
+        if not self.across_shards:
+            return list(queryset)
+        # Every database's first rows past the cursor, merged on the same key, contain the page.
+        rows = across_families(queryset)
+        rows.sort(key=lambda post: (post.created_date, post.pk), reverse=descending)
+        return rows[:limit]
+
+    def get_page(self, after=None, before=None):
+        after_key = self.decode_cursor(after) if after else None
+        before_key = self.decode_cursor(before) if before else None
+
+        if before_key:
+            # Walk backwards from the cursor, then flip the rows back into display order.
+            queryset = self._seek(self.queryset, before_key, not self.descending)
+            rows = self._rows(queryset, not self.descending, self.per_page + 1)
+            has_more = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            if not rows:
+                return self.get_page()
+            return CursorPage(
+                rows,
+                next_cursor=self.encode_cursor(rows[-1]),
+                previous_cursor=self.encode_cursor(rows[0]) if has_more else None,
+            )
+
+        queryset = self.queryset
+        if after_key:
+            queryset = self._seek(queryset, after_key, self.descending)
+        rows = self._rows(queryset, self.descending, self.per_page + 1)
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        return CursorPage(
+            rows,
+            next_cursor=self.encode_cursor(rows[-1]) if has_more else None,
+            previous_cursor=self.encode_cursor(rows[0]) if after_key and rows else None,
+        )
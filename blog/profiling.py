@@ -0,0 +1,198 @@
+import cProfile
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.core import signing
+from django.template.backends.django import DjangoTemplates, Template
+
+PROFILE_HEADER = 'X-Profile-Request'
+PROFILE_HEADER_SALT = 'blog.profiling.header'
+
+# The profile of the request being handled, when it was sampled (see RequestProfilingMiddleware).
+_current = ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    """Where one request's time went: SQL, template rendering and everything else."""
+
+    def __init__(self, request):
+        self.method = request.method
+        self.path = request.path
+        self.started = time.perf_counter()
+        self.queries = []
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.total_time = None
+        self.status = None
+        self.response_size = None
+
+    def record_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.db_time += duration
+            self.queries.append((sql, duration))
+
+    @property
+    def view_time(self):
+        # Python time in middleware and the view, outside the database and templates.
+        return self.total_time - self.db_time - self.template_time
+
+    def repeated_queries(self):
+        """{sql: times run} for statements run more than once; the SQL is unparameterised, so this finds N+1 loops."""
+        counts = Counter(sql for sql, _ in self.queries)
+        return {sql: count for sql, count in counts.most_common() if count > 1}
+
+    def finish(self, response):
+        self.total_time = time.perf_counter() - self.started
+        self.status = response.status_code
+        if not response.streaming:
+            self.response_size = len(response.content)
+
+    def server_timing(self):
+        metrics = [
+            f'db;dur={self.db_time * 1000:.1f};desc="{len(self.queries)} queries"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+            f'view;dur={self.view_time * 1000:.1f}',
+            f'total;dur={self.total_time * 1000:.1f}',
+        ]
+        repeated = self.repeated_queries()
+        if repeated:
+            metrics.append(f'dup;desc="{sum(repeated.values()) - len(repeated)} repeated queries"')
+        return ', '.join(metrics)
+
+    def as_dict(self):
+        return {
+            'method': self.method,
+            'path': self.path,
+            'status': self.status,
+            'total_ms': round(self.total_time * 1000, 1),
+            'view_ms': round(self.view_time * 1000, 1),
+            'db_ms': round(self.db_time * 1000, 1),
+            'template_ms': round(self.template_time * 1000, 1),
+            'queries': len(self.queries),
+            'response_bytes': self.response_size,
+            'repeated_queries': self.repeated_queries(),
+        }
+
+
+def record_query(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    return profile.record_query(execute, sql, params, many, context)
+
+
+def install(connection):
+    """
+    Add record_query to every query `connection` runs, once. It's installed as connections
+    are opened, so a family shard first used halfway through a request is profiled too.
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def profile_request(request):
+    profile = RequestProfile(request)
+    token = _current.set(profile)
+    try:
+        yield profile
+    finally:
+        _current.reset(token)
+
+
+class ProfiledTemplate(Template):
+    def render(self, context=None, request=None):
+        profile = _current.get()
+        if profile is None:
+            return super().render(context, request)
+        started, db_time = time.perf_counter(), profile.db_time
+        try:
+            return super().render(context, request)
+        finally:
+            # Lazy querysets evaluated while rendering count as database time, not template time.
+            profile.template_time += time.perf_counter() - started - (profile.db_time - db_time)
+
+
+class ProfiledDjangoTemplates(DjangoTemplates):
+    """The Django template backend, timing top-level renders for the request profile."""
+
+    def from_string(self, template_code):
+        return ProfiledTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        return ProfiledTemplate(super().get_template(template_name).template, self)
+
+
+# Only one cProfile profiler can run at a time in a process on Python 3.12+; concurrent
+# requests that would have been profiled are simply served without it.
+_cprofile_lock = threading.Lock()
+
+
+def sign_profile_header():
+    """A value for the X-Profile-Request header, valid for PYTHON_PROFILE_HEADER_MAX_AGE seconds."""
+    return signing.TimestampSigner(salt=PROFILE_HEADER_SALT).sign('profile')
+
+
+def has_profile_header(request):
+    value = request.headers.get(PROFILE_HEADER)
+    if not value:
+        return False
+    try:
+        signing.TimestampSigner(salt=PROFILE_HEADER_SALT).unsign(value, max_age=settings.PYTHON_PROFILE_HEADER_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+@contextmanager
+def cprofile():
+    """Yield a running cProfile.Profile, or None if another request is already being profiled."""
+    if not _cprofile_lock.acquire(blocking=False):
+        yield None
+        return
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+    finally:
+        _cprofile_lock.release()
+
+
+def profile_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return re.sub(r'[^\w-]', '_', match.view_name) if match else 'unresolved'
+
+
+def save_cprofile(profiler, view_name, directory=None):
+    """Write `profiler`'s stats as <view>.<ms>.<pid>.pstats, keeping only the newest PYTHON_PROFILE_MAX_FILES."""
+    directory = Path(directory or settings.PYTHON_PROFILE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'{view_name}.{int(time.time() * 1000)}.{os.getpid()}.pstats'
+    profiler.dump_stats(path)
+
+    files = sorted(directory.glob('*.pstats'), key=lambda f: f.stat().st_mtime, reverse=True)
+    for old in files[settings.PYTHON_PROFILE_MAX_FILES:]:
+        old.unlink(missing_ok=True)
+    return path
+
+
+def profiles_by_view(directory=None):
+    """{view name: [.pstats paths]} for the saved profiles."""
+    profiles = defaultdict(list)
+    for path in sorted(Path(directory or settings.PYTHON_PROFILE_DIR).glob('*.pstats')):
+        profiles[path.name.split('.', 1)[0]].append(path)
+    return dict(profiles)
@@ -0,0 +1,95 @@
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .models import Post, Profile
+from .sharding import TENANT_MODELS, each_database
+from .task_queue import task
+
+RENDITION_WIDTHS = {
+    'photo': (320, 640, 1024),
+    'avatar': (64, 128),
+}
+
+# The model and image field each kind is made from; finished widths go in `<field>_renditions`.
+RENDITION_SOURCES = {
+    'photo': (Post, 'photo'),
+    'avatar': (Profile, 'image'),
+}
+
+# WebP for browsers that take it, JPEG for everything else.
+RENDITION_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def rendition_name(name, width, extension):
+    stem, _ = os.path.splitext(name)
+    return f'renditions/{width}w/{stem}.{extension}'
+
+
+def available_renditions(image, kind, extension):
+    """Return [(width, name)] for the renditions of the `image` field file that have been written."""
+    if not image:
+        return []
+    _, field = RENDITION_SOURCES[kind]
+    widths = getattr(image.instance, f'{field}_renditions', None) or []
+    return [(width, rendition_name(image.name, width, extension)) for width in widths]
+
+
+def record_renditions(name, kind):
+    """Store the rendition widths on every row whose image is `name`."""
+    model, field = RENDITION_SOURCES[kind]
+    widths = list(RENDITION_WIDTHS[kind])
+    # Posts may have moved out to family shards; profiles are only ever in the central database.
+    databases = each_database() if model._meta.model_name in TENANT_MODELS else [None]
+    for _ in databases:
+        model.objects.filter(**{field: name}).update(**{f'{field}_renditions': widths})
+
+
+@task
+def create_renditions(name, kind):
+    # Shared sources such as the default avatar already have their files; just record them.
+    if not needs_renditions(name, kind):
+        if default_storage.exists(name):
+            record_renditions(name, kind)
+        return []
+
+    try:
+        with default_storage.open(name) as source:
+            image = Image.open(source)
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except (FileNotFoundError, UnidentifiedImageError, OSError):
+        return []
+
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+    created = []
+    for width in RENDITION_WIDTHS[kind]:
+        resized = image.copy()
+        # Never upscale: a small upload is written at its own size.
+        resized.thumbnail((width, width * 10), Image.Resampling.LANCZOS)
+        for extension, (image_format, options) in RENDITION_FORMATS.items():
+            target = rendition_name(name, width, extension)
+            frame = resized.convert('RGB') if image_format == 'JPEG' else resized
+            buffer = BytesIO()
+            frame.save(buffer, image_format, **options)
+            if default_storage.exists(target):
+                default_storage.delete(target)
+            default_storage.save(target, ContentFile(buffer.getvalue()))
+            created.append(target)
+    record_renditions(name, kind)
+    return created
+
+
+def needs_renditions(name, kind):
+    largest = RENDITION_WIDTHS[kind][-1]
+    if not name or default_storage.exists(rendition_name(name, largest, 'jpg')):
+        return False
+    return default_storage.exists(name)
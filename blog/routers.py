@@ -0,0 +1,84 @@
+import logging
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+logger = logging.getLogger(__name__)
+
+READ_ALIAS = 'readonly'
+WRITE_SQL_RE = re.compile(r'^\s*(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+# True while a safe-method request is being handled (see ReadOnlyRequestMiddleware).
+_read_only = ContextVar('read_only', default=False)
+
+
+class WriteDuringReadOnlyRequest(RuntimeError):
+    pass
+
+
+def _guard_writes(execute, sql, params, many, context):
+    if _read_only.get() and WRITE_SQL_RE.match(sql):
+        message = f'Write during a read-only request: {sql[:80]}. Wrap deliberate writes in blog.routers.allow_writes().'
+        if settings.DATABASE_READ_ONLY_STRICT:
+            raise WriteDuringReadOnlyRequest(message)
+        logger.warning(message)
+    return execute(sql, params, many, context)
+
+
+def install_write_guard(connection):
+    """
+    Add _guard_writes to every query `connection` runs, once. It's on every connection, not
+    just 'default', because requests write through whichever alias they're routed to, such
+    as a family shard.
+    """
+    if _guard_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_guard_writes)
+
+
+@contextmanager
+def read_only():
+    token = _read_only.set(True)
+    try:
+        yield
+    finally:
+        _read_only.reset(token)
+
+
+@contextmanager
+def allow_writes():
+    """Mark a deliberate write inside a read-only request; reads in the block use the primary too."""
+    token = _read_only.set(False)
+    try:
+        yield
+    finally:
+        _read_only.reset(token)
+
+
+def in_read_only_request():
+    return _read_only.get()
+
+
+class ReadWriteRouter:
+    """
+    Send reads made while handling GET/HEAD requests to the read-only alias, when one is
+    configured, and everything else to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _read_only.get() and READ_ALIAS in settings.DATABASES:
+            return READ_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Writes made during a read-only request are caught by _guard_writes, on the SQL actually run.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != READ_ALIAS
@@ -0,0 +1,111 @@
+import re
+
+from django.db import connection, connections, router
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+SEARCH_TABLE = 'blog_post_search'
+
+
+def search_enabled():
+    return connection.vendor == 'sqlite'
+
+
+def _connection(post=None):
+    # With sharding on, a post's index lives alongside it in its family's shard.
+    from .models import Post
+    return connections[router.db_for_write(Post, instance=post)]
+
+
+def ensure_index_table(using):
+    """Create the full-text table on `using` if it's missing, e.g. on a freshly migrated shard."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5('
+            "title, content, media_description, photo_caption, tags, family_id UNINDEXED, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+
+
+def build_match_expression(query):
+    # Quote every word so user input can never be parsed as FTS5 syntax, and
+    # prefix-match it so "photo" still finds "photosynthesis".
+    words = re.findall(r'\w+', query or '')
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def index_post(post):
+    if not search_enabled() or not post.pk:
+        return
+    tags = ' '.join(post.tags.values_list('name', flat=True))
+    with _connection(post).cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [post.pk])
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, title, content, media_description, photo_caption, tags, family_id) '
+            'VALUES (%s, %s, %s, %s, %s, %s, %s)',
+            [post.pk, post.title, post.content or '', post.media_description or '', post.photo_caption or '', tags, post.family_id],
+        )
+
+
+def remove_post(post_id):
+    if not search_enabled():
+        return
+    with _connection().cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [post_id])
+
+
+def rebuild_index():
+    """Re-index every post in one statement, e.g. after rows were bulk-inserted without signals."""
+    if not search_enabled():
+        return
+    with _connection().cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, title, content, media_description, photo_caption, tags, family_id) '
+            "SELECT p.id, p.title, p.content, COALESCE(p.media_description, ''), COALESCE(p.photo_caption, ''), "
+            "COALESCE((SELECT group_concat(t.name, ' ') FROM blog_post_tags pt "
+            "JOIN blog_tag t ON t.id = pt.tag_id WHERE pt.post_id = p.id), ''), p.family_id "
+            'FROM blog_post p'
+        )
+
+
+def set_author_family(user_id, family_id):
+    if not search_enabled():
+        return
+    with _connection().cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {SEARCH_TABLE} SET family_id = %s WHERE rowid IN (SELECT id FROM blog_post WHERE author_id = %s)',
+            [family_id, user_id],
+        )
+
+
+def search_posts(queryset, query, family=None, ranked=True):
+    """
+    Restrict a Post queryset to rows matching `query` in the full-text index.
+
+    With `ranked` the results are ordered by bm25 relevance; pass
+    ranked=False when the caller applies its own ordering.
+    """
+    if not search_enabled():
+        return queryset.filter(Q(title__icontains=query) | Q(content__icontains=query))
+
+    match = build_match_expression(query)
+    if not match:
+        return queryset.none()
+
+    sql = f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s'
+    params = [match]
+    if family is not None:
+        sql += ' AND family_id = %s'
+        params.append(family.pk)
+    queryset = queryset.filter(id__in=RawSQL(sql, params))
+    if not ranked:
+        return queryset
+
+    # Only matching posts get here, and FTS5 answers MATCH with a rowid constraint by
+    # seeking straight to that row, so the rank costs one index lookup per result.
+    rank = RawSQL(
+        f'SELECT rank FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s AND rowid = blog_post.id',
+        [match],
+    )
+    return queryset.annotate(search_rank=rank).order_by('search_rank')
@@ -0,0 +1,150 @@
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, User
+from django.db import transaction
+from django.utils import timezone
+
+from . import activity, search, tags
+from .models import (
+    Assessment, Comment, Criterion, Evaluation, Family, Level, Notification, Post, Presentation,
+    PresentationPost, Profile, Rubric, Subject, Tag,
+)
+
+SEED_PASSWORD = 'password'
+BATCH_SIZE = 1000
+SUBJECT_NAMES = ('Science', 'History', 'Math', 'Art', 'Music', 'Literature', 'Geography', 'Coding')
+WORDS = (
+    'volcano', 'photosynthesis', 'river', 'fraction', 'castle', 'poem', 'melody', 'robot', 'map',
+    'experiment', 'painting', 'fossil', 'planet', 'algorithm', 'harvest', 'bridge', 'story', 'garden',
+)
+RUBRIC_CRITERIA = ('Research', 'Method', 'Presentation')
+RUBRIC_LEVELS = ('Beginning', 'Developing', 'Secure', 'Excellent')
+POSTS_PER_PRESENTATION = 5
+
+
+def _text(rng, words):
+    return ' '.join(rng.choices(WORDS, k=words))
+
+
+def _bulk(model, objects):
+    # SQLite returns the new primary keys from a bulk insert, so the objects can be linked to straight away.
+    return model.objects.bulk_create(objects, batch_size=BATCH_SIZE)
+
+
+def shared_password_hash():
+    # Hashed once and shared by every seeded user: hashing per user would dominate the run.
+    return make_password(SEED_PASSWORD)
+
+
+def seed_family(name, students=300, posts_per_student=40, tag_count=200, comments_per_post=1,
+                notifications_per_student=20, presentations_per_student=0, assessments_per_student=0,
+                seed=0, password=None, end_date=None):
+    """
+    Bulk-insert one family: a teacher, its students and their posts, tags,
+    comments, notifications, presentations and rubric assessments.
+
+    The same name, counts, seed and end_date always produce the same rows.
+    Bulk inserts skip model signals, so callers must run
+    rebuild_derived_data() once they have finished seeding.
+    Returns (family, teacher, students).
+    """
+    rng = random.Random(f'{name}:{seed}')
+    password = password or shared_password_hash()
+    end_date = end_date or timezone.now()
+    slug = name.lower().replace(' ', '-')
+
+    with transaction.atomic():
+        family = Family.objects.create(name=name)
+        users = _bulk(User, [User(username=f'{slug}-teacher', password=password)] + [
+            User(username=f'{slug}-student-{i}', password=password) for i in range(students)
+        ])
+        teacher, student_users = users[0], users[1:]
+
+        _bulk(Profile, [Profile(user=user, family=family) for user in users])
+        memberships = User.groups.through
+        teachers, students_group = Group.objects.get(name='Teachers'), Group.objects.get(name='Students')
+        _bulk(memberships, [memberships(user=teacher, group=teachers)] + [
+            memberships(user=student, group=students_group) for student in student_users
+        ])
+
+        subjects = [Subject.objects.get_or_create(name=subject_name)[0] for subject_name in SUBJECT_NAMES]
+        tag_ids = [tag.pk for tag in _bulk(Tag, [
+            Tag(name=f'{slug}-tag-{i}', slug=f'{slug}-tag-{i}') for i in range(tag_count)
+        ])]
+
+        rubric = criteria = levels = None
+        if assessments_per_student:
+            rubric = Rubric.objects.create(name=f'{name} rubric', author=teacher)
+            criteria = _bulk(Criterion, [
+                Criterion(rubric=rubric, name=criterion, order=i) for i, criterion in enumerate(RUBRIC_CRITERIA)
+            ])
+            levels = _bulk(Level, [
+                Level(rubric=rubric, name=level, points=i + 1, order=i) for i, level in enumerate(RUBRIC_LEVELS)
+            ])
+
+        posts = []
+        for student in student_users:
+            for i in range(posts_per_student):
+                posts.append(Post(
+                    author=student,
+                    family=family,
+                    subject=rng.choice(subjects),
+                    title=_text(rng, 4).capitalize(),
+                    content=_text(rng, 60),
+                    created_date=end_date - timedelta(days=rng.randint(0, 365), minutes=rng.randint(0, 1440)),
+                    status='published' if rng.random() < 0.8 else 'draft',
+                    review_status=rng.choice(Post.REVIEW_STATUS_CHOICES)[0],
+                    rubric=rubric if i < assessments_per_student else None,
+                ))
+        posts = _bulk(Post, posts)
+
+        post_tags = Post.tags.through
+        _bulk(post_tags, [
+            post_tags(post_id=post.pk, tag_id=tag_id)
+            for post in posts for tag_id in rng.sample(tag_ids, min(3, len(tag_ids)))
+        ])
+
+        commenters = [teacher] + student_users
+        _bulk(Comment, [
+            Comment(post=post, author=rng.choice(commenters), text=_text(rng, 15))
+            for post in posts for _ in range(comments_per_post)
+        ])
+        _bulk(Notification, [
+            Notification(recipient=student, family=family, sender=teacher, message=_text(rng, 8), read=rng.random() < 0.7)
+            for student in student_users for _ in range(notifications_per_student)
+        ])
+
+        if presentations_per_student and posts_per_student:
+            presentations = _bulk(Presentation, [
+                Presentation(author=student, family=family, title=_text(rng, 3).capitalize())
+                for student in student_users for _ in range(presentations_per_student)
+            ])
+            slides = []
+            for i, presentation in enumerate(presentations):
+                # Both lists are in student order, so a student's posts are one slice of `posts`.
+                index = i // presentations_per_student
+                own_posts = posts[index * posts_per_student:(index + 1) * posts_per_student]
+                for order, post in enumerate(rng.sample(own_posts, min(POSTS_PER_PRESENTATION, len(own_posts)))):
+                    slides.append(PresentationPost(presentation=presentation, post=post, order=order))
+            _bulk(PresentationPost, slides)
+
+        if rubric:
+            assessed = [post for post in posts if post.rubric_id]
+            assessments = _bulk(Assessment, [
+                Assessment(post=post, rubric=rubric, assessor=teacher, overall_feedback=_text(rng, 12))
+                for post in assessed
+            ])
+            _bulk(Evaluation, [
+                Evaluation(assessment=assessment, criterion=criterion, level=rng.choice(levels))
+                for assessment in assessments for criterion in criteria
+            ])
+    return family, teacher, student_users
+
+
+def rebuild_derived_data():
+    """Rebuild what signals normally keep current: the search index, activity rollup and tag counts."""
+    search.rebuild_index()
+    activity.rebuild()
+    tags.recount()
@@ -0,0 +1,266 @@
+import copy
+import os
+import shutil
+import sqlite3
+import tempfile
+from contextlib import closing, contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+SHARD_ALIAS_PREFIX = 'family_'
+TEMPLATE_ALIAS = 'shard_template'
+CENTRAL_SCHEMA = 'central'
+# Each shard numbers its rows from family_id * ID_SPACE, so ids never collide across shards
+# and rows moved in from the central database keep theirs.
+ID_SPACE = 2 ** 40
+
+# Models whose rows live in a family's shard; everything else (auth, sessions, families,
+# profiles, subjects, the task queue) stays in the central database.
+TENANT_MODELS = {
+    'post', 'post_tags', 'tag', 'comment', 'pendingpostview', 'dailyactivity', 'assessment', 'evaluation',
+    'privatefeedback', 'presentation', 'presentationpost', 'peerreviewrequest', 'notification',
+    'announcement', 'portfolio', 'portfolio_posts', 'portfolio_presentations', 'rubric', 'criterion', 'level',
+}
+
+POSTS = f'SELECT id FROM {CENTRAL_SCHEMA}.blog_post WHERE family_id = %(family)s'
+MEMBERS = f'SELECT user_id FROM {CENTRAL_SCHEMA}.blog_profile WHERE family_id = %(family)s'
+ASSESSMENTS = f'SELECT id FROM {CENTRAL_SCHEMA}.blog_assessment WHERE post_id IN ({POSTS})'
+PRESENTATIONS = f'SELECT id FROM {CENTRAL_SCHEMA}.blog_presentation WHERE family_id = %(family)s'
+PORTFOLIOS = f'SELECT id FROM {CENTRAL_SCHEMA}.blog_portfolio WHERE author_id IN ({MEMBERS})'
+RUBRICS = f'SELECT id FROM {CENTRAL_SCHEMA}.blog_rubric WHERE author_id IN ({MEMBERS})'
+
+# (table, which of the central database's rows belong to the family), parents before children.
+# Tags and post tags are copied separately, since tags are shared between families.
+FAMILY_ROWS = [
+    ('blog_rubric', f'id IN ({RUBRICS})'),
+    ('blog_criterion', f'rubric_id IN ({RUBRICS})'),
+    ('blog_level', f'rubric_id IN ({RUBRICS})'),
+    ('blog_post', 'family_id = %(family)s'),
+    ('blog_comment', f'post_id IN ({POSTS})'),
+    ('blog_pendingpostview', f'post_id IN ({POSTS})'),
+    ('blog_privatefeedback', f'post_id IN ({POSTS})'),
+    ('blog_peerreviewrequest', f'post_id IN ({POSTS})'),
+    ('blog_assessment', f'post_id IN ({POSTS})'),
+    ('blog_evaluation', f'assessment_id IN ({ASSESSMENTS})'),
+    ('blog_presentation', 'family_id = %(family)s'),
+    ('blog_presentationpost', f'presentation_id IN ({PRESENTATIONS})'),
+    ('blog_portfolio', f'id IN ({PORTFOLIOS})'),
+    ('blog_portfolio_posts', f'portfolio_id IN ({PORTFOLIOS})'),
+    ('blog_portfolio_presentations', f'portfolio_id IN ({PORTFOLIOS})'),
+    ('blog_announcement', 'family_id = %(family)s'),
+    ('blog_notification', 'family_id = %(family)s'),
+    ('blog_dailyactivity', 'family_id = %(family)s'),
+]
+
+# The family whose shard the current request or task uses (see use_family_shard).
+_family = ContextVar('shard_family', default=None)
+
+
+class FamilyChangeBetweenShards(RuntimeError):
+    pass
+
+
+def shard_alias(family_id):
+    return f'{SHARD_ALIAS_PREFIX}{family_id}'
+
+
+def is_shard_alias(alias):
+    return alias == TEMPLATE_ALIAS or alias.startswith(SHARD_ALIAS_PREFIX)
+
+
+def shard_path(family_id):
+    return Path(settings.DATABASE_SHARD_DIR) / f'{shard_alias(family_id)}.sqlite3'
+
+
+def template_path():
+    return Path(settings.DATABASE_SHARD_DIR) / 'template.sqlite3'
+
+
+def register_alias(alias, path):
+    """
+    Add a database alias for the shard file at `path`, with the central database
+    attached so shared tables resolve in joins and writes.
+    """
+    if alias in connections.settings:
+        return alias
+    central = connections[DEFAULT_DB_ALIAS].settings_dict
+    config = copy.deepcopy(central)
+    config['NAME'] = str(path)
+    options = config.setdefault('OPTIONS', {})
+    central_name = str(central['NAME']).replace("'", "''")
+    options['init_command'] = ';'.join(filter(None, [
+        options.get('init_command', ''),
+        # Foreign keys to shared tables point into the attached database, which SQLite can't enforce.
+        'PRAGMA foreign_keys = OFF',
+        f"ATTACH DATABASE '{central_name}' AS {CENTRAL_SCHEMA}",
+    ]))
+    # transaction_mode is kept: BEGIN IMMEDIATE takes the write lock on the central database as
+    # well as the shard, so writers to either queue for the busy timeout instead of hitting
+    # SQLITE_BUSY when a deferred transaction tries to upgrade its read lock.
+    connections.settings[alias] = config
+    return alias
+
+
+def _set_id_ranges(path, family_id):
+    with closing(sqlite3.connect(path)) as db, db:
+        tables = [name for (name,) in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND sql LIKE '%AUTOINCREMENT%' AND name != 'django_migrations'"
+        )]
+        db.executemany('DELETE FROM sqlite_sequence WHERE name = ?', [(table,) for table in tables])
+        db.executemany(
+            'INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)',
+            [(table, family_id * ID_SPACE) for table in tables],
+        )
+
+
+def provision_shard(family_id):
+    """Create the family's shard as a copy of the migrated template. Returns its alias."""
+    path = shard_path(family_id)
+    if not path.exists():
+        if not template_path().exists():
+            raise ImproperlyConfigured('No shard template; run `manage.py migrate_shards` first.')
+        # Copy under a temporary name so no process ever opens a half-written shard.
+        handle, temporary = tempfile.mkstemp(dir=path.parent, suffix='.sqlite3')
+        os.close(handle)
+        shutil.copyfile(template_path(), temporary)
+        _set_id_ranges(temporary, family_id)
+        os.replace(temporary, path)
+    return register_alias(shard_alias(family_id), path)
+
+
+def shard_for(family_id):
+    """The alias of `family_id`'s shard, provisioning it on first use."""
+    alias = shard_alias(family_id)
+    if alias in connections.settings:
+        return alias
+    return provision_shard(family_id)
+
+
+def shard_family_ids():
+    """The ids of the families that have a shard file."""
+    directory = Path(settings.DATABASE_SHARD_DIR)
+    return sorted(
+        int(path.stem[len(SHARD_ALIAS_PREFIX):])
+        for path in directory.glob(f'{SHARD_ALIAS_PREFIX}*.sqlite3')
+        if path.stem[len(SHARD_ALIAS_PREFIX):].isdigit()
+    )
+
+
+@contextmanager
+def use_family_shard(family_id):
+    """Route every query in the block to `family_id`'s shard, when sharding is on."""
+    token = _family.set(family_id if settings.DATABASE_SHARDING else None)
+    try:
+        yield
+    finally:
+        _family.reset(token)
+
+
+def each_database():
+    """Yield once with no shard selected, then once inside each family's shard, for maintenance jobs."""
+    with use_family_shard(None):
+        yield None
+    if settings.DATABASE_SHARDING:
+        for family_id in shard_family_ids():
+            with use_family_shard(family_id):
+                yield family_id
+
+
+def across_families(queryset):
+    """
+    The rows `queryset` matches in the central database and in every family's shard,
+    for reads that aren't scoped to one family, such as the public timeline.
+    """
+    rows = []
+    for _ in each_database():
+        # A fresh copy each time: an evaluated queryset would hand back its first database's rows.
+        rows.extend(queryset.all())
+    return rows
+
+
+def _columns(cursor, table):
+    cursor.execute(f'PRAGMA main.table_info({table})')
+    return ', '.join(f'"{row[1]}"' for row in cursor.fetchall())
+
+
+def move_central_rows(family_id):
+    """
+    Move the family's rows that are still in the central database into its shard, such as
+    everything from before sharding was turned on, or a new member's earlier posts.
+    Returns the number of rows moved.
+    """
+    from . import search, tags
+
+    alias = shard_for(family_id)
+    params = {'family': family_id}
+    moved = 0
+    with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+        columns = _columns(cursor, 'blog_tag')
+        cursor.execute(
+            f'INSERT OR IGNORE INTO main.blog_tag ({columns}) SELECT {columns} FROM {CENTRAL_SCHEMA}.blog_tag '
+            f'WHERE id IN (SELECT tag_id FROM {CENTRAL_SCHEMA}.blog_post_tags WHERE post_id IN ({POSTS}))',
+            params,
+        )
+        for table, rows in FAMILY_ROWS:
+            columns = _columns(cursor, table)
+            cursor.execute(
+                f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM {CENTRAL_SCHEMA}.{table} WHERE {rows}',
+                params,
+            )
+            moved += cursor.rowcount
+        # A tag the shard already had under another id keeps the shard's id.
+        cursor.execute(
+            'INSERT OR IGNORE INTO main.blog_post_tags (post_id, tag_id) '
+            f'SELECT pt.post_id, st.id FROM {CENTRAL_SCHEMA}.blog_post_tags pt '
+            f'JOIN {CENTRAL_SCHEMA}.blog_tag ct ON ct.id = pt.tag_id JOIN main.blog_tag st ON st.slug = ct.slug '
+            f'WHERE pt.post_id IN ({POSTS})',
+            params,
+        )
+        cursor.execute(f'DELETE FROM {CENTRAL_SCHEMA}.blog_post_search WHERE rowid IN ({POSTS})', params)
+        cursor.execute(f'DELETE FROM {CENTRAL_SCHEMA}.blog_post_tags WHERE post_id IN ({POSTS})', params)
+        # Children first, while the parent rows their filters select on are still there.
+        for table, rows in reversed(FAMILY_ROWS):
+            cursor.execute(f'DELETE FROM {CENTRAL_SCHEMA}.{table} WHERE {rows}', params)
+
+    with use_family_shard(family_id):
+        search.rebuild_index()
+        tags.recount()
+    with use_family_shard(None):
+        tags.recount()
+    return moved
+
+
+class FamilyShardRouter:
+    """
+    With DATABASE_SHARDING on, send queries on TENANT_MODELS made for a family to that
+    family's SQLite file, and everything else to the central database. The central
+    database is attached to each shard so tenant queries can join shared tables such
+    as users, but writes to the two go through separate connections and transactions.
+    """
+
+    def _route(self, model, hints):
+        if not settings.DATABASE_SHARDING or model._meta.model_name not in TENANT_MODELS:
+            return None
+        # An instance loaded from a shard keeps using it for its related rows, even while handling
+        # another family's request, e.g. the posts of a public portfolio from a different family.
+        instance_db = getattr(getattr(hints.get('instance'), '_state', None), 'db', None)
+        if instance_db and is_shard_alias(instance_db):
+            return instance_db
+        family_id = _family.get()
+        return shard_for(family_id) if family_id is not None else None
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not is_shard_alias(db):
+            return None
+        # Shards only get tenant tables; data migrations (no model_name) stay with the central database.
+        return app_label == 'blog' and model_name in TENANT_MODELS
@@ -0,0 +1,131 @@
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+# The JSON lines go to the rotating file configured for this logger in settings.LOGGING.
+logger = logging.getLogger('blog.slow_queries')
+
+EXPLAINABLE_SQL_RE = re.compile(r'^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+
+# The request whose queries are being run (see SlowQueryOriginMiddleware).
+_request = ContextVar('slow_query_request', default=None)
+
+
+def log_slow_queries(execute, sql, params, many, context):
+    started = time.perf_counter()
+    result = execute(sql, params, many, context)
+    duration = time.perf_counter() - started
+    if duration * 1000 >= settings.SLOW_QUERY_THRESHOLD_MS:
+        record_slow_query(context['connection'], sql, params, many, duration)
+    return result
+
+
+def install(connection):
+    """Add log_slow_queries to every query `connection` runs, once."""
+    if log_slow_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(log_slow_queries)
+
+
+@contextmanager
+def query_origin(request):
+    token = _request.set(request)
+    try:
+        yield
+    finally:
+        _request.reset(token)
+
+
+def _origin():
+    request = _request.get()
+    if request is None:
+        return None, None
+    match = getattr(request, 'resolver_match', None)
+    return (match.view_name if match else None), request.path
+
+
+def explain(connection, sql, params):
+    """The query plan for `sql`, one line per step, without running it."""
+    if not EXPLAINABLE_SQL_RE.match(sql):
+        return []
+    # create_cursor() bypasses execute wrappers, so this neither recurses nor trips the read-only guard.
+    cursor = connection.create_cursor()
+    try:
+        with connection.wrap_database_errors:
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+            # SQLite rows are (id, parent, notused, detail); the detail is the readable part.
+            return [row[-1] for row in cursor.fetchall()]
+    except DatabaseError as error:
+        return [f'EXPLAIN failed: {error}']
+    finally:
+        cursor.close()
+
+
+def record_slow_query(connection, sql, params, many, duration):
+    view_name, path = _origin()
+    # executemany() runs one statement for many parameter rows; explaining the first row is enough.
+    params = params[0] if many and params else params
+    logger.warning(json.dumps({
+        'time': timezone.now().isoformat(),
+        'duration_ms': round(duration * 1000, 1),
+        'sql': sql,
+        'params': [repr(param) for param in params or ()],
+        'many': many,
+        'view': view_name,
+        'path': path,
+        'plan': explain(connection, sql, params),
+    }))
+
+
+def normalise_sql(sql):
+    """
+    Reduce a statement to its shape: IN lists of any length, bulk inserts of any
+    size, LIMIT/OFFSET values and other inlined literals compare equal.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "'?'", sql)
+    sql = re.sub(r'\b\d+\b', 'N', sql)
+    sql = re.sub(r'\(\s*%s(?:\s*,\s*%s)*\s*\)', '(%s, ...)', sql)
+    # Multi-row VALUES lists from bulk inserts.
+    sql = re.sub(r'\(%s, \.\.\.\)(?:\s*,\s*\(%s, \.\.\.\))+', '(%s, ...)', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def read_log(path=None):
+    """Yield the logged slow queries, oldest file first, including rotated backups."""
+    path = Path(path or settings.SLOW_QUERY_LOG)
+    # RotatingFileHandler keeps backups as .1 (newest) to .N (oldest).
+    backups = [p for p in path.parent.glob(f'{path.name}.*') if p.suffix[1:].isdigit()]
+    backups.sort(key=lambda p: int(p.suffix[1:]), reverse=True)
+    for log_file in [*backups, path]:
+        if not log_file.exists():
+            continue
+        with log_file.open() as lines:
+            for line in lines:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def aggregate(records):
+    """Group slow queries by normalised SQL, slowest total time first."""
+    shapes = {}
+    for record in records:
+        shape = shapes.setdefault(normalise_sql(record['sql']), {
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'views': Counter(), 'slowest': record,
+        })
+        shape['count'] += 1
+        shape['total_ms'] += record['duration_ms']
+        shape['views'][record.get('view') or record.get('path') or '(no request)'] += 1
+        if record['duration_ms'] >= shape['max_ms']:
+            shape['max_ms'] = record['duration_ms']
+            shape['slowest'] = record
+    return sorted(shapes.items(), key=lambda item: item[1]['total_ms'], reverse=True)
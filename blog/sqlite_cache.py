@@ -0,0 +1,135 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# Writes between checks on the number of entries, so a set() doesn't count the table every time.
+CULL_CHECK_INTERVAL = 100
+LIVE = '(expires IS NULL OR expires > ?)'
+
+
+class SQLiteCache(BaseCache):
+    """
+    A cache in one SQLite file that every process on the host opens, so what one
+    Gunicorn worker sets or deletes the other workers and the task worker see at once.
+
+    Integers are stored as SQLite integers rather than pickled, which lets incr()
+    be a single UPDATE: two processes bumping the same counter never lose a step.
+    """
+
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self.path = location
+        options = params.get('OPTIONS', {})
+        self.busy_timeout = options.get('BUSY_TIMEOUT', 5)
+        self._local = threading.local()
+        self._writes = 0
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        # A connection opened before Gunicorn forked the worker belongs to the master.
+        if db is None or self._local.pid != os.getpid():
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL) WITHOUT ROWID'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _encode(self, value):
+        if type(value) is int and -2 ** 63 <= value < 2 ** 63:
+            return value
+        return pickle.dumps(value, self.pickle_protocol)
+
+    def _decode(self, stored):
+        return stored if isinstance(stored, int) else pickle.loads(stored)
+
+    def _write(self, key, value, timeout, only_if_missing=False):
+        sql = (
+            'INSERT INTO cache (key, value, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires'
+        )
+        params = [key, self._encode(value), self.get_backend_timeout(timeout)]
+        if only_if_missing:
+            # An expired row counts as missing.
+            sql += ' WHERE cache.expires IS NOT NULL AND cache.expires <= ?'
+            params.append(time.time())
+        written = self._db().execute(sql, params).rowcount > 0
+        self._writes += 1
+        if self._writes % CULL_CHECK_INTERVAL == 0:
+            self._cull()
+        return written
+
+    def _cull(self):
+        db = self._db()
+        db.execute('DELETE FROM cache WHERE expires <= ?', [time.time()])
+        (entries,) = db.execute('SELECT COUNT(*) FROM cache').fetchone()
+        if entries <= self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            db.execute('DELETE FROM cache')
+            return
+        # Drop the entries closest to expiring; those without a timeout go last.
+        db.execute(
+            'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires IS NULL, expires LIMIT ?)',
+            [entries // self._cull_frequency],
+        )
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self._db().execute(f'SELECT value FROM cache WHERE key = ? AND {LIVE}', [key, time.time()]).fetchone()
+        return default if row is None else self._decode(row[0])
+
+    def get_many(self, keys, version=None):
+        keys = {self.make_and_validate_key(key, version=version): key for key in keys}
+        if not keys:
+            return {}
+        placeholders = ', '.join('?' * len(keys))
+        rows = self._db().execute(
+            f'SELECT key, value FROM cache WHERE key IN ({placeholders}) AND {LIVE}', [*keys, time.time()]
+        )
+        return {keys[key]: self._decode(value) for key, value in rows}
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._write(self.make_and_validate_key(key, version=version), value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._write(self.make_and_validate_key(key, version=version), value, timeout, only_if_missing=True)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._db().execute(
+            f'UPDATE cache SET expires = ? WHERE key = ? AND {LIVE}',
+            [self.get_backend_timeout(timeout), key, time.time()],
+        ).rowcount > 0
+
+    def incr(self, key, delta=1, version=None):
+        validated = self.make_and_validate_key(key, version=version)
+        rows = self._db().execute(
+            f"UPDATE cache SET value = value + ? WHERE key = ? AND {LIVE} AND typeof(value) = 'integer' RETURNING value",
+            [delta, validated, time.time()],
+        ).fetchall()
+        if not rows:
+            raise ValueError(f"Key '{key}' not found")
+        return rows[0][0]
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._db().execute('DELETE FROM cache WHERE key = ?', [key]).rowcount > 0
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._db().execute(f'SELECT 1 FROM cache WHERE key = ? AND {LIVE}', [key, time.time()]).fetchone() is not None
+
+    def clear(self):
+        self._db().execute('DELETE FROM cache')
@@ -0,0 +1,84 @@
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.text import slugify
+
+from .models import Tag
+from .sharding import across_families
+
+TAG_CLOUD_SIZE = 30
+
+
+def normalise_tag_names(raw):
+    """
+    Split a comma-separated tag string into clean names, one per slug.
+
+    "Science", "science " and "SCIENCE" all slugify to the same slug, which
+    Tag.slug must keep unique, so only the first spelling is kept.
+    """
+    names = {}
+    for name in str(raw or '').split(','):
+        name = re.sub(r'\s+', ' ', name).strip()
+        slug = slugify(name)
+        if slug and slug not in names:
+            names[slug] = name
+    return names
+
+
+def resolve_tags(raw):
+    """Return the Tag for every name in `raw`, creating missing ones in one bulk insert."""
+    names = normalise_tag_names(raw)
+    if not names:
+        return []
+    tags = {tag.slug: tag for tag in Tag.objects.filter(slug__in=names)}
+    missing = [slug for slug in names if slug not in tags]
+    if missing:
+        # bulk_create skips Tag.save(), so the slug is set here rather than derived there.
+        Tag.objects.bulk_create(
+            [Tag(name=names[slug], slug=slug) for slug in missing],
+            ignore_conflicts=True,
+        )
+        # Re-read so tags another request created in the meantime are picked up too.
+        tags.update((tag.slug, tag) for tag in Tag.objects.filter(slug__in=missing))
+    return [tags[slug] for slug in names if slug in tags]
+
+
+def set_post_tags(post, raw):
+    """Make `post`'s tags match `raw`, touching only the M2M rows that changed."""
+    wanted = {tag.pk for tag in resolve_tags(raw)}
+    current = set(post.tags.values_list('pk', flat=True))
+    if current - wanted:
+        post.tags.remove(*(current - wanted))
+    if wanted - current:
+        post.tags.add(*(wanted - current))
+
+
+def adjust_post_counts(tag_ids, delta):
+    if tag_ids:
+        Tag.objects.filter(pk__in=tag_ids).update(post_count=F('post_count') + delta)
+
+
+def recount():
+    """Recompute every Tag.post_count, e.g. after posts were tagged with bulk inserts."""
+    totals = (
+        Tag.post_set.through.objects.filter(tag_id=OuterRef('pk'))
+        .values('tag_id')
+        .annotate(total=Count('post_id'))
+        .values('total')
+    )
+    Tag.objects.update(post_count=Coalesce(Subquery(totals), 0))
+
+
+def tag_cloud(limit=TAG_CLOUD_SIZE):
+    if not settings.DATABASE_SHARDING:
+        return Tag.objects.filter(post_count__gt=0).order_by('-post_count', 'name')[:limit]
+    # Each shard counts only its own family's posts, so a tag's counts are added up by name.
+    counts = Counter()
+    tags = Tag.objects.filter(post_count__gt=0).values_list('name', 'post_count')
+    for name, post_count in across_families(tags):
+        counts[name] += post_count
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    return [Tag(name=name, post_count=post_count) for name, post_count in ranked]
@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import autodiscover_modules
+
+from .models import PeriodicTask, Task, TaskRun
+
+logger = logging.getLogger(__name__)
+
+_registry = {}
+_schedule = {}
+
+# How long a claimed task stays locked before another worker may pick it up again.
+LEASE = timedelta(minutes=10)
+# How often a running task's lease is pushed back out to LEASE from now.
+HEARTBEAT_INTERVAL = LEASE / 4
+
+
+def task(func=None, *, max_attempts=3, every=None):
+    """
+    Register a function as a queueable task.
+
+    `every` (a timedelta) also schedules it to be queued periodically by
+    whichever worker notices it's due first.
+    """
+    def decorator(func):
+        func.task_name = f'{func.__module__}.{func.__name__}'
+        func.max_attempts = max_attempts
+        _registry[func.task_name] = func
+        if every is not None:
+            _schedule[func.task_name] = every
+        return func
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def autodiscover():
+    autodiscover_modules('tasks')
+
+
+def enqueue(func, *args, **kwargs):
+    if settings.TASK_QUEUE_EAGER:
+        transaction.on_commit(lambda: func(*args, **kwargs))
+        return None
+    return Task.objects.create(
+        name=func.task_name,
+        args=list(args),
+        kwargs=kwargs,
+        max_attempts=func.max_attempts,
+    )
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=settings.TASK_RETRY_BACKOFF * 2 ** (attempts - 1))
+
+
+def seed_periodic_tasks(now=None):
+    """Create the schedule row for each periodic task that doesn't have one yet. Run once at worker start."""
+    now = now or timezone.now()
+    PeriodicTask.objects.bulk_create(
+        [PeriodicTask(name=name, next_run_at=now) for name in _schedule],
+        ignore_conflicts=True,
+    )
+
+
+def schedule_periodic_tasks(now=None):
+    now = now or timezone.now()
+    due = PeriodicTask.objects.filter(name__in=list(_schedule), next_run_at__lte=now)
+    for periodic in due:
+        # Only the worker whose conditional UPDATE lands gets to queue this run.
+        claimed = PeriodicTask.objects.filter(pk=periodic.pk, next_run_at=periodic.next_run_at).update(
+            next_run_at=now + _schedule[periodic.name],
+            last_run_at=now,
+        )
+        if claimed:
+            Task.objects.create(name=periodic.name, max_attempts=_registry[periodic.name].max_attempts)
+
+
+def requeue_expired_tasks(now=None):
+    """
+    Requeue running tasks whose worker stopped renewing their lease, presumably because it
+    died. A task that has used all its attempts fails instead, so a task that crashes its
+    worker isn't claimed forever.
+    """
+    now = now or timezone.now()
+    expired = Task.objects.filter(status='running', locked_until__lt=now)
+    for task in expired.filter(attempts__gte=F('max_attempts')):
+        last_error = f'Lease expired on {task.locked_by} during attempt {task.attempts} of {task.max_attempts}'
+        failed = expired.filter(pk=task.pk).update(status='failed', locked_by='', locked_until=None, last_error=last_error)
+        if failed:
+            # The run's real start isn't known; the lease was last renewed LEASE before it ran out.
+            started_date = task.locked_until - LEASE
+            TaskRun.objects.create(
+                task=task,
+                worker=task.locked_by,
+                started_date=started_date,
+                duration_ms=(now - started_date).total_seconds() * 1000,
+                succeeded=False,
+                error=last_error,
+            )
+            logger.error('Task %s (%s) failed: %s', task.pk, task.name, last_error)
+    return expired.filter(attempts__lt=F('max_attempts')).update(
+        status='queued',
+        locked_by='',
+        locked_until=None,
+    )
+
+
+def claim_next_task(worker_id):
+    """
+    Claim the oldest due task for `worker_id`, or return None.
+
+    SQLite has no SELECT ... FOR UPDATE, so each candidate is claimed with a
+    conditional UPDATE; SQLite serialises writers, so only one worker's
+    UPDATE can match a still-queued row.
+    """
+    now = timezone.now()
+    candidates = Task.objects.filter(status='queued', run_at__lte=now).order_by('run_at', 'id').values_list('id', flat=True)[:10]
+    for task_id in candidates:
+        claimed = Task.objects.filter(pk=task_id, status='queued').update(
+            status='running',
+            locked_by=worker_id,
+            locked_until=now + LEASE,
+            attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return Task.objects.get(pk=task_id)
+    return None
+
+
+@contextmanager
+def heartbeat(task, worker_id):
+    """
+    Keep extending a running task's lease from a background thread, so a task that
+    runs longer than LEASE isn't requeued and run a second time by another worker.
+    """
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while not stopped.wait(HEARTBEAT_INTERVAL.total_seconds()):
+                Task.objects.filter(pk=task.pk, status='running', locked_by=worker_id).update(
+                    locked_until=timezone.now() + LEASE,
+                )
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=beat, name=f'{worker_id}:heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def run_task(task, worker_id):
+    func = _registry.get(task.name)
+    started_date = timezone.now()
+    started = time.perf_counter()
+    error = ''
+    try:
+        if func is None:
+            raise LookupError(f'Unknown task {task.name!r}')
+        with heartbeat(task, worker_id):
+            func(*task.args, **task.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception('Task %s (%s) failed', task.pk, task.name)
+    duration_ms = (time.perf_counter() - started) * 1000
+
+    TaskRun.objects.create(
+        task=task,
+        worker=worker_id,
+        started_date=started_date,
+        duration_ms=duration_ms,
+        succeeded=not error,
+        error=error,
+    )
+
+    task.locked_by = ''
+    task.locked_until = None
+    if not error:
+        task.status = 'succeeded'
+    elif task.attempts < task.max_attempts and func is not None:
+        task.status = 'queued'
+        task.run_at = timezone.now() + retry_delay(task.attempts)
+    else:
+        task.status = 'failed'
+    task.last_error = error
+    # If the lease ran out and the task was requeued, it belongs to whoever claimed it next.
+    finished = Task.objects.filter(pk=task.pk, status='running', locked_by=worker_id).update(
+        status=task.status,
+        run_at=task.run_at,
+        locked_by='',
+        locked_until=None,
+        last_error=error,
+    )
+    if not finished:
+        logger.warning('Task %s (%s) lost its lease to another worker; not recording its result', task.pk, task.name)
+    return not error
+
+
+class Worker:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+
+    def run_once(self):
+        """Do one round of housekeeping and run at most one task. Returns True if a task ran."""
+        schedule_periodic_tasks()
+        requeue_expired_tasks()
+        task = claim_next_task(self.worker_id)
+        if task is None:
+            return False
+        run_task(task, self.worker_id)
+        return True
+
+    def drain(self):
+        while self.run_once():
+            pass
+
+    def run_forever(self, stop_event, poll_interval):
+        while not stop_event.is_set():
+            close_old_connections()
+            if not self.run_once():
+                stop_event.wait(poll_interval)
+        close_old_connections()
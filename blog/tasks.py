@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import notifications, renditions  # noqa: F401 -- registers their tasks with the worker
+from .models import Task
+from .sharding import each_database
+from .task_queue import task
+from .view_counts import flush_view_counts
+
+
+@task(every=timedelta(seconds=settings.VIEW_COUNT_FLUSH_INTERVAL))
+def flush_buffered_views():
+    for _ in each_database():
+        flush_view_counts()
+
+
+@task(every=timedelta(hours=1))
+def purge_finished_tasks():
+    cutoff = timezone.now() - timedelta(days=settings.TASK_RETENTION_DAYS)
+    Task.objects.filter(status__in=['succeeded', 'failed'], created_date__lt=cutoff).delete()
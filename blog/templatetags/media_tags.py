@@ -0,0 +1,47 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+
+from blog.renditions import available_renditions
+
+register = template.Library()
+
+
+def _srcset(renditions):
+    return ', '.join(f'{default_storage.url(name)} {width}w' for width, name in renditions)
+
+
+@register.simple_tag
+def rendition_url(image, width, kind='photo'):
+    """URL of the smallest rendition at least `width` wide, falling back to the original upload."""
+    if not image:
+        return ''
+    renditions = available_renditions(image, kind, 'jpg')
+    for rendition_width, name in renditions:
+        if rendition_width >= width:
+            return default_storage.url(name)
+    return image.url
+
+
+@register.simple_tag
+def responsive_image(image, alt='', css_class='', sizes='100vw', kind='photo'):
+    """
+    Render a lazily loaded <img> with a WebP/JPEG srcset of the upload's renditions.
+
+    Uploads whose renditions haven't been generated yet render the original file.
+    """
+    if not image:
+        return ''
+    jpeg = available_renditions(image, kind, 'jpg')
+    if not jpeg:
+        return format_html('<img src="{}" class="{}" alt="{}" loading="lazy">', image.url, css_class, alt)
+
+    webp = available_renditions(image, kind, 'webp')
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" class="{}" alt="{}" loading="lazy" decoding="async">'
+        '</picture>',
+        _srcset(webp), sizes,
+        default_storage.url(jpeg[-1][1]), _srcset(jpeg), sizes, css_class, alt,
+    )
@@ -1,6 +1,88 @@
-from django.test import TestCase
-from django.contrib.auth.models import User
-from .models import Post, Subject, Family
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import date, timedelta
+from importlib import import_module
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest.mock import patch
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, connections, transaction
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.models import Sum
+from django.http import HttpResponse
+from django.template import Context, Template, engines
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import metrics, task_queue
+from . import notifications as notification_service
+from . import urls as blog_urls
+from .caching import bump_generation, cache_version, cached
+from .media import parse_range
+from .middleware import RequestProfilingMiddleware, UserContext
+from .models import (
+    Announcement, Assessment, Comment, Criterion, DailyActivity, Evaluation, Family, Level,
+    Notification, PeerReviewRequest, PendingPostView, PeriodicTask, Portfolio, Post, Presentation,
+    PresentationPost, Profile, Rubric, Subject, Tag, Task, TaskRun,
+)
+from .notifications import fan_out_notifications
+from .pagination import CursorPaginator
+from .profiling import profiles_by_view, sign_profile_header
+from .renditions import create_renditions, rendition_name
+from .routers import READ_ALIAS, ReadWriteRouter, WriteDuringReadOnlyRequest, allow_writes, read_only
+from .search import search_posts
+from .seeding import rebuild_derived_data, seed_family
+from .sharding import ID_SPACE, FamilyChangeBetweenShards, is_shard_alias, shard_family_ids, use_family_shard
+from .slow_queries import log_slow_queries, normalise_sql, read_log
+from .sqlite_cache import SQLiteCache
+from .tags import normalise_tag_names, set_post_tags, tag_cloud
+from .task_queue import (
+    Worker, claim_next_task, enqueue, requeue_expired_tasks, run_task, schedule_periodic_tasks,
+    seed_periodic_tasks, task,
+)
+from .view_counts import flush_view_counts
+
+# The shared cache outlives each test's rolled-back data, so tests run without one unless they ask.
+cache_override = override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+
+def setUpModule():
+    cache_override.enable()
+
+def tearDownModule():
+    cache_override.disable()
+
+def create_member(username, family=None, group=None, **fields):
+    """A user who signs in with 'password', in the 'Teachers' or 'Students' `group` and in `family`."""
+    user = User.objects.create_user(username=username, password='password', **fields)
+    if group:
+        user.groups.add(Group.objects.get(name=group))
+    if family:
+        user.profile.family = family
+        user.profile.save()
+    return user
+
+def create_post(author, subject, title='Volcano', content='Boom', status='published', **fields):
+    return Post.objects.create(author=author, subject=subject, title=title, content=content, status=status, **fields)
+
+def make_jpeg(width, height):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), 'orange').save(buffer, 'JPEG')
+    return SimpleUploadedFile('sunset.jpg', buffer.getvalue(), content_type='image/jpeg')
 
 class PostModelTest(TestCase):
 
@@ -74,14 +156,54 @@ class PostViewTest(TestCase):
     def test_view_count_increment(self):
         """Test that the view_count is incremented when the post_detail view is accessed."""
         self.client.get(f'/post/{self.post.pk}/')
+        flush_view_counts()
         self.post.refresh_from_db()
         self.assertEqual(self.post.view_count, 1)
 
         self.client.get(f'/post/{self.post.pk}/')
+        flush_view_counts()
         self.post.refresh_from_db()
         self.assertEqual(self.post.view_count, 2)
 
-from django.db import IntegrityError
+    def test_view_is_buffered_without_reading_the_buffer(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/post/{self.post.pk}/')
+        self.assertEqual(response.context['displayed_view_count'], 1)
+        sqls = [q['sql'] for q in queries.captured_queries]
+        self.assertEqual(sum('blog_pendingpostview' in sql for sql in sqls), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.view_count, 0)
+
+    def test_status_change_does_not_write_back_the_view_count(self):
+        family = Family.objects.create(name='The Simpsons')
+        self.user.profile.family = family
+        self.user.profile.save()
+        create_member('hoover', family, 'Teachers')
+        self.client.login(username='hoover', password='password')
+        self.client.get(f'/post/{self.post.pk}/')
+        self.client.post(f'/post/{self.post.pk}/', {'review_status': 'approved', 'status_submit': ''})
+        flush_view_counts()
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.review_status, self.post.view_count), ('approved', 2))
+
+    def test_flush_batches_one_update_per_post(self):
+        other = Post.objects.create(author=self.user, subject=self.subject, title='Other', content='x')
+        for post in [self.post, self.post, other, self.post]:
+            PendingPostView.objects.create(post=post)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(flush_view_counts(), 4)
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.post.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.post.view_count, other.view_count), (3, 1))
+        self.assertFalse(PendingPostView.objects.exists())
+
+    def test_flush_command(self):
+        PendingPostView.objects.create(post=self.post)
+        out = StringIO()
+        call_command('flush_view_counts', stdout=out)
+        self.assertIn('Flushed 1 views.', out.getvalue())
 
 class FamilyModelTest(TestCase):
 
@@ -98,3 +220,1702 @@ class ProfileModelTest(TestCase):
         user = User.objects.create_user(username='newuser', password='password')
         self.assertIsNotNone(user.profile)
         self.assertEqual(user.profile.user, user)
+
+class CursorPaginationTest(TestCase):
+
+    def setUp(self):
+        self.user = create_member('testuser')
+        self.subject = Subject.objects.create(name='Test Subject')
+        now = timezone.now()
+        self.posts = [
+            Post.objects.create(
+                author=self.user,
+                subject=self.subject,
+                title=f'Post {i}',
+                content='Content',
+                status='published',
+                created_date=now - timedelta(days=i % 5)  # Duplicate timestamps exercise the id tie-breaker
+            )
+            for i in range(14)
+        ]
+
+    def walk(self, descending):
+        paginator = CursorPaginator(Post.objects.all(), 6, descending=descending)
+        page = paginator.get_page()
+        seen = list(page)
+        while page.has_next():
+            page = paginator.get_page(after=page.next_cursor)
+            seen.extend(page)
+        return seen
+
+    def test_pages_cover_every_post_once(self):
+        """Test that following next cursors visits every post exactly once, in order."""
+        newest = self.walk(descending=True)
+        self.assertEqual(len(newest), 14)
+        self.assertEqual(newest, sorted(self.posts, key=lambda p: (p.created_date, p.pk), reverse=True))
+
+        oldest = self.walk(descending=False)
+        self.assertEqual(oldest, newest[::-1])
+
+    def test_previous_cursor_returns_prior_page(self):
+        """Test that stepping back from page two lands on page one."""
+        paginator = CursorPaginator(Post.objects.all(), 6)
+        first = paginator.get_page()
+        second = paginator.get_page(after=first.next_cursor)
+        self.assertFalse(first.has_previous())
+        self.assertTrue(second.has_previous())
+        self.assertEqual(list(paginator.get_page(before=second.previous_cursor)), list(first))
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        paginator = CursorPaginator(Post.objects.all(), 6)
+        self.assertEqual(list(paginator.get_page(after='not-a-cursor')), list(paginator.get_page()))
+
+    def test_deep_page_costs_same_as_first_page(self):
+        """Test that a later page runs the same number of queries as the first."""
+        with CaptureQueriesContext(connection) as first_queries:
+            response = self.client.get('/public-timeline/')
+        cursor = response.context['page_obj'].next_cursor
+        with CaptureQueriesContext(connection) as second_queries:
+            response = self.client.get(f'/public-timeline/?after={cursor}')
+        self.assertEqual(len(response.context['page_obj']), 6)
+        self.assertEqual(len(first_queries), len(second_queries))
+        self.assertFalse(any('COUNT(' in q['sql'] for q in second_queries.captured_queries))
+
+class PostSearchTest(TestCase):
+
+    def setUp(self):
+        self.family = Family.objects.create(name='The Simpsons')
+        self.other_family = Family.objects.create(name='The Flanders')
+        self.user = create_member('testuser', self.family)
+        self.subject = Subject.objects.create(name='Science')
+        self.post = create_post(
+            self.user, self.subject, title='Volcano experiment', content='Baking soda and vinegar.',
+            photo_caption='Eruption in the kitchen',
+        )
+
+    def test_matches_every_indexed_field(self):
+        """Test that title, content, caption and tag names are all searchable."""
+        self.post.tags.add(Tag.objects.create(name='chemistry'))
+        for query in ['volcano', 'vinegar', 'eruption', 'chemistry', 'volc']:
+            self.assertEqual(list(search_posts(Post.objects.all(), query)), [self.post], query)
+
+    def test_index_follows_edits_and_deletes(self):
+        self.post.title = 'Rainbow prism'
+        self.post.save()
+        self.assertFalse(search_posts(Post.objects.all(), 'volcano').exists())
+        self.assertTrue(search_posts(Post.objects.all(), 'rainbow').exists())
+
+        tag = Tag.objects.create(name='optics')
+        self.post.tags.add(tag)
+        tag.name = 'light'
+        tag.save()
+        self.assertTrue(search_posts(Post.objects.all(), 'light').exists())
+        self.post.tags.clear()
+        self.assertFalse(search_posts(Post.objects.all(), 'light').exists())
+
+        self.post.delete()
+        self.assertFalse(search_posts(Post.objects.all(), 'rainbow').exists())
+
+    def test_results_are_ranked(self):
+        """Test that a post mentioning the term more often ranks first."""
+        stronger = Post.objects.create(
+            author=self.user,
+            subject=self.subject,
+            title='Volcano volcano',
+            content='All about the volcano.',
+        )
+        results = search_posts(Post.objects.all(), 'volcano')
+        self.assertEqual(list(results), [stronger, self.post])
+        self.assertLess(results[0].search_rank, results[1].search_rank)
+
+    def test_scoped_per_family(self):
+        self.assertTrue(search_posts(Post.objects.all(), 'volcano', family=self.family).exists())
+        self.assertFalse(search_posts(Post.objects.all(), 'volcano', family=self.other_family).exists())
+
+        self.user.profile.family = self.other_family
+        self.user.profile.save()
+        self.assertTrue(search_posts(Post.objects.all(), 'volcano', family=self.other_family).exists())
+
+    def test_query_syntax_is_escaped(self):
+        self.assertFalse(search_posts(Post.objects.all(), '"').exists())
+        self.assertFalse(search_posts(Post.objects.all(), 'volcano AND NEAR(').exists())
+        self.assertTrue(search_posts(Post.objects.all(), 'volcano (').exists())
+
+    def test_teacher_dashboard_search(self):
+        create_member('hoover', self.family, 'Teachers')
+        self.user.groups.add(Group.objects.get(name='Students'))
+        self.client.login(username='hoover', password='password')
+        response = self.client.get('/teacher/dashboard/?q=volcano')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_posts'], 1)
+
+class UserContextTest(TestCase):
+
+    def setUp(self):
+        self.family = Family.objects.create(name='The Simpsons')
+        self.user = User.objects.get(pk=create_member('testuser', self.family, 'Teachers').pk)
+
+    def test_loads_profile_roles_and_unread_count_in_one_query(self):
+        Notification.objects.create(recipient=self.user, message='Hello')
+        Notification.objects.create(recipient=self.user, message='Read', read=True)
+        with self.assertNumQueries(1):
+            user_context = UserContext(self.user)
+            self.assertEqual(user_context.family, self.family)
+            self.assertTrue(user_context.is_teacher)
+            self.assertFalse(user_context.is_student)
+            self.assertEqual(user_context.unread_notification_count, 1)
+            self.assertEqual(self.user.profile, user_context.profile)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(user_context.unread_notifications), 1)
+
+    def test_creates_missing_profile(self):
+        self.user.profile.delete()
+        user = User.objects.get(pk=self.user.pk)
+        self.assertIsNotNone(UserContext(user).profile)
+
+    def test_page_query_count_is_independent_of_notifications(self):
+        self.client.login(username='testuser', password='password')
+        Notification.objects.create(recipient=self.user, message='First')
+        with CaptureQueriesContext(connection) as few:
+            self.client.get('/announcements/')
+        Notification.objects.bulk_create(Notification(recipient=self.user, message=str(i)) for i in range(10))
+        with CaptureQueriesContext(connection) as many:
+            self.client.get('/announcements/')
+        self.assertEqual(len(few), len(many))
+
+    def test_teacher_views_reject_students(self):
+        create_member('bart', group='Students')
+        self.client.login(username='bart', password='password')
+        response = self.client.get('/teacher/dashboard/')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/accounts/login/', response.url)
+
+class NotificationFanOutTest(TestCase):
+
+    def setUp(self):
+        self.family = Family.objects.create(name='The Simpsons')
+        self.teacher = create_member('hoover', self.family, 'Teachers')
+        self.students = [
+            create_member('bart', self.family, 'Students'),
+            create_member('lisa', self.family, 'Students'),
+            create_member('milhouse', group='Students'),
+        ]
+
+    def test_fan_out_is_chunked_and_idempotent(self):
+        recipient_ids = [student.pk for student in self.students]
+        with patch.object(notification_service, 'FAN_OUT_CHUNK_SIZE', 2):
+            with CaptureQueriesContext(connection) as queries:
+                fan_out_notifications(recipient_ids, 'Hello', 'test:1')
+            fan_out_notifications(recipient_ids, 'Hello', 'test:1')
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(Notification.objects.filter(batch_key='test:1').count(), 3)
+
+    def test_announcement_notifies_family_students_in_background(self):
+        self.client.login(username='hoover', password='password')
+        response = self.client.post('/announcements/new/', {'title': 'Field trip', 'content': 'Friday'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Notification.objects.exists())
+
+        Worker('test').drain()
+        recipients = set(Notification.objects.values_list('recipient__username', flat=True))
+        self.assertEqual(recipients, {'bart', 'lisa'})
+
+        # Re-running the same delivery must not duplicate anything.
+        Task.objects.update(status='queued')
+        Worker('test').drain()
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_peer_review_request_is_bulk_and_repeatable(self):
+        subject = Subject.objects.create(name='Science')
+        post = Post.objects.create(author=self.students[0], subject=subject, title='Volcano', content='x')
+        self.client.login(username='bart', password='password')
+        data = {'reviewers': [self.students[1].pk, self.teacher.pk]}
+        self.client.post(f'/post/{post.pk}/request-review/', data)
+        self.client.post(f'/post/{post.pk}/request-review/', data)
+        Worker('test').drain()
+        self.assertEqual(PeerReviewRequest.objects.filter(post=post).count(), 2)
+        self.assertEqual(Notification.objects.filter(post=post, recipient=self.teacher).count(), 2)
+
+flaky_calls = []
+
+@task(max_attempts=2)
+def flaky_task(value):
+    flaky_calls.append(value)
+    raise ValueError('boom')
+
+@task
+def recording_task(value):
+    flaky_calls.append(value)
+
+class TaskQueueTest(TestCase):
+
+    def setUp(self):
+        flaky_calls.clear()
+
+    def test_task_runs_once_and_records_timing(self):
+        queued = enqueue(recording_task, 'hello')
+        Worker('test').drain()
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, 'succeeded')
+        self.assertEqual(flaky_calls, ['hello'])
+        run = TaskRun.objects.get(task=queued)
+        self.assertTrue(run.succeeded)
+        self.assertGreaterEqual(run.duration_ms, 0)
+
+    def test_claimed_task_cannot_be_claimed_again(self):
+        queued = enqueue(recording_task, 'once')
+        self.assertEqual(claim_next_task('worker-1'), queued)
+        self.assertIsNone(claim_next_task('worker-2'))
+
+    @override_settings(TASK_RETRY_BACKOFF=30)
+    def test_failures_retry_with_backoff_then_fail(self):
+        queued = enqueue(flaky_task, 1)
+        with self.assertLogs('blog.task_queue', 'ERROR'):
+            self.assertFalse(run_task(claim_next_task('test'), 'test'))
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, 'queued')
+        self.assertGreater(queued.run_at, timezone.now() + timedelta(seconds=25))
+        self.assertIsNone(claim_next_task('test'))
+
+        Task.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+        with self.assertLogs('blog.task_queue', 'ERROR'):
+            run_task(claim_next_task('test'), 'test')
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, 'failed')
+        self.assertIn('ValueError: boom', queued.last_error)
+        self.assertEqual(TaskRun.objects.filter(task=queued, succeeded=False).count(), 2)
+
+    def test_result_is_dropped_once_the_lease_is_lost(self):
+        queued = enqueue(recording_task, 'slow')
+        claimed = claim_next_task('worker-1')
+        # The lease ran out and another worker claimed the task in the meantime.
+        Task.objects.filter(pk=queued.pk).update(locked_by='worker-2')
+        with self.assertLogs('blog.task_queue', 'WARNING'):
+            run_task(claimed, 'worker-1')
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.locked_by), ('running', 'worker-2'))
+
+    def test_expired_leases_are_requeued_until_attempts_run_out(self):
+        queued = enqueue(recording_task, 'crash')
+        later = timezone.now() + task_queue.LEASE + timedelta(minutes=1)
+        for attempt in range(1, queued.max_attempts):
+            claim_next_task('worker-1')
+            self.assertEqual(requeue_expired_tasks(later), 1)
+            queued.refresh_from_db()
+            self.assertEqual((queued.status, queued.attempts), ('queued', attempt))
+
+        claim_next_task('worker-1')
+        with self.assertLogs('blog.task_queue', 'ERROR'):
+            self.assertEqual(requeue_expired_tasks(later), 0)
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.locked_by), ('failed', ''))
+        self.assertIn('Lease expired', queued.last_error)
+        run = TaskRun.objects.get(task=queued)
+        self.assertEqual((run.worker, run.succeeded, run.error), ('worker-1', False, queued.last_error))
+        self.assertIsNone(claim_next_task('worker-2'))
+
+    def test_periodic_tasks_are_queued_once_per_interval(self):
+        with patch.dict(task_queue._schedule, {recording_task.task_name: timedelta(minutes=5)}, clear=True):
+            now = timezone.now()
+            seed_periodic_tasks(now)
+            seed_periodic_tasks(now)
+            schedule_periodic_tasks(now)
+            schedule_periodic_tasks(now)
+            self.assertEqual(Task.objects.filter(name=recording_task.task_name).count(), 1)
+            schedule_periodic_tasks(now + timedelta(minutes=6))
+            self.assertEqual(Task.objects.filter(name=recording_task.task_name).count(), 2)
+        self.assertTrue(PeriodicTask.objects.filter(name=recording_task.task_name).exists())
+
+    def test_run_worker_burst(self):
+        enqueue(recording_task, 'burst')
+        out = StringIO()
+        call_command('run_worker', '--burst', '--concurrency', '2', stdout=out)
+        self.assertEqual(flaky_calls, ['burst'])
+        self.assertIn('Queue drained.', out.getvalue())
+
+class RenditionTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media_override = override_settings(MEDIA_ROOT=self.media_root)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.user = create_member('testuser')
+        self.subject = Subject.objects.create(name='Art')
+
+    def test_upload_queues_renditions_at_each_width(self):
+        post = Post.objects.create(author=self.user, subject=self.subject, title='Sunset', content='x', photo=make_jpeg(1600, 1200))
+        self.assertTrue(Task.objects.filter(name=create_renditions.task_name, args=[post.photo.name, 'photo']).exists())
+
+        Worker('test').drain()
+        for width in (320, 640, 1024):
+            for extension in ('webp', 'jpg'):
+                with Image.open(os.path.join(self.media_root, rendition_name(post.photo.name, width, extension))) as image:
+                    self.assertEqual(image.size, (width, width * 3 // 4))
+
+    def test_small_uploads_are_not_upscaled(self):
+        post = Post.objects.create(author=self.user, subject=self.subject, title='Tiny', content='x', photo=make_jpeg(200, 100))
+        create_renditions(post.photo.name, 'photo')
+        with Image.open(os.path.join(self.media_root, rendition_name(post.photo.name, 1024, 'jpg'))) as image:
+            self.assertEqual(image.size, (200, 100))
+
+    def test_responsive_image_tag(self):
+        post = Post.objects.create(author=self.user, subject=self.subject, title='Sunset', content='x', photo=make_jpeg(1600, 1200))
+        template = Template('{% load media_tags %}{% responsive_image post.photo alt=post.title css_class="card-img-top" %}')
+
+        html = template.render(Context({'post': post}))
+        self.assertIn(f'src="{post.photo.url}"', html)
+        self.assertIn('loading="lazy"', html)
+
+        create_renditions(post.photo.name, 'photo')
+        post.refresh_from_db()
+        self.assertEqual(post.photo_renditions, [320, 640, 1024])
+        with patch.object(default_storage, 'exists') as exists:
+            html = template.render(Context({'post': post}))
+        exists.assert_not_called()
+        self.assertIn('type="image/webp"', html)
+        self.assertIn('640w', html)
+        self.assertNotIn(f'src="{post.photo.url}"', html)
+
+    def test_only_new_uploads_queue_renditions(self):
+        post = Post.objects.create(author=self.user, subject=self.subject, title='Sunset', content='x', photo=make_jpeg(1600, 1200))
+        Worker('test').drain()
+        post.refresh_from_db()
+        post.title = 'Sunrise'
+        post.save()
+        self.assertFalse(Task.objects.filter(name=create_renditions.task_name, status='queued').exists())
+        self.assertEqual(post.photo_renditions, [320, 640, 1024])
+
+        post.photo = make_jpeg(800, 600)
+        post.save()
+        self.assertEqual(post.photo_renditions, [])
+        self.assertTrue(Task.objects.filter(name=create_renditions.task_name, args=[post.photo.name, 'photo']).exists())
+
+class MediaServingTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media_override = override_settings(MEDIA_ROOT=self.media_root)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.family = Family.objects.create(name='The Simpsons')
+        self.user = create_member('testuser', self.family)
+        self.payload = bytes(range(256)) * 40
+        self.post = Post.objects.create(
+            author=self.user,
+            subject=Subject.objects.create(name='Music'),
+            title='Recital',
+            content='x',
+            status='published',
+            video_file=SimpleUploadedFile('recital.mp4', self.payload, content_type='video/mp4'),
+        )
+        self.url = f'/media/{self.post.video_file.name}'
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=990-2000', 1000), (990, 999))
+        self.assertEqual(parse_range('bytes=1000-', 1000), 'unsatisfiable')
+        self.assertIsNone(parse_range('bytes=0-1,5-9', 1000))
+        self.assertIsNone(parse_range('items=0-1', 1000))
+
+    def test_full_and_partial_responses(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(b''.join(response.streaming_content), self.payload)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.payload)}')
+        self.assertEqual(b''.join(response.streaming_content), self.payload[100:200])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.payload)}-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_conditional_requests(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # A stale If-Range validator means the client gets the whole, current file.
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+    @override_settings(MEDIA_SERVE_MODE='x-accel-redirect')
+    def test_accel_redirect_handoff(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.post.video_file.name}')
+        self.assertEqual(response.content, b'')
+
+    def test_tenant_and_draft_checks(self):
+        create_member('outsider', Family.objects.create(name='The Flanders'))
+        self.client.login(username='outsider', password='password')
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+        self.client.logout()
+        Post.objects.filter(pk=self.post.pk).update(status='draft')
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.client.login(username='testuser', password='password')
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_renditions_follow_the_post_with_the_exact_source(self):
+        self.post.photo = make_jpeg(800, 600)
+        self.post.save()
+        create_renditions(self.post.photo.name, 'photo')
+        url = f'/media/{rendition_name(self.post.photo.name, 320, "jpg")}'
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        # 'photos/sunset.x.png' starts with 'photos/sunset.' but isn't the rendition's source.
+        stem = os.path.splitext(self.post.photo.name)[0]
+        Post.objects.create(author=self.user, subject=self.post.subject, title='Other', content='x', photo=f'{stem}.x.png')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        Post.objects.create(author=self.user, subject=self.post.subject, title='Copy', content='x', photo=self.post.photo.name)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_path_traversal_is_rejected(self):
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, 404)
+        self.assertEqual(self.client.get('/media/videos/missing.mp4').status_code, 404)
+
+class TeacherDashboardHeatmapTest(TestCase):
+
+    def setUp(self):
+        self.family = Family.objects.create(name='The Simpsons')
+        self.teacher = create_member('hoover', self.family, 'Teachers')
+        self.student = create_member('bart', self.family, 'Students')
+        subject = Subject.objects.create(name='History')
+        now = timezone.now()
+        for days_ago, count in [(0, 3), (2, 1), (40, 6)]:
+            for i in range(count):
+                Post.objects.create(author=self.student, subject=subject, title=f'{days_ago}-{i}', content='x' * 1000, created_date=now - timedelta(days=days_ago))
+        Post.objects.create(author=self.student, subject=subject, title='old', content='x', created_date=now - timedelta(days=400))
+        self.client.login(username='hoover', password='password')
+
+    def test_heatmap_is_built_from_daily_aggregates(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/teacher/dashboard/')
+        cells = {day['date']: day for week in response.context['heatmap'] for day in week}
+        today = timezone.now().date()
+        self.assertEqual(cells[today]['count'], 3)
+        self.assertEqual(cells[today]['level'], 2)
+        self.assertEqual(cells[today - timedelta(days=40)]['level'], 3)
+        self.assertEqual(response.context['total_posts_last_year'], 10)
+        self.assertEqual(response.context['busiest_day'], today - timedelta(days=40))
+        self.assertEqual(response.context['busiest_day_count'], 6)
+        self.assertEqual(len(response.context['heatmap']), 53)
+
+        aggregates = [q['sql'] for q in queries.captured_queries if 'GROUP BY' in q['sql']]
+        self.assertTrue(any('FROM "blog_dailyactivity"' in sql for sql in aggregates))
+        self.assertFalse(any('FROM "blog_post"' in sql for sql in aggregates))
+
+    def test_search_falls_back_to_aggregating_posts(self):
+        Post.objects.filter(title='0-0').update(title='Gettysburg')
+        from .search import index_post
+        index_post(Post.objects.get(title='Gettysburg'))
+        response = self.client.get('/teacher/dashboard/?q=gettysburg')
+        self.assertEqual(response.context['total_posts'], 1)
+        self.assertEqual(response.context['total_posts_last_year'], 1)
+
+class DailyActivityRollupTest(TestCase):
+
+    def setUp(self):
+        self.family = Family.objects.create(name='The Simpsons')
+        self.user = create_member('bart', self.family)
+        self.science = Subject.objects.create(name='Science')
+        self.art = Subject.objects.create(name='Art')
+
+    def snapshot(self):
+        return sorted(DailyActivity.objects.values_list('family_id', 'author_id', 'subject_id', 'day', 'status', 'review_status', 'count'))
+
+    def test_family_less_authors_get_one_row_per_key(self):
+        loner = create_member('hermit')
+        Post.objects.create(author=loner, subject=self.science, title='A', content='x')
+        row = DailyActivity.objects.get(author=loner)
+        self.assertIsNone(row.family_id)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            DailyActivity.objects.create(
+                author=loner, subject=self.science, day=row.day, status=row.status, review_status=row.review_status,
+            )
+
+    def test_rollup_tracks_creates_edits_and_deletes(self):
+        first = Post.objects.create(author=self.user, subject=self.science, title='A', content='x')
+        Post.objects.create(author=self.user, subject=self.science, title='B', content='x')
+        self.assertEqual(DailyActivity.objects.get().count, 2)
+
+        first.subject = self.art
+        first.status = 'published'
+        first.save()
+        counts = dict(DailyActivity.objects.values_list('subject__name', 'count'))
+        self.assertEqual(counts, {'Science': 1, 'Art': 1})
+
+        first.title = 'Renamed'
+        first.save()
+        self.assertEqual(sum(DailyActivity.objects.values_list('count', flat=True)), 2)
+
+        first.delete()
+        self.assertEqual(list(DailyActivity.objects.values_list('subject__name', 'count')), [('Science', 1)])
+
+    def test_rollup_follows_family_changes(self):
+        Post.objects.create(author=self.user, subject=self.science, title='A', content='x')
+        other_family = Family.objects.create(name='The Flanders')
+        self.user.profile.family = other_family
+        self.user.profile.save()
+        self.assertEqual(DailyActivity.objects.get().family, other_family)
+
+    def test_rebuild_matches_incremental_rollup(self):
+        now = timezone.now()
+        for i in range(6):
+            Post.objects.create(
+                author=self.user,
+                subject=self.science if i % 2 else self.art,
+                title=str(i),
+                content='x',
+                status='published' if i % 3 else 'draft',
+                created_date=now - timedelta(days=i % 2),
+            )
+        incremental = self.snapshot()
+        out = StringIO()
+        call_command('rebuild_activity_rollup', stdout=out)
+        self.assertEqual(self.snapshot(), incremental)
+        self.assertIn(f'Wrote {len(incremental)} rollup rows.', out.getvalue())
+
+    def test_archive_years_come_from_rollup(self):
+        Post.objects.create(author=self.user, subject=self.science, title='Old', content='x', created_date=timezone.now() - timedelta(days=800))
+        Post.objects.create(author=self.user, subject=self.science, title='New', content='x')
+        self.client.login(username='bart', password='password')
+        response = self.client.get('/author/bart/')
+        this_year = timezone.now().year
+        self.assertEqual(list(response.context['archive_years']), [this_year, (timezone.now() - timedelta(days=800)).year])
+
+class TeacherDashboardSectionsTest(TestCase):
+
+    def setUp(self):
+        self.family = Family.objects.create(name='The Simpsons')
+        self.teacher = create_member('hoover', self.family, 'Teachers')
+        self.client.login(username='hoover', password='password')
+
+    def add_students(self, count, subjects, posts_each):
+        students_group = Group.objects.get(name='Students')
+        for i in range(count):
+            student = User.objects.create(username=f'student{User.objects.count()}')
+            student.groups.add(students_group)
+            Profile.objects.filter(user=student).update(family=self.family)
+            for subject in subjects:
+                for j in range(posts_each):
+                    Post.objects.create(author=student, subject=subject, title=f'{subject.name} {j}', content='x' * 500)
+
+    def test_query_count_is_constant(self):
+        subjects = [Subject.objects.create(name=f'Subject {i}') for i in range(2)]
+        self.add_students(1, subjects, 1)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get('/teacher/dashboard/')
+
+        subjects += [Subject.objects.create(name=f'Subject {i}') for i in range(2, 6)]
+        self.add_students(4, subjects, 2)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get('/teacher/dashboard/')
+        self.assertEqual(len(small), len(large))
+
+        sections = response.context['subject_sections']
+        self.assertEqual(len(sections), 6)
+        self.assertEqual([len(section['posts']) for section in sections], [5] * 6)
+        self.assertEqual(sections[0]['total'], 9)
+        self.assertNotIn('"blog_post"."content"', ' '.join(q['sql'] for q in large.captured_queries))
+
+    def test_single_subject_is_paged(self):
+        subject = Subject.objects.create(name='Science')
+        self.add_students(1, [subject], 30)
+        response = self.client.get(f'/teacher/dashboard/?subject={subject.pk}')
+        page = response.context['section_page']
+        self.assertEqual(len(page), 25)
+        self.assertTrue(page.has_next())
+        response = self.client.get(f'/teacher/dashboard/?subject={subject.pk}&after={page.next_cursor}')
+        self.assertEqual(len(response.context['subject_sections'][0]['posts']), 5)
+
+class QueryPlanTest(TestCase):
+    """The hot list queries must be served by an index, not a full scan plus sort."""
+
+    def setUp(self):
+        self.user = create_member('lisa')
+
+    def assertUsesIndex(self, queryset, index_name, sorted_by_index=True):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index_name}', plan)
+        for line in plan.splitlines():
+            self.assertNotRegex(line, r'\bSCAN blog_', plan)
+        if sorted_by_index:
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_public_timeline(self):
+        queryset = Post.objects.filter(status='published').order_by('-created_date', '-id')
+        self.assertUsesIndex(queryset, 'blog_post_status_created')
+
+    def test_author_timeline(self):
+        queryset = Post.objects.filter(author=self.user).order_by('-created_date')
+        self.assertUsesIndex(queryset, 'blog_post_author_created')
+
+    def test_unread_notifications(self):
+        queryset = Notification.objects.filter(recipient=self.user, read=False).order_by('-created_date')
+        self.assertUsesIndex(queryset, 'blog_notif_recipient_unread')
+
+    def test_unread_notification_count(self):
+        queryset = UserContext(self.user)._profile_queryset().filter(user=self.user)
+        self.assertUsesIndex(queryset, 'blog_notif_recipient_unread')
+
+    def test_pending_peer_reviews(self):
+        queryset = PeerReviewRequest.objects.filter(reviewer=self.user, status='pending')
+        self.assertUsesIndex(queryset, 'blog_review_reviewer_status')
+
+    def test_author_announcements(self):
+        queryset = Announcement.objects.filter(author=self.user).order_by('-created_date')
+        self.assertUsesIndex(queryset, 'blog_announce_author_created')
+
+    def test_family_timeline(self):
+        family = Family.objects.create(name='The Simpsons')
+        queryset = Post.objects.for_family(family).order_by('-created_date')
+        self.assertUsesIndex(queryset, 'blog_post_family_created')
+
+    def test_family_announcements(self):
+        family = Family.objects.create(name='The Simpsons')
+        queryset = Announcement.objects.for_family(family).order_by('-created_date')
+        self.assertUsesIndex(queryset, 'blog_announce_family_created')
+
+class BenchmarkSqliteTest(TestCase):
+
+    def test_reports_both_profiles(self):
+        out = StringIO()
+        call_command('benchmark_sqlite', readers=1, writers=1, duration=0.2, rows=10, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('default', lines[0])
+        self.assertIn('production', lines[1])
+        self.assertIn('reads/s', lines[1])
+
+@override_settings(DATABASE_READ_ONLY_STRICT=True)
+class ReadOnlyRoutingTest(TestCase):
+
+    def setUp(self):
+        self.family = Family.objects.create(name='The Simpsons')
+        self.teacher = create_member('hoover', self.family, 'Teachers')
+        self.student = create_member('bart', self.family, 'Students')
+        self.subject = Subject.objects.create(name='Science')
+        self.post = create_post(self.student, self.subject)
+        self.presentation = Presentation.objects.create(author=self.student, title='Science fair')
+        self.router = ReadWriteRouter()
+
+    def test_get_requests_do_not_write(self):
+        self.client.login(username='hoover', password='password')
+        urls = [
+            '/public-timeline/',
+            f'/post/{self.post.pk}/',
+            '/author/bart/',
+            f'/presentation/{self.presentation.pk}/',
+            '/teacher/dashboard/',
+            '/announcements/',
+            '/rubrics/',
+            '/family/manage/',
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(PendingPostView.objects.filter(post=self.post).count(), 1)
+
+    def test_author_without_profile_is_not_created_on_get(self):
+        self.client.login(username='hoover', password='password')
+        Profile.objects.filter(user=self.student).delete()
+        self.client.get('/author/bart/')
+        self.assertFalse(Profile.objects.filter(user=self.student).exists())
+
+    def test_writes_raise_during_read_only_requests(self):
+        with read_only():
+            with self.assertRaises(WriteDuringReadOnlyRequest), transaction.atomic():
+                Subject.objects.create(name='Art')
+            with allow_writes():
+                Subject.objects.create(name='Music')
+        self.assertTrue(Subject.objects.filter(name='Music').exists())
+
+    @override_settings(DATABASE_READ_ONLY_STRICT=False)
+    def test_writes_are_logged_when_not_strict(self):
+        with read_only(), self.assertLogs('blog.routers', 'WARNING'):
+            Subject.objects.create(name='Art')
+        self.assertTrue(Subject.objects.filter(name='Art').exists())
+
+    def test_reads_use_read_alias_only_for_safe_requests(self):
+        with patch.dict(settings.DATABASES, {READ_ALIAS: {}}):
+            self.assertEqual(self.router.db_for_read(Post), 'default')
+            with read_only():
+                self.assertEqual(self.router.db_for_read(Post), READ_ALIAS)
+                with allow_writes():
+                    self.assertEqual(self.router.db_for_read(Post), 'default')
+        self.assertFalse(self.router.allow_migrate(READ_ALIAS, 'blog'))
+
+    def test_post_requests_can_write(self):
+        self.client.login(username='hoover', password='password')
+        Notification.objects.create(recipient=self.teacher, message='Hello')
+        self.client.post('/notifications/mark-as-read/')
+        self.assertFalse(Notification.objects.filter(recipient=self.teacher, read=False).exists())
+
+class TagServiceTest(TestCase):
+
+    def setUp(self):
+        self.user = create_member('lisa')
+        self.subject = Subject.objects.create(name='Science')
+        self.post = create_post(self.user, self.subject, status='draft')
+
+    def tag_counts(self):
+        return dict(Tag.objects.values_list('name', 'post_count'))
+
+    def test_removing_an_unlinked_tag_keeps_counts(self):
+        other = Post.objects.create(author=self.user, subject=self.subject, title='Other', content='x')
+        set_post_tags(other, 'Lava')
+        lava = Tag.objects.get(name='Lava')
+        self.post.tags.remove(lava)
+        lava.post_set.remove(self.post)
+        self.assertEqual(self.tag_counts(), {'Lava': 1})
+
+    def test_normalise_keeps_one_spelling_per_slug(self):
+        names = normalise_tag_names(' Science ,science,  Rock   Cycle ,, !!, SCIENCE')
+        self.assertEqual(list(names.values()), ['Science', 'Rock Cycle'])
+
+    def test_creates_missing_tags_in_bulk(self):
+        Tag.objects.create(name='chemistry')
+        with CaptureQueriesContext(connection) as queries:
+            set_post_tags(self.post, 'Chemistry, geology, volcanoes')
+        inserts = [q['sql'] for q in queries.captured_queries if 'INTO "blog_tag" ' in q['sql']]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(sorted(self.post.tags.values_list('slug', flat=True)), ['chemistry', 'geology', 'volcanoes'])
+        self.assertEqual(Tag.objects.get(name='geology').slug, 'geology')
+
+    def test_only_changed_links_are_written(self):
+        set_post_tags(self.post, 'geology, volcanoes')
+        with CaptureQueriesContext(connection) as queries:
+            set_post_tags(self.post, 'volcanoes, geology')
+        writes = [q['sql'] for q in queries.captured_queries if q['sql'].startswith(('INSERT', 'DELETE'))]
+        self.assertEqual(writes, [])
+
+        set_post_tags(self.post, 'volcanoes, lava')
+        self.assertEqual(sorted(self.post.tags.values_list('name', flat=True)), ['lava', 'volcanoes'])
+
+    def test_post_counts_follow_tag_changes(self):
+        other = Post.objects.create(author=self.user, subject=self.subject, title='Lava', content='Hot')
+        set_post_tags(self.post, 'geology, volcanoes')
+        set_post_tags(other, 'volcanoes')
+        self.assertEqual(self.tag_counts(), {'geology': 1, 'volcanoes': 2})
+        self.assertEqual([tag.name for tag in tag_cloud()], ['volcanoes', 'geology'])
+
+        set_post_tags(self.post, 'volcanoes')
+        self.assertEqual(self.tag_counts(), {'geology': 0, 'volcanoes': 2})
+
+        other.delete()
+        self.assertEqual(self.tag_counts(), {'geology': 0, 'volcanoes': 1})
+
+        volcanoes = Tag.objects.get(name='volcanoes')
+        volcanoes.post_set.clear()
+        self.assertEqual(self.tag_counts(), {'geology': 0, 'volcanoes': 0})
+        volcanoes.post_set.add(self.post)
+        self.post.tags.clear()
+        self.assertEqual(self.tag_counts(), {'geology': 0, 'volcanoes': 0})
+
+    def test_editing_with_empty_tags_removes_them(self):
+        set_post_tags(self.post, 'geology')
+        self.client.login(username='lisa', password='password')
+        self.client.post(f'/post/{self.post.pk}/edit/', {
+            'subject': self.subject.pk, 'title': 'Volcano', 'content': 'Boom', 'tags': '', 'action': 'save',
+        })
+        self.assertFalse(self.post.tags.exists())
+        self.assertEqual(Tag.objects.get(name='geology').post_count, 0)
+
+    def test_saving_a_stale_tag_keeps_its_count(self):
+        tag = Tag.objects.create(name='geology')
+        self.post.tags.add(tag)
+        tag.name = 'Geology'
+        tag.save()
+        tag.refresh_from_db()
+        self.assertEqual(tag.post_count, 1)
+
+class ListingQueryBudgetTest(TestCase):
+    """Listing and detail pages run a fixed number of queries however many posts, tags and comments they show."""
+
+    # Queries per page, counted with the user context, session and notification lookups included.
+    BUDGETS = {
+        'public_timeline': 7,
+        'posts_by_tag': 6,
+        'author_post_list': 10,
+        'post_detail': 10,
+        'presentation_detail': 5,
+        'portfolio_detail': 8,
+        'public_portfolio_detail': 7,
+    }
+
+    def setUp(self):
+        self.family = Family.objects.create(name='The Simpsons')
+        self.teacher = create_member('hoover', self.family, 'Teachers')
+        self.student = create_member('bart', self.family, 'Students')
+        self.subjects = [Subject.objects.create(name=name) for name in ('Science', 'History', 'Art')]
+        self.post = self.add_post(0)
+        self.presentation = Presentation.objects.create(author=self.student, title='Science fair')
+        self.portfolio = Portfolio.objects.create(author=self.student, title='Best work', is_public=True)
+        self.extend(self.post)
+        self.client.login(username='hoover', password='password')
+
+    def add_post(self, i):
+        post = Post.objects.create(
+            author=self.student, subject=self.subjects[i % 3], title=f'Post {i}', content='Boom', status='published',
+        )
+        set_post_tags(post, f'common, tag{i}, other{i}')
+        return post
+
+    def extend(self, post):
+        Comment.objects.create(post=self.post, author=self.teacher, text=f'Comment on {post.title}')
+        Comment.objects.create(post=self.post, author=self.student, text=f'Reply on {post.title}')
+        PresentationPost.objects.create(presentation=self.presentation, post=post, order=post.pk)
+        self.portfolio.posts.add(post)
+
+    def urls(self):
+        return {
+            'public_timeline': '/public-timeline/',
+            'posts_by_tag': '/tag/common/',
+            'author_post_list': '/author/bart/',
+            'post_detail': f'/post/{self.post.pk}/',
+            'presentation_detail': f'/presentation/{self.presentation.pk}/',
+            'portfolio_detail': f'/portfolio/{self.portfolio.pk}/',
+            'public_portfolio_detail': f'/portfolio/public/{self.portfolio.pk}/',
+        }
+
+    def count_queries(self):
+        counts = {}
+        for name, url in self.urls().items():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            counts[name] = len(queries)
+        return counts
+
+    def test_query_counts_are_fixed(self):
+        small = self.count_queries()
+        for i in range(1, 9):
+            self.extend(self.add_post(i))
+        large = self.count_queries()
+        self.assertEqual(small, large)
+        for name, count in large.items():
+            with self.subTest(view=name):
+                self.assertLessEqual(count, self.BUDGETS[name])
+
+class ViewBudgetTest(TestCase):
+    """
+    Every page in blog/urls.py, as an anonymous user, a student and a teacher,
+    against a seeded family. A page fails when it runs more queries than its
+    budget, or takes TIMING_SLACK times longer than its time budget. Timings
+    depend on the machine, so VIEW_BUDGET_TIMINGS=1 is needed to hold pages
+    to the time budgets themselves.
+
+    The family has VIEW_BUDGET_SCALE x 300 students with 40 posts and a comment
+    on each (1 by default, so 12,000 posts). Set VIEW_BUDGET_REPORT to a file
+    path to write the measurements out as TSV.
+    """
+
+    # A page this many times over its time budget is slow on any machine.
+    TIMING_SLACK = 4
+
+    # url name: (queries, milliseconds). Query budgets must hold at any scale.
+    BUDGETS = {
+        'password_change': (4, 250),
+        'timeline_redirect': (3, 250),
+        'posts_by_tag': (7, 250),
+        'public_timeline': (8, 250),
+        'mark_notifications_as_read': (2, 250),
+        'post_list_archive': (8, 250),
+        'signup': (4, 250),
+        'family_create': (3, 250),
+        'family_management': (5, 250),
+        'join_or_create_family': (3, 250),
+        'join_family': (3, 250),
+        'post_create': (6, 250),
+        'post_detail': (12, 250),
+        'post_edit': (10, 250),
+        'request_peer_review': (7, 500),
+        'assess_post': (8, 250),
+        'author_post_list_by_year': (11, 500),
+        'author_post_list': (11, 500),
+        'teacher_dashboard': (8, 1000),
+        'teacher_dashboard_filtered': (9, 1000),
+        'announcement_create': (3, 250),
+        'announcement_list': (4, 250),
+        'post_delete': (6, 250),
+        'presentation_create': (8, 250),
+        'presentation_detail': (6, 250),
+        'presentation_edit': (12, 250),
+        'presentation_delete': (6, 250),
+        'edit_profile': (4, 250),
+        'portfolio_list': (5, 250),
+        'portfolio_create': (6, 250),
+        'portfolio_detail': (10, 250),
+        'portfolio_edit': (11, 250),
+        'portfolio_delete': (7, 250),
+        'public_portfolio_detail': (8, 250),
+        'rubric_list': (4, 250),
+        'rubric_create': (3, 250),
+        'rubric_detail': (8, 250),
+        'rubric_detail_post': (8, 250),
+        'rubric_edit': (6, 250),
+        'rubric_delete': (4, 250),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        scale = float(os.environ.get('VIEW_BUDGET_SCALE', '1'))
+        family, cls.teacher, students = seed_family(
+            'Budget Family', students=max(int(300 * scale), 2), posts_per_student=40, tag_count=200,
+        )
+        rebuild_derived_data()
+        cls.student = students[0]
+        cls.rubric = Rubric.objects.create(name='Lab report', author=cls.teacher)
+        Criterion.objects.create(rubric=cls.rubric, name='Method', order=1)
+        Level.objects.create(rubric=cls.rubric, name='Secure', points=3, order=1)
+        cls.post = Post.objects.filter(author=cls.student, status='published').first()
+        cls.post.rubric = cls.rubric
+        cls.post.save()
+        cls.presentation = Presentation.objects.create(author=cls.student, title='Science fair')
+        for order, post in enumerate(Post.objects.filter(author=cls.student)[:10]):
+            PresentationPost.objects.create(presentation=cls.presentation, post=post, order=order)
+        cls.portfolio = Portfolio.objects.create(author=cls.student, title='Best work', is_public=True)
+        cls.portfolio.posts.set(Post.objects.filter(author=cls.student)[:10])
+
+    def url_kwargs(self, name):
+        pk = {
+            'presentation': self.presentation.pk,
+            'portfolio': self.portfolio.pk,
+            'rubric': self.rubric.pk,
+        }.get(name.split('_')[0], self.post.pk)
+        return {
+            'posts_by_tag': {'tag_name': self.post.tags.first().name},
+            'post_list_archive': {'year': self.post.created_date.year},
+            'author_post_list': {'username': self.student.username},
+            'author_post_list_by_year': {'username': self.student.username, 'year': self.post.created_date.year},
+            'teacher_dashboard_filtered': {'username': self.student.username},
+            'public_portfolio_detail': {'pk': self.portfolio.pk},
+            'rubric_detail_post': {'pk': self.rubric.pk, 'post_pk': self.post.pk},
+        }.get(name, {'pk': pk})
+
+    def url_for(self, pattern):
+        kwargs = self.url_kwargs(pattern.name) if pattern.pattern.converters else {}
+        return reverse(pattern.name, kwargs=kwargs)
+
+    def measure(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = self.client.get(url)
+            elapsed = (time.perf_counter() - started) * 1000
+        self.assertLess(response.status_code, 500, url)
+        return len(queries), elapsed, len(response.content)
+
+    def test_every_view_is_within_budget(self):
+        roles = {'anonymous': None, 'student': self.student, 'teacher': self.teacher}
+        patterns = {pattern.name: pattern for pattern in blog_urls.urlpatterns}
+        self.assertEqual(set(patterns), set(self.BUDGETS), 'Every URL needs a declared budget.')
+
+        measurements = []
+        for role, user in roles.items():
+            self.client.logout()
+            if user:
+                self.client.force_login(user)
+            for name, pattern in patterns.items():
+                url = self.url_for(pattern)
+                queries, elapsed, size = self.measure(url)
+                measurements.append((name, role, url, queries, elapsed, size))
+
+        report_path = os.environ.get('VIEW_BUDGET_REPORT')
+        if report_path:
+            with open(report_path, 'w') as report:
+                report.write('view\trole\turl\tqueries\tms\tbytes\n')
+                for name, role, url, queries, elapsed, size in measurements:
+                    report.write(f'{name}\t{role}\t{url}\t{queries}\t{elapsed:.1f}\t{size}\n')
+
+        slack = 1 if os.environ.get('VIEW_BUDGET_TIMINGS') == '1' else self.TIMING_SLACK
+        over_budget = [
+            f'{name} as {role}: {queries} queries (budget {self.BUDGETS[name][0]}), '
+            f'{elapsed:.0f} ms (budget {self.BUDGETS[name][1] * slack})'
+            for name, role, url, queries, elapsed, size in measurements
+            if queries > self.BUDGETS[name][0] or elapsed > self.BUDGETS[name][1] * slack
+        ]
+        self.assertEqual(over_budget, [])
+
+class SeedScaleTest(TestCase):
+
+    def seed(self, prefix):
+        call_command(
+            'seed_scale', families=2, students=3, posts=4, tags=5, comments=1, notifications=2,
+            presentations=1, assessments=2, prefix=prefix, end_date=date(2025, 6, 1), stdout=StringIO(),
+        )
+        return list(
+            Post.objects.filter(author__username__startswith=prefix)
+            .order_by('id').values_list('title', 'subject__name', 'created_date', 'status')
+        )
+
+    def test_seeds_every_kind_of_row(self):
+        self.seed('scale')
+        family = Family.objects.get(name='scale 0 family 0')
+        students = User.objects.filter(profile__family=family, groups__name='Students')
+        self.assertEqual(students.count(), 3)
+        self.assertEqual(Post.objects.filter(author__profile__family=family).count(), 12)
+        self.assertEqual(Presentation.objects.filter(author__in=students).count(), 3)
+        self.assertEqual(Assessment.objects.filter(post__author__in=students).count(), 6)
+        self.assertEqual(Evaluation.objects.filter(assessment__post__author__in=students).count(), 18)
+        self.assertEqual(DailyActivity.objects.filter(family=family).aggregate(total=Sum('count'))['total'], 12)
+        self.assertTrue(Tag.objects.filter(post_count__gt=0).exists())
+        self.assertTrue(self.client.login(username='scale-0-family-0-student-0', password='password'))
+
+    def test_same_seed_gives_same_rows(self):
+        with transaction.atomic():
+            first = self.seed('alpha')
+            transaction.set_rollback(True)
+        self.assertFalse(Post.objects.exists())
+        self.assertEqual(self.seed('alpha'), first)
+
+    def test_refuses_to_seed_twice(self):
+        self.seed('scale')
+        with self.assertRaises(CommandError):
+            self.seed('scale')
+
+# Request profiling
+
+@override_settings(REQUEST_PROFILING_SAMPLE_RATE=1.0, REQUEST_PROFILING_REPEAT_THRESHOLD=3)
+class RequestProfilingTest(TestCase):
+
+    def setUp(self):
+        self.subjects = [Subject.objects.create(name=name) for name in ('Science', 'History', 'Math')]
+        self.request = RequestFactory().get('/subjects/')
+
+    def view(self, request):
+        # One query per subject: the loop the profiler should flag.
+        names = [Subject.objects.get(pk=subject.pk).name for subject in self.subjects]
+        return HttpResponse(engines['django'].from_string('{{ names|join:", " }}').render({'names': names}))
+
+    def test_server_timing_and_log_line(self):
+        middleware = RequestProfilingMiddleware(self.view)
+        with self.assertLogs('blog.profiling', 'INFO') as logs:
+            response = middleware(self.request)
+
+        self.assertEqual(response.content, b'Science, History, Math')
+        timing = response['Server-Timing']
+        for metric in ('db;dur=', 'desc="3 queries"', 'tpl;dur=', 'view;dur=', 'total;dur=', 'dup;desc="2 repeated queries"'):
+            self.assertIn(metric, timing)
+
+        self.assertEqual(logs.records[0].levelname, 'WARNING')
+        record = json.loads(logs.records[0].getMessage().split(' ', 2)[2])
+        self.assertEqual(record['path'], '/subjects/')
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['queries'], 3)
+        self.assertEqual(record['response_bytes'], len(response.content))
+        self.assertEqual(list(record['repeated_queries'].values()), [3])
+
+    def test_distinct_queries_log_at_info(self):
+        middleware = RequestProfilingMiddleware(lambda request: HttpResponse(str(Subject.objects.count())))
+        with self.assertLogs('blog.profiling', 'INFO') as logs:
+            response = middleware(self.request)
+        self.assertEqual(logs.records[0].levelname, 'INFO')
+        self.assertNotIn('dup;', response['Server-Timing'])
+
+    def test_queries_on_connections_opened_mid_request_are_timed(self):
+        def view(request):
+            # Like a family shard first used halfway through a request.
+            opened = connections.create_connection(DEFAULT_DB_ALIAS)
+            with opened.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            opened.close()
+            return HttpResponse()
+
+        with self.assertLogs('blog.profiling', 'INFO'):
+            response = RequestProfilingMiddleware(view)(self.request)
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+    def test_unsampled_requests_are_untouched(self):
+        with override_settings(REQUEST_PROFILING_SAMPLE_RATE=0.5), patch('blog.middleware.random.random', return_value=0.9):
+            response = RequestProfilingMiddleware(self.view)(self.request)
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(REQUEST_PROFILING_SAMPLE_RATE=0)
+    def test_disabled_by_default(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            RequestProfilingMiddleware(self.view)
+
+# Slow-query log
+
+# Low enough that every query counts as slow.
+@override_settings(SLOW_QUERY_THRESHOLD_MS=0.000001)
+class SlowQueryLogTest(TestCase):
+
+    def setUp(self):
+        self.student = create_member('bart', group='Students')
+        self.subject = Subject.objects.create(name='Science')
+        create_post(self.student, self.subject)
+
+    def logged(self, logs):
+        return [json.loads(record.getMessage()) for record in logs.records]
+
+    def test_records_sql_params_and_plan(self):
+        with self.assertLogs('blog.slow_queries', 'WARNING') as logs, connection.execute_wrapper(log_slow_queries):
+            list(Post.objects.filter(title__icontains='volc'))
+        record = self.logged(logs)[0]
+        self.assertIn('FROM "blog_post"', record['sql'])
+        self.assertEqual(record['params'], ["'%volc%'"])
+        self.assertIsNone(record['view'])
+        self.assertTrue(any('SCAN blog_post' in step for step in record['plan']))
+
+    def test_records_originating_view(self):
+        with self.assertLogs('blog.slow_queries', 'WARNING') as logs, connection.execute_wrapper(log_slow_queries):
+            self.client.get('/public-timeline/')
+        views = {(record['view'], record['path']) for record in self.logged(logs)}
+        self.assertIn(('public_timeline', '/public-timeline/'), views)
+
+    def test_normalise_sql(self):
+        self.assertEqual(
+            normalise_sql('SELECT * FROM "blog_post" WHERE id IN (%s, %s, %s)\n LIMIT 21'),
+            normalise_sql('SELECT * FROM "blog_post" WHERE id IN (%s) LIMIT 50'),
+        )
+
+    def test_report_reads_rotated_logs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = Path(directory) / 'slow.log'
+            rows = [
+                (log.with_name('slow.log.1'), 'SELECT 1 FROM "blog_tag" WHERE id IN (%s, %s)', 'tag_posts', 40.0),
+                (log, 'SELECT 1 FROM "blog_tag" WHERE id IN (%s)', 'public_timeline', 60.0),
+                (log, 'SELECT 1 FROM "blog_post" LIMIT 20', 'post_list', 5.0),
+            ]
+            for path, sql, view, duration in rows:
+                with path.open('a') as f:
+                    f.write(json.dumps({
+                        'time': '2026-01-01T00:00:00+00:00', 'duration_ms': duration, 'sql': sql,
+                        'params': ['1'], 'many': False, 'view': view, 'path': '/', 'plan': ['SCAN blog_tag'],
+                    }) + '\n')
+            self.assertEqual([record['view'] for record in read_log(log)], ['tag_posts', 'public_timeline', 'post_list'])
+
+            out = StringIO()
+            call_command('slow_queries', log=str(log), limit=1, stdout=out)
+        output = out.getvalue()
+        self.assertIn('#1: 2 queries, 100ms total', output)
+        self.assertIn('Views: tag_posts (1), public_timeline (1)', output)
+        self.assertIn('Plan:  SCAN blog_tag', output)
+        self.assertIn('1 more shapes', output)
+
+# Sampled cProfile capture
+
+class PythonProfilingTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.settings_override = override_settings(PYTHON_PROFILE_DIR=self.directory, PYTHON_PROFILE_MAX_FILES=3)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def saved(self):
+        return {view: len(paths) for view, paths in profiles_by_view().items()}
+
+    @override_settings(PYTHON_PROFILE_SAMPLE_RATE=1.0)
+    def test_sampled_requests_are_saved_per_view(self):
+        self.client.get('/public-timeline/')
+        self.client.get('/no-such-page/')
+        self.assertEqual(self.saved(), {'public_timeline': 1, 'unresolved': 1})
+
+    @override_settings(PYTHON_PROFILE_SAMPLE_RATE=1.0)
+    def test_directory_is_bounded(self):
+        for _ in range(5):
+            self.client.get('/public-timeline/')
+        self.assertEqual(self.saved(), {'public_timeline': 3})
+
+    @override_settings(PYTHON_PROFILE_HEADER=True)
+    def test_signed_header_triggers_profiling(self):
+        self.client.get('/public-timeline/', headers={'X-Profile-Request': 'profile:forged'})
+        self.assertEqual(self.saved(), {})
+        self.client.get('/public-timeline/', headers={'X-Profile-Request': sign_profile_header()})
+        self.assertEqual(self.saved(), {'public_timeline': 1})
+
+    @override_settings(PYTHON_PROFILE_SAMPLE_RATE=1.0)
+    def test_profile_report_merges_by_view(self):
+        self.client.get('/public-timeline/')
+        self.client.get('/public-timeline/')
+        out = StringIO()
+        call_command('profile_report', limit=5, stdout=out)
+        self.assertIn('public_timeline: 2 profiles', out.getvalue())
+        self.assertIn('function calls', out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('profile_report', view=['teacher_dashboard'], stdout=StringIO())
+
+# Metrics endpoint
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.staff = create_member('skinner', is_staff=True)
+        self.student = create_member('bart', group='Students')
+
+    def value(self, name, **labels):
+        return metrics.collect().get((name, tuple(sorted(labels.items()))), 0)
+
+    def scrape(self, **kwargs):
+        response = self.client.get('/metrics', **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_requests_are_counted_per_url_name(self):
+        before = self.value('blog_http_requests_total', method='GET', status='200', view='public_timeline')
+        self.client.get('/public-timeline/')
+        self.client.get('/public-timeline/')
+        self.assertEqual(self.value('blog_http_requests_total', method='GET', status='200', view='public_timeline'), before + 2)
+
+        self.client.login(username='skinner', password='password')
+        body = self.scrape()
+        self.assertIn('# TYPE blog_http_request_duration_seconds histogram', body)
+        self.assertIn('blog_http_requests_total{method="GET",status="200",view="public_timeline"}', body)
+        self.assertIn('blog_http_request_duration_seconds_bucket{view="public_timeline",le="+Inf"}', body)
+        self.assertIn('blog_http_request_queries_count{view="public_timeline"}', body)
+
+    def test_queries_on_connections_opened_mid_request_are_counted(self):
+        # Like a family shard first used halfway through a request.
+        with metrics.counting_queries() as queries:
+            opened = connections.create_connection(DEFAULT_DB_ALIAS)
+            with opened.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            opened.close()
+        self.assertEqual(queries[0], 1)
+
+    def test_endpoint_requires_staff_or_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.login(username='bart', password='password')
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.logout()
+        with override_settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 403)
+            self.scrape(headers={'Authorization': 'Bearer s3cret'})
+
+    def test_business_counters(self):
+        posts = self.value('blog_posts_created_total')
+        fanned_out = self.value('blog_notifications_fanned_out_total')
+        uploaded = self.value('blog_upload_bytes_total', view='post_create')
+
+        Post.objects.create(author=self.student, subject=Subject.objects.create(name='Art'), title='Sketch', content='Pencil')
+        fan_out_notifications([self.student.pk, self.staff.pk], 'Hello', 'test:1')
+        self.client.post('/post/new/', {'photo': SimpleUploadedFile('photo.jpg', b'x' * 1234)})
+
+        self.assertEqual(self.value('blog_posts_created_total'), posts + 1)
+        self.assertEqual(self.value('blog_notifications_fanned_out_total'), fanned_out + 2)
+        self.assertEqual(self.value('blog_upload_bytes_total', view='post_create'), uploaded + 1234)
+
+    def test_values_are_summed_across_processes(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            before = self.value('blog_http_requests_total', method='GET', status='200', view='post_list')
+            histogram = [0] * (len(metrics.LATENCY_BUCKETS) + 1) + [0.0]
+            histogram[0], histogram[-1] = 3, 0.009
+            Path(directory, 'other-worker.json').write_text(json.dumps([
+                ['blog_http_requests_total', {'method': 'GET', 'status': '200', 'view': 'post_list'}, 5],
+                ['blog_http_request_duration_seconds', {'view': 'post_list'}, histogram],
+            ]))
+            self.assertEqual(self.value('blog_http_requests_total', method='GET', status='200', view='post_list'), before + 5)
+
+            metrics.registry.dirty = True
+            metrics.flush()
+            self.assertTrue(Path(directory, f'{metrics.registry.process_id}.json').exists())
+
+            body = metrics.render(metrics.collect())
+            self.assertIn('blog_http_request_duration_seconds_bucket{view="post_list",le="0.005"} 3', body)
+            self.assertIn('blog_http_request_duration_seconds_count{view="post_list"} 3', body)
+
+    def test_files_of_exited_processes_are_pruned(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            snapshot = json.dumps([['blog_posts_created_total', {}, 7]])
+            exited, idle = Path(directory, '999999999-dead.json'), Path(directory, f'{os.getpid()}-idle.json')
+            for path in (exited, idle):
+                path.write_text(snapshot)
+                os.utime(path, (0, 0))
+            metrics.collect()
+            self.assertFalse(exited.exists())
+            self.assertTrue(idle.exists())
+
+# Denormalised family on content
+
+class FamilyScopedContentTest(TestCase):
+
+    def setUp(self):
+        self.simpsons = Family.objects.create(name='The Simpsons')
+        self.flanders = Family.objects.create(name='The Flanders')
+        self.teacher = create_member('hoover', self.simpsons, 'Teachers')
+        self.student = create_member('bart', self.simpsons, 'Students')
+        self.neighbour = create_member('rod', self.flanders)
+        self.subject = Subject.objects.create(name='Science')
+
+    def create_content(self, user):
+        return [
+            Post.objects.create(author=user, subject=self.subject, title='Volcano', content='Boom', status='published'),
+            Presentation.objects.create(author=user, title='Science fair'),
+            Announcement.objects.create(author=user, title='Field trip', content='Bring lunch'),
+            Notification.objects.create(recipient=user, message='Hello'),
+        ]
+
+    def test_family_is_copied_from_the_owner_on_create(self):
+        for obj in self.create_content(self.student):
+            self.assertEqual(obj.family_id, self.simpsons.pk, type(obj).__name__)
+        self.assertEqual(list(Post.objects.for_family(self.flanders)), [])
+
+    def test_changing_family_moves_the_owners_content(self):
+        content = self.create_content(self.student)
+        self.student.profile.family = self.flanders
+        self.student.profile.save()
+        for obj in content:
+            obj.refresh_from_db()
+            self.assertEqual(obj.family_id, self.flanders.pk, type(obj).__name__)
+
+    def test_other_profile_edits_leave_content_alone(self):
+        self.create_content(self.student)
+        self.student.profile.theme = 'vibrant'
+        with CaptureQueriesContext(connection) as queries:
+            self.student.profile.save()
+        self.assertEqual([query['sql'].split()[0] for query in queries], ['SELECT', 'UPDATE'])
+
+    def test_users_without_a_family_see_nothing(self):
+        loner = create_member('hermit')
+        Post.objects.create(author=loner, subject=self.subject, title='Alone', content='...', status='published')
+        self.assertEqual(Post.objects.filter(family=None).count(), 1)
+        self.assertEqual(list(Post.objects.for_family(None)), [])
+
+    def test_fan_out_looks_up_each_recipients_family(self):
+        fan_out_notifications([self.student.pk, self.neighbour.pk], 'Hello', 'test:families')
+        families = dict(Notification.objects.filter(batch_key='test:families').values_list('recipient_id', 'family_id'))
+        self.assertEqual(families, {self.student.pk: self.simpsons.pk, self.neighbour.pk: self.flanders.pk})
+
+    def test_presentations_of_other_families_are_not_found(self):
+        presentation = Presentation.objects.create(author=self.neighbour, title='Bible stories')
+        self.client.login(username='bart', password='password')
+        self.assertEqual(self.client.get(f'/presentation/{presentation.pk}/').status_code, 404)
+
+    def test_backfill_migration(self):
+        content = self.create_content(self.student)
+        for obj in content:
+            type(obj).objects.update(family=None)
+        migration = import_module('blog.migrations.0043_family_scoped_content')
+        migration.backfill_families(apps, None)
+        for obj in content:
+            obj.refresh_from_db()
+            self.assertEqual(obj.family_id, self.simpsons.pk, type(obj).__name__)
+
+# Per-family database shards
+
+class FamilyShardingTest(TransactionTestCase):
+    # The Teachers/Students groups come from a data migration, which flushing would lose.
+    serialized_rollback = True
+
+    @classmethod
+    def ensure_connection_patch_method(cls):
+        guarded = super().ensure_connection_patch_method()
+        unguarded = BaseDatabaseWrapper.ensure_connection
+
+        # Shard aliases are registered as the tests run, so they can't be listed in `databases`.
+        def ensure_connection(connection, *args, **kwargs):
+            if is_shard_alias(connection.alias):
+                return unguarded(connection, *args, **kwargs)
+            return guarded(connection, *args, **kwargs)
+
+        return ensure_connection
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.settings_override = override_settings(DATABASE_SHARDING=True, DATABASE_SHARD_DIR=directory)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.addCleanup(self.drop_shard_aliases)
+
+        self.simpsons = Family.objects.create(name='The Simpsons')
+        self.flanders = Family.objects.create(name='The Flanders')
+        self.student = create_member('bart', self.simpsons, 'Students')
+        self.neighbour = create_member('rod', self.flanders, 'Students')
+        self.subject = Subject.objects.create(name='Science')
+
+    def drop_shard_aliases(self):
+        for alias in [alias for alias in connections.settings if is_shard_alias(alias)]:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+
+    def create_post(self, author, title='Volcano'):
+        post = Post.objects.create(author=author, subject=self.subject, title=title, content='Boom', status='published')
+        set_post_tags(post, 'lava')
+        return post
+
+    def test_family_writes_go_to_its_shard(self):
+        call_command('migrate_shards', stdout=StringIO())
+        self.assertEqual(shard_family_ids(), [self.simpsons.pk, self.flanders.pk])
+
+        with use_family_shard(self.simpsons.pk):
+            post = self.create_post(self.student)
+            self.assertEqual(post._state.db, f'family_{self.simpsons.pk}')
+            self.assertGreater(post.pk, self.simpsons.pk * ID_SPACE)
+            self.assertEqual(search_posts(Post.objects.all(), 'volcano').get(), post)
+            # Shared tables are reachable from the shard's connection.
+            self.assertEqual(Post.objects.select_related('author').get().author.username, 'bart')
+        self.assertFalse(Post.objects.exists())
+        with use_family_shard(self.flanders.pk):
+            self.assertFalse(Post.objects.exists())
+
+    def test_requests_use_the_users_family_shard(self):
+        call_command('migrate_shards', stdout=StringIO())
+        with use_family_shard(self.simpsons.pk):
+            post = self.create_post(self.student)
+
+        self.client.login(username='bart', password='password')
+        response = self.client.post(f'/post/{post.pk}/', {'text': 'Cool!', 'comment_submit': ''})
+        self.assertEqual(response.status_code, 302)
+        with use_family_shard(self.simpsons.pk):
+            self.assertEqual(Comment.objects.get().text, 'Cool!')
+
+        self.client.login(username='rod', password='password')
+        self.assertEqual(self.client.get(f'/post/{post.pk}/').status_code, 404)
+
+    def test_shared_tables_stay_in_the_central_database(self):
+        call_command('migrate_shards', stdout=StringIO())
+        with use_family_shard(self.simpsons.pk):
+            self.assertEqual(Subject.objects.get()._state.db, 'default')
+            Notification.objects.create(recipient=self.student, message='Hello')
+
+        self.client.login(username='bart', password='password')
+        response = self.client.get('/public-timeline/')
+        self.assertEqual(response.wsgi_request.user_context.unread_notification_count, 1)
+
+    def test_move_data_takes_a_familys_rows_out_of_the_central_database(self):
+        post = self.create_post(self.student)
+        Comment.objects.create(post=post, author=self.neighbour, text='Nice')
+        self.create_post(self.neighbour, title='Flood')
+
+        out = StringIO()
+        call_command('migrate_shards', families=[self.simpsons.pk], move_data=True, stdout=out)
+        self.assertIn(f'Created shard family_{self.simpsons.pk}.', out.getvalue())
+
+        self.assertEqual(list(Post.objects.values_list('title', flat=True)), ['Flood'])
+        self.assertFalse(Comment.objects.exists())
+        self.assertEqual(search_posts(Post.objects.all(), 'volcano').count(), 0)
+        with use_family_shard(self.simpsons.pk):
+            moved = Post.objects.get()
+            self.assertEqual(moved.pk, post.pk)
+            self.assertEqual(moved.comments.get().text, 'Nice')
+            self.assertEqual(list(moved.tags.values_list('name', 'post_count')), [('lava', 1)])
+            self.assertEqual(search_posts(Post.objects.all(), 'volcano').get(), moved)
+
+    def test_joining_a_family_moves_earlier_posts_into_its_shard(self):
+        call_command('migrate_shards', stdout=StringIO())
+        newcomer = create_member('lisa')
+        post = self.create_post(newcomer, title='Saxophone')
+        self.assertEqual(post._state.db, 'default')
+
+        self.simpsons.invite_code = 'ABC-123'
+        self.simpsons.save()
+        self.client.login(username='lisa', password='password')
+        self.client.post('/family/join/', {'invite_code': 'ABC-123'})
+
+        self.assertFalse(Post.objects.exists())
+        with use_family_shard(self.simpsons.pk):
+            moved = Post.objects.get()
+            self.assertEqual((moved.pk, moved.family_id), (post.pk, self.simpsons.pk))
+            self.assertEqual(search_posts(Post.objects.all(), 'saxophone').get(), moved)
+
+    def test_members_cannot_change_family(self):
+        self.student.profile.family = self.flanders
+        with self.assertRaises(FamilyChangeBetweenShards):
+            self.student.profile.save()
+        self.student.profile.family = None
+        with self.assertRaises(FamilyChangeBetweenShards):
+            self.student.profile.save()
+
+    @override_settings(DATABASE_READ_ONLY_STRICT=True)
+    def test_shard_connections_are_guarded_and_take_write_locks_up_front(self):
+        central = connections['default'].settings_dict
+        with patch.dict(central, {'OPTIONS': {**central.get('OPTIONS', {}), 'transaction_mode': 'IMMEDIATE'}}):
+            call_command('migrate_shards', stdout=StringIO())
+        alias = f'family_{self.simpsons.pk}'
+        self.assertEqual(connections[alias].settings_dict['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+
+        with use_family_shard(self.simpsons.pk), read_only():
+            with self.assertRaises(WriteDuringReadOnlyRequest):
+                Tag.objects.create(name='Lava')
+
+    def test_published_posts_are_readable_across_shards(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_override = override_settings(MEDIA_ROOT=media_root)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+
+        post = self.create_post(self.student)
+        post.photo = make_jpeg(400, 300)
+        post.save()
+        self.create_post(self.neighbour, title='Flood')
+        call_command('migrate_shards', move_data=True, stdout=StringIO())
+        self.assertFalse(Post.objects.exists())
+
+        # Anonymous visitors have no shard of their own.
+        response = self.client.get('/public-timeline/')
+        self.assertEqual([p.title for p in response.context['page_obj']], ['Flood', 'Volcano'])
+        self.assertEqual([tag.name for tag in response.context['tag_cloud']], ['lava'])
+        response = self.client.get('/tag/lava/')
+        self.assertEqual(len(response.context['page_obj']), 2)
+        self.assertEqual(self.client.get(f'/post/{post.pk}/').status_code, 200)
+        self.assertEqual(self.client.get(f'/media/{post.photo.name}').status_code, 200)
+        with use_family_shard(self.simpsons.pk):
+            self.assertEqual(PendingPostView.objects.get().post_id, post.pk)
+
+        # Signed-in users see every family's published posts on the public timeline, too.
+        self.client.login(username='rod', password='password')
+        response = self.client.get('/public-timeline/')
+        self.assertEqual(len(response.context['page_obj']), 2)
+
+    def test_public_portfolios_are_readable_across_shards(self):
+        post = self.create_post(self.student)
+        portfolio = Portfolio.objects.create(author=self.student, title='Best work', is_public=True)
+        portfolio.posts.add(post)
+        call_command('migrate_shards', move_data=True, stdout=StringIO())
+        self.assertFalse(Portfolio.objects.exists())
+
+        response = self.client.get(f'/portfolio/public/{portfolio.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p.title for p in response.context['posts']], ['Volcano'])
+
+        # Another family's member reads the portfolio's posts from its shard, not their own.
+        self.client.login(username='rod', password='password')
+        response = self.client.get(f'/portfolio/public/{portfolio.pk}/')
+        self.assertEqual([p.title for p in response.context['posts']], ['Volcano'])
+
+    @override_settings(DATABASE_SHARDING=False)
+    def test_migrate_shards_needs_sharding_on(self):
+        with self.assertRaises(CommandError):
+            call_command('migrate_shards', stdout=StringIO())
+
+# Shared cache and per-family generations
+
+class SharedCacheTest(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.location = os.path.join(directory, 'cache.sqlite3')
+        self.settings_override = override_settings(CACHES={'default': {
+            'BACKEND': 'blog.sqlite_cache.SQLiteCache',
+            'LOCATION': self.location,
+            'OPTIONS': {'MAX_ENTRIES': 5, 'CULL_FREQUENCY': 2},
+        }})
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+        self.simpsons = Family.objects.create(name='The Simpsons')
+        self.flanders = Family.objects.create(name='The Flanders')
+        self.teacher = create_member('hoover', self.simpsons, 'Teachers')
+        self.student = create_member('bart', self.simpsons, 'Students')
+        self.subject = Subject.objects.create(name='Science')
+
+    def test_backend(self):
+        cache.set('pickled', {'a': [1, 2]})
+        self.assertEqual(cache.get('pickled'), {'a': [1, 2]})
+        self.assertFalse(cache.add('pickled', 'other'))
+        self.assertTrue(cache.add('counter', 41))
+        self.assertEqual(cache.incr('counter'), 42)
+        with self.assertRaises(ValueError):
+            cache.incr('missing')
+        self.assertEqual(cache.get_many(['pickled', 'counter', 'missing']), {'pickled': {'a': [1, 2]}, 'counter': 42})
+        cache.set('expired', 'gone', timeout=-1)
+        self.assertIsNone(cache.get('expired'))
+        self.assertTrue(cache.add('expired', 'back'))
+        self.assertTrue(cache.delete('expired'))
+        self.assertFalse(cache.has_key('expired'))
+
+    def test_every_process_shares_the_file(self):
+        cache.set('greeting', 'hello')
+        # A second backend on the same file stands in for another Gunicorn worker.
+        other = SQLiteCache(self.location, {})
+        self.assertEqual(other.get('greeting'), 'hello')
+        other.delete('greeting')
+        self.assertIsNone(cache.get('greeting'))
+
+    def test_generations_change_with_family_content(self):
+        simpsons, flanders = cache_version(self.simpsons.pk), cache_version(self.flanders.pk)
+        self.assertEqual(cache_version(self.simpsons.pk), simpsons)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(author=self.student, subject=self.subject, title='Volcano', content='Boom')
+            # Until the write commits, other processes still read the old rows.
+            self.assertEqual(cache_version(self.simpsons.pk), simpsons)
+        self.assertNotEqual(cache_version(self.simpsons.pk), simpsons)
+        self.assertEqual(cache_version(self.flanders.pk), flanders)
+
+        for change in (
+            lambda: Presentation.objects.create(author=self.student, title='Science fair'),
+            lambda: Portfolio.objects.create(author=self.student, title='Best work'),
+            lambda: post.delete(),
+        ):
+            before = cache_version(self.simpsons.pk)
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+            self.assertNotEqual(cache_version(self.simpsons.pk), before)
+
+        # Tagging a post only moves its own family on; a tag itself is shared, so it moves every family.
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(author=self.student, subject=self.subject, title='Magma', content='Hot')
+            tag = Tag.objects.create(name='Lava')
+        simpsons, flanders = cache_version(self.simpsons.pk), cache_version(self.flanders.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            post.tags.add(tag)
+        self.assertNotEqual(cache_version(self.simpsons.pk), simpsons)
+        self.assertEqual(cache_version(self.flanders.pk), flanders)
+        simpsons = cache_version(self.simpsons.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            tag.post_set.remove(post)
+        self.assertNotEqual(cache_version(self.simpsons.pk), simpsons)
+        self.assertEqual(cache_version(self.flanders.pk), flanders)
+        tag.name = 'Magma'
+        with self.captureOnCommitCallbacks(execute=True):
+            tag.save()
+        self.assertNotEqual(cache_version(self.flanders.pk), flanders)
+
+    def test_generation_survives_eviction(self):
+        version = cache_version(self.simpsons.pk)
+        cache.clear()
+        self.assertNotEqual(cache_version(self.simpsons.pk), version)
+        # Bumping a counter that was never read is a no-op rather than an error.
+        bump_generation(self.flanders.pk)
+
+    def test_cached_recomputes_after_a_bump(self):
+        calls = []
+        compute = lambda: calls.append(1) or len(calls)
+        self.assertEqual(cached('totals', self.simpsons.pk, compute, 'x'), 1)
+        self.assertEqual(cached('totals', self.simpsons.pk, compute, 'x'), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_generation(self.simpsons.pk)
+        self.assertEqual(cached('totals', self.simpsons.pk, compute, 'x'), 2)
+
+    def test_culling_bounds_the_table(self):
+        for i in range(100):
+            cache.set(f'key-{i}', i)
+        self.assertLessEqual(len(cache.get_many([f'key-{i}' for i in range(100)])), 50)
+
+    def test_dashboard_totals_are_cached_until_a_post_changes(self):
+        Post.objects.create(author=self.student, subject=self.subject, title='Volcano', content='Boom')
+        self.client.login(username='hoover', password='password')
+        self.assertEqual(self.client.get('/teacher/dashboard/').context['total_posts'], 1)
+        with CaptureQueriesContext(connection) as cached_queries:
+            self.assertEqual(self.client.get('/teacher/dashboard/').context['total_posts'], 1)
+        self.assertFalse(any('blog_dailyactivity' in query['sql'] for query in cached_queries))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Post.objects.create(author=self.student, subject=self.subject, title='Flood', content='Splash')
+        self.assertEqual(self.client.get('/teacher/dashboard/').context['total_posts'], 2)
+
+    def test_author_timeline_fragments_are_invalidated(self):
+        self.client.login(username='bart', password='password')
+        self.assertContains(self.client.get('/author/bart/'), 'No presentations yet.')
+        with self.captureOnCommitCallbacks(execute=True):
+            Presentation.objects.create(author=self.student, title='Science fair')
+        self.assertContains(self.client.get('/author/bart/'), 'Science fair')
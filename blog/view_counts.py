@@ -0,0 +1,34 @@
+from django.db import router, transaction
+from django.db.models import Count, F, Max
+
+from .models import Post, PendingPostView
+from .routers import allow_writes
+
+
+def record_view(post):
+    # An INSERT into the buffer never reads the counter, so concurrent workers can't lose hits.
+    # Views are recorded from GET requests, so the write has to be allowed explicitly.
+    # Folding them into the counter is left to the worker's flush_buffered_views task.
+    with allow_writes():
+        # Through the post, so the row lands in whichever database the post was read from.
+        post.pending_views.create()
+
+
+def flush_view_counts():
+    """
+    Fold buffered views into Post.view_count with one F() update per post.
+
+    Returns the number of views flushed.
+    """
+    with transaction.atomic(using=router.db_for_write(PendingPostView)):
+        high_water = PendingPostView.objects.aggregate(high_water=Max('id'))['high_water']
+        if high_water is None:
+            return 0
+        pending = PendingPostView.objects.filter(id__lte=high_water)
+        totals = pending.values('post_id').annotate(views=Count('id')).order_by()
+        flushed = 0
+        for row in totals:
+            Post.objects.filter(pk=row['post_id']).update(view_count=F('view_count') + row['views'])
+            flushed += row['views']
+        pending.delete()
+    return flushed
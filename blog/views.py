@@ -1,39 +1,52 @@
-from django.core.paginator import Paginator
 from django.shortcuts import render, redirect, get_object_or_404
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.validators import get_available_image_extensions
+from django.http import Http404
+from django.utils._os import safe_join
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import login
-from django.contrib.auth.decorators import login_required, user_passes_test
+from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.contrib.auth.models import User, Group
-from .models import Post, Presentation, Subject, PeerReviewRequest, Comment, Profile, Notification, Tag, Announcement, Family, PresentationPost, Rubric, Assessment, Evaluation
+from .models import DailyActivity, Post, Presentation, Subject, PeerReviewRequest, Comment, Profile, Notification, Tag, Announcement, Family, PresentationPost, Rubric, Assessment, Evaluation
 from .forms import PostForm, PresentationForm, CommentForm, PeerReviewRequestForm, ProfileForm, PrivateFeedbackForm, PostReviewStatusForm, FamilyForm, JoinFamilyForm, RubricForm, CriterionFormSet, LevelFormSet, AssessmentForm, EvaluationFormSet
-from django.db.models import Q
+from .pagination import CursorPaginator
+from .search import search_posts
+from .sharding import across_families
+from .view_counts import record_view
+from .notifications import fan_out_notifications, notify_family_students, new_batch_key
+from .task_queue import enqueue
+from .media import media_response
+from .activity import daily_totals, subject_totals
+from .caching import cached
+from .tags import set_post_tags, tag_cloud
+from django.db.models import F, Q, Window
 from django.utils import timezone
-from django.db.models.functions import ExtractYear
+from django.db.models.functions import ExtractYear, RowNumber
 from datetime import date, timedelta
+from functools import wraps
+import os
 import secrets
 import string
 from django.contrib import messages
 
 def timeline_redirect(request):
     # If the user is a student, redirect them to their personal timeline.
-    if request.user.is_authenticated and request.user.groups.filter(name='Students').exists():
+    if request.user_context.is_student:
         return redirect('author_post_list', username=request.user.username)
 
     # Otherwise, show the public timeline for guests and teachers.
     return redirect('public_timeline')
 
-def public_timeline(request):
-    all_posts = Post.objects.filter(status='published')
+def public_timeline(request, year=None):
+    all_posts = Post.objects.for_listing().filter(status='published')
+    if year:
+        all_posts = all_posts.filter(created_date__year=year)
 
     search_query = request.GET.get('q')
     if search_query:
-        all_posts = all_posts.filter(Q(title__icontains=search_query) | Q(content__icontains=search_query))
-
-    sort_by = request.GET.get('sort')
-    if sort_by == 'oldest':
-        all_posts = all_posts.order_by('created_date')
-    else:
-        all_posts = all_posts.order_by('-created_date')
+        all_posts = search_posts(all_posts, search_query, ranked=False)
 
     subject_id = request.GET.get('subject')
     if subject_id:
@@ -41,13 +54,14 @@ def public_timeline(request):
 
     subjects = Subject.objects.all()
 
-    paginator = Paginator(all_posts, 6)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    sort_by = request.GET.get('sort')
+    paginator = CursorPaginator(all_posts, 6, descending=sort_by != 'oldest', across_shards=True)
+    page_obj = paginator.get_page(after=request.GET.get('after'), before=request.GET.get('before'))
     
     context = {
         'page_obj': page_obj,
         'subjects': subjects,
+        'tag_cloud': tag_cloud(),
     }
     return render(request, 'blog/post_list.html', context)
 
@@ -75,6 +89,7 @@ def post_create(request):
         if form.is_valid():
             post = form.save(commit=False)
             post.author = request.user
+            post.family_id = request.user_context.profile.family_id
             post.post_type = post_type
             
             # Handle action buttons
@@ -82,14 +97,7 @@ def post_create(request):
             post.status = 'published' if action == 'publish' else 'draft'
             post.save()
             
-            # Handle tags safely
-            tags_data = form.cleaned_data.get('tags', '')
-            if tags_data:
-                post.tags.clear()
-                tag_names = [t.strip() for t in str(tags_data).split(',') if t.strip()]
-                for tag_name in tag_names:
-                    tag, _ = Tag.objects.get_or_create(name=tag_name)
-                    post.tags.add(tag)
+            set_post_tags(post, form.cleaned_data.get('tags', ''))
             
             messages.success(request, f"Post {'published' if action == 'publish' else 'saved as draft'}!")
             return redirect('author_post_list', username=request.user.username)
@@ -101,21 +109,24 @@ def post_create(request):
     
     return render(request, 'blog/post_form.html', {'form': form, 'post_type': post_type})
 
+def get_author_profile(user):
+    # Users made before the profile signal have no profile; an unsaved one avoids writing during a GET.
+    return Profile.objects.filter(user=user).first() or Profile(user=user)
+
 def author_post_list(request, username, year=None):
     author = get_object_or_404(User, username=username)
 
-    # Defensively get or create profiles to prevent crashes for users made before profile signal.
-    requesting_user_profile, _ = Profile.objects.get_or_create(user=request.user)
-    author_profile, _ = Profile.objects.get_or_create(user=author)
+    requesting_user_profile = request.user_context.profile
+    author_profile = get_author_profile(author)
 
     # Multi-tenancy security check
-    if not requesting_user_profile.family:
+    if not requesting_user_profile or not requesting_user_profile.family_id:
         return redirect('family_create')
 
-    if requesting_user_profile.family != author_profile.family:
+    if requesting_user_profile.family_id != author_profile.family_id:
         return redirect('timeline_redirect')
     
-    posts_list = Post.objects.filter(author=author).order_by('-created_date')
+    posts_list = Post.objects.for_listing().filter(author=author).order_by('-created_date')
     if year:
         posts_list = posts_list.filter(created_date__year=year)
         
@@ -134,7 +145,7 @@ def author_post_list(request, username, year=None):
     presentations = Presentation.objects.filter(author=author)
     portfolios = Portfolio.objects.filter(author=author)
     
-    archive_years = Post.objects.filter(author=author).annotate(year=ExtractYear('created_date')).values_list('year', flat=True).distinct().order_by('-year')
+    archive_years = DailyActivity.objects.filter(author=author).annotate(year=ExtractYear('day')).values_list('year', flat=True).distinct().order_by('-year')
 
     # Fetch pending peer review requests
     pending_reviews = PeerReviewRequest.objects.filter(reviewer=author, status='pending')
@@ -158,7 +169,7 @@ def author_post_list(request, username, year=None):
 @login_required
 def post_edit(request, pk):
     post = get_object_or_404(Post, pk=pk)
-    if post.author != request.user and not is_teacher(request.user):
+    if post.author != request.user and not request.user_context.is_teacher:
         return redirect('timeline_redirect')
 
     post_type = post.post_type
@@ -174,17 +185,11 @@ def post_edit(request, pk):
                 post.status = 'draft'
             post.save()
             
-            # Handle tags safely
-            tags_data = form.cleaned_data.get('tags', '')
-            if tags_data:
-                post.tags.clear()
-                tag_names = [t.strip() for t in str(tags_data).split(',') if t.strip()]
-                for tag_name in tag_names:
-                    tag, _ = Tag.objects.get_or_create(name=tag_name)
-                    post.tags.add(tag)
+            # An emptied tags field removes all of the post's tags.
+            set_post_tags(post, form.cleaned_data.get('tags', ''))
             
             messages.success(request, f'Post successfully updated as {post.status}.')
-            if is_teacher(request.user):
+            if request.user_context.is_teacher:
                 return redirect('public_timeline')
             else:
                 return redirect('author_post_list', username=request.user.username) # Redirect after success
@@ -194,19 +199,30 @@ def post_edit(request, pk):
         form = PostForm(instance=post, post_type=post_type, initial={'tags': ', '.join([t.name for t in post.tags.all()])}, user=request.user)
     return render(request, 'blog/post_form.html', {'form': form, 'post_type': post_type})
 
-def is_teacher(user):
-    return user.groups.filter(name='Teachers').exists()
+def teacher_required(view_func):
+    # Like user_passes_test, but reads the role from the request's user context
+    # so the view doesn't repeat the groups query.
+    @wraps(view_func)
+    def _wrapped_view(request, *args, **kwargs):
+        if not request.user_context.is_teacher:
+            return redirect_to_login(request.get_full_path())
+        return view_func(request, *args, **kwargs)
+    return _wrapped_view
+
+DASHBOARD_SECTION_SIZE = 5
+DASHBOARD_SECTION_PAGE_SIZE = 25
+DASHBOARD_SECTION_FIELDS = ('id', 'title', 'status', 'created_date', 'author_id', 'subject_id', 'author__username', 'subject__name')
 
 @login_required
-@user_passes_test(is_teacher)
+@teacher_required
 def teacher_dashboard(request, username=None):
-    requesting_user_profile, _ = Profile.objects.get_or_create(user=request.user)
+    requesting_user_profile = request.user_context.profile
     # Ensure the teacher has a family assigned
     if not requesting_user_profile.family:
         return redirect('family_create')
 
     family = requesting_user_profile.family
-    student_posts = Post.objects.filter(author__groups__name='Students', author__profile__family=family)
+    student_posts = Post.objects.for_family(family).filter(author__groups__name='Students')
     selected_student = None
     search_query = request.GET.get('q')
     selected_status = request.GET.get('status')
@@ -216,46 +232,76 @@ def teacher_dashboard(request, username=None):
         student_posts = student_posts.filter(author=selected_student)
 
     if search_query:
-        student_posts = student_posts.filter(
-            Q(title__icontains=search_query) |
-            Q(video_description__icontains=search_query)
-        )
+        student_posts = search_posts(student_posts, search_query, family=family, ranked=False)
 
     if selected_status:
         student_posts = student_posts.filter(review_status=selected_status)
 
-    subjects = Subject.objects.filter(post__in=student_posts).distinct().prefetch_related('post_set')
-    
-    subject_posts = {subject: subject.post_set.filter(id__in=student_posts).order_by('-created_date') for subject in subjects}
-
     students = User.objects.filter(groups__name='Students', profile__family=family).order_by('username')
 
+    # Totals come from the daily activity rollup; only full-text searches need the posts themselves
+    if search_query:
+        activity = student_posts
+    else:
+        activity = DailyActivity.objects.filter(family=family, author__groups__name='Students')
+        if selected_student:
+            activity = activity.filter(author=selected_student)
+        if selected_status:
+            activity = activity.filter(review_status=selected_status)
+
+    today = date.today()
+    start_date = today - timedelta(days=365)
+
+    def activity_totals():
+        return subject_totals(activity), daily_totals(activity, start_date)
+
+    if search_query:
+        posts_per_subject, posts_by_date = activity_totals()
+    else:
+        # The rollup only changes along with the family's posts, so its totals are cached per generation.
+        posts_per_subject, posts_by_date = cached(
+            'dashboard-totals', family.pk, activity_totals,
+            selected_student.pk if selected_student else '', selected_status or '', start_date,
+        )
+
     # Calculate subject distribution
-    total_posts = student_posts.count()
+    total_posts = sum(posts_per_subject.values())
     subject_distribution = {}
     if total_posts > 0:
-        for subject in subjects:
-            post_count = subject_posts[subject].count()
+        subject_names = Subject.objects.in_bulk(posts_per_subject)
+        for subject_id, post_count in sorted(posts_per_subject.items()):
             percentage = (post_count / total_posts) * 100
-            subject_distribution[subject.name] = round(percentage, 1)
-
-    # Contribution graph data
-    today = date.today()
-    start_date = today - timedelta(days=365)
-    
-    posts_last_year = student_posts.filter(created_date__date__gte=start_date)
-    total_posts_last_year = posts_last_year.count()
+            subject_distribution[subject_names[subject_id].name] = round(percentage, 1)
+
+    # Subject sections: one query for the newest few posts of every subject, regrouped here.
+    # ?subject=<id> pages through a single subject instead.
+    section_posts = student_posts.select_related('author', 'subject').only(*DASHBOARD_SECTION_FIELDS)
+    selected_subject_id = request.GET.get('subject', '')
+    section_page = None
+    if selected_subject_id.isdigit():
+        paginator = CursorPaginator(section_posts.filter(subject_id=selected_subject_id), DASHBOARD_SECTION_PAGE_SIZE)
+        section_page = paginator.get_page(after=request.GET.get('after'), before=request.GET.get('before'))
+        rows = list(section_page)
+    else:
+        rows = (
+            section_posts
+            .annotate(section_rank=Window(RowNumber(), partition_by=[F('subject_id')], order_by=[F('created_date').desc(), F('id').desc()]))
+            .filter(section_rank__lte=DASHBOARD_SECTION_SIZE)
+            .order_by('subject_id', '-created_date', '-id')
+        )
 
-    is_current_year = True
-    for post in posts_last_year:
-        if post.created_date.year != today.year:
-            is_current_year = False
-            break
+    subject_sections = {}
+    for post in rows:
+        section = subject_sections.setdefault(post.subject_id, {
+            'subject': post.subject,
+            'posts': [],
+            'total': posts_per_subject.get(post.subject_id, 0),
+        })
+        section['posts'].append(post)
 
-    posts_by_date = {}
-    for post in posts_last_year:
-        day = post.created_date.date()
-        posts_by_date[day] = posts_by_date.get(day, 0) + 1
+    # Contribution graph data
+    total_posts_last_year = sum(posts_by_date.values())
+    is_current_year = all(day.year == today.year for day in posts_by_date)
 
     # Find the busiest day
     busiest_day = None
@@ -306,7 +352,8 @@ def teacher_dashboard(request, username=None):
                 break # Move to the next week
 
     context = {
-        'subject_posts': subject_posts,
+        'subject_sections': list(subject_sections.values()),
+        'section_page': section_page,
         'students': students,
         'selected_student': selected_student,
         'search_query': search_query,
@@ -344,6 +391,7 @@ def presentation_create(request):
         if form.is_valid():
             presentation = form.save(commit=False)
             presentation.author = request.user
+            presentation.family_id = request.user_context.profile.family_id
             presentation.save()
             
             # Save posts with their order
@@ -361,11 +409,9 @@ def presentation_create(request):
     subject_id = request.GET.get('subject', '')
     
     # Start with the base queryset from the form's initial definition
-    posts_queryset = Post.objects.filter(author=request.user)
+    posts_queryset = Post.objects.for_listing().filter(author=request.user)
     if search_query:
-        posts_queryset = posts_queryset.filter(
-            Q(title__icontains=search_query) | Q(content__icontains=search_query)
-        )
+        posts_queryset = search_posts(posts_queryset, search_query)
     if subject_id:
         posts_queryset = posts_queryset.filter(subject__id=subject_id)
 
@@ -383,11 +429,12 @@ def presentation_create(request):
 
 @login_required
 def presentation_detail(request, pk):
-    requesting_user_profile, _ = Profile.objects.get_or_create(user=request.user)
-    presentation = get_object_or_404(Presentation, pk=pk, author__profile__family=requesting_user_profile.family)
+    presentation = get_object_or_404(
+        Presentation.objects.for_family(request.user_context.profile.family_id).select_related('author'), pk=pk
+    )
 
-    # Get all posts in the presentation, ordered by their order in PresentationPost
-    all_posts = [pp.post for pp in presentation.presentationpost_set.all().order_by('order')]
+    # Ordered by their order in PresentationPost
+    all_posts = Post.objects.for_presentation(presentation)
 
     context = {
         'presentation': presentation,
@@ -404,20 +451,21 @@ def request_peer_review(request, pk):
     if request.method == 'POST':
         form = PeerReviewRequestForm(request.POST, user=request.user)
         if form.is_valid():
-            reviewers = form.cleaned_data['reviewers']
-            for reviewer in reviewers:
-                PeerReviewRequest.objects.get_or_create(
-                    post=post,
-                    requester=request.user,
-                    reviewer=reviewer
-                )
-                # Create a notification for the reviewer
-                Notification.objects.create(
-                    recipient=reviewer,
-                    sender=request.user,
-                    post=post,
-                    message=f'{request.user.username} requested you to review their post "{post.title}".'
-                )
+            reviewers = list(form.cleaned_data['reviewers'])
+            PeerReviewRequest.objects.bulk_create(
+                [PeerReviewRequest(post=post, requester=request.user, reviewer=reviewer) for reviewer in reviewers],
+                ignore_conflicts=True
+            )
+            # Notify the reviewers outside the request cycle
+            enqueue(
+                fan_out_notifications,
+                [reviewer.pk for reviewer in reviewers],
+                f'{request.user.username} requested you to review their post "{post.title}".',
+                new_batch_key('review'),
+                sender_id=request.user.pk,
+                post_id=post.pk,
+                family_id=post.family_id
+            )
             return redirect('post_detail', pk=post.pk)
     else:
         form = PeerReviewRequestForm(user=request.user)
@@ -430,22 +478,32 @@ def request_peer_review(request, pk):
 
 from .forms import PostForm, PresentationForm, CommentForm, PeerReviewRequestForm, ProfileForm, PrivateFeedbackForm, PostReviewStatusForm, AnnouncementForm
 
+def can_view_post(request, status, post_family_id):
+    if request.user.is_authenticated:
+        family_id = request.user_context.profile.family_id
+        return family_id is not None and family_id == post_family_id
+    # Anonymous users can only see published posts.
+    return status == 'published'
+
+def get_across_families_or_404(queryset, **lookup):
+    """get_object_or_404 over the central database and every family's shard (see DATABASE_SHARDING)."""
+    found = across_families(queryset.filter(**lookup)[:1])
+    if not found:
+        raise Http404
+    return found[0]
+
 def post_detail(request, pk):
-    print("--- DEBUG: post_detail VIEW IS RUNNING ---")
-    post = get_object_or_404(Post, pk=pk)
+    if request.user.is_authenticated:
+        post = get_object_or_404(Post.objects.for_detail(), pk=pk)
+    else:
+        # Anonymous visitors have no family shard; the post may be in any of them.
+        post = get_across_families_or_404(Post.objects.for_detail(), pk=pk)
 
     # Multi-tenancy and privacy security check
-    if request.user.is_authenticated:
-        requesting_user_profile, _ = Profile.objects.get_or_create(user=request.user)
-        author_profile, _ = Profile.objects.get_or_create(user=post.author)
-        if not requesting_user_profile.family or requesting_user_profile.family != author_profile.family:
-            return redirect('timeline_redirect')
-    elif post.status != 'published':
-        # Anonymous users can only see published posts.
+    if not can_view_post(request, post.status, post.family_id):
         return redirect('timeline_redirect')
 
-    post.view_count += 1
-    post.save(update_fields=['view_count'])
+    record_view(post)
 
     comment_form = None
     private_feedback_form = None
@@ -456,7 +514,7 @@ def post_detail(request, pk):
     if post.rubric:
         try:
             assessment = post.assessment
-            evaluations = assessment.evaluations.all()
+            evaluations = assessment.evaluations.select_related('criterion', 'level')
         except Assessment.DoesNotExist:
             pass
     
@@ -471,7 +529,7 @@ def post_detail(request, pk):
                     new_comment.author = request.user
                     new_comment.save()
 
-                    if request.user.groups.filter(name='Students').exists():
+                    if request.user_context.is_student:
                         PeerReviewRequest.objects.filter(
                             post=post,
                             reviewer=request.user,
@@ -480,7 +538,7 @@ def post_detail(request, pk):
                     return redirect('post_detail', pk=post.pk)
 
             # Private feedback form submission for teachers
-            if is_teacher(request.user) and 'feedback_submit' in request.POST:
+            if request.user_context.is_teacher and 'feedback_submit' in request.POST:
                 private_feedback_form = PrivateFeedbackForm(request.POST)
                 if private_feedback_form.is_valid():
                     new_feedback = private_feedback_form.save(commit=False)
@@ -493,36 +551,41 @@ def post_detail(request, pk):
                         recipient=post.author,
                         sender=request.user,
                         post=post,
+                        family_id=post.family_id,
                         message=f'{request.user.username} left private feedback on your post "{post.title}".'
                     )
 
                     return redirect('post_detail', pk=post.pk)
 
             # Review status form submission for teachers
-            if is_teacher(request.user) and 'status_submit' in request.POST:
+            if request.user_context.is_teacher and 'status_submit' in request.POST:
                 review_status_form = PostReviewStatusForm(request.POST, instance=post)
                 if review_status_form.is_valid():
-                    review_status_form.save()
+                    # Only the status: a full save would write back the view_count read at the start of the request.
+                    review_status_form.save(commit=False).save(update_fields=['review_status'])
 
                     # Create a notification for the post author
                     Notification.objects.create(
                         recipient=post.author,
                         sender=request.user,
                         post=post,
+                        family_id=post.family_id,
                         message=f'The status of your post "{post.title}" has been changed to "{post.get_review_status_display()}".'
                     )
 
                     return redirect('post_detail', pk=post.pk)
 
         comment_form = CommentForm()
-        if is_teacher(request.user):
+        if request.user_context.is_teacher:
             private_feedback_form = PrivateFeedbackForm()
             review_status_form = PostReviewStatusForm(instance=post)
 
-    private_feedback = post.private_feedback.order_by('-created_date') if request.user == post.author or (request.user.is_authenticated and is_teacher(request.user)) else []
+    private_feedback = post.private_feedback.select_related('author__profile').order_by('-created_date') if request.user == post.author or request.user_context.is_teacher else []
 
     context = {
         'post': post,
+        # Count this view without waiting for the next flush; other buffered views show up once it runs.
+        'displayed_view_count': post.view_count + 1,
         'comment_form': comment_form,
         'private_feedback': private_feedback,
         'private_feedback_form': private_feedback_form,
@@ -534,7 +597,7 @@ def post_detail(request, pk):
 
 @login_required
 def edit_profile(request):
-    profile, created = Profile.objects.get_or_create(user=request.user)
+    profile = request.user_context.profile
     if request.method == 'POST':
         form = ProfileForm(request.POST, request.FILES, instance=profile)
         if form.is_valid():
@@ -571,11 +634,9 @@ def presentation_edit(request, pk):
     search_query = request.GET.get('q', '')
     subject_id = request.GET.get('subject', '')
     
-    posts_queryset = Post.objects.filter(author=request.user)
+    posts_queryset = Post.objects.for_listing().filter(author=request.user)
     if search_query:
-        posts_queryset = posts_queryset.filter(
-            Q(title__icontains=search_query) | Q(content__icontains=search_query)
-        )
+        posts_queryset = search_posts(posts_queryset, search_query)
     if subject_id:
         posts_queryset = posts_queryset.filter(subject__id=subject_id)
 
@@ -613,26 +674,26 @@ def presentation_delete(request, pk):
     return render(request, 'blog/presentation_confirm_delete.html', {'presentation': presentation})
 
 @login_required
-@user_passes_test(is_teacher)
+@teacher_required
 def announcement_create(request):
-    requesting_user_profile, _ = Profile.objects.get_or_create(user=request.user)
+    requesting_user_profile = request.user_context.profile
     if request.method == 'POST':
         form = AnnouncementForm(request.POST)
         if form.is_valid():
             announcement = form.save(commit=False)
             announcement.author = request.user
+            announcement.family_id = requesting_user_profile.family_id
             announcement.save()
 
             # Create notifications only for students in the same family
-            if requesting_user_profile.family:
-                students_group = Group.objects.get(name='Students')
-                students_in_family = students_group.user_set.filter(profile__family=requesting_user_profile.family)
-                for student in students_in_family:
-                    Notification.objects.create(
-                        recipient=student,
-                        sender=request.user,
-                        message=f'New Announcement: {announcement.title}'
-                    )
+            if requesting_user_profile.family_id:
+                enqueue(
+                    notify_family_students,
+                    requesting_user_profile.family_id,
+                    f'New Announcement: {announcement.title}',
+                    f'announcement:{announcement.pk}',
+                    sender_id=request.user.pk
+                )
 
             return redirect('announcement_list')
     else:
@@ -640,13 +701,10 @@ def announcement_create(request):
     return render(request, 'blog/announcement_form.html', {'form': form})
 
 @login_required
-@user_passes_test(is_teacher)
+@teacher_required
 def announcement_list(request):
-    requesting_user_profile, _ = Profile.objects.get_or_create(user=request.user)
-    if not requesting_user_profile.family:
-        return render(request, 'blog/announcement_list.html', {'announcements': []})
-
-    announcements = Announcement.objects.filter(author__profile__family=requesting_user_profile.family).order_by('-created_date')
+    requesting_user_profile = request.user_context.profile
+    announcements = Announcement.objects.for_family(requesting_user_profile.family_id).order_by('-created_date')
     context = {
         'announcements': announcements
     }
@@ -659,11 +717,14 @@ def mark_notifications_as_read(request):
     return redirect(request.META.get('HTTP_REFERER', 'timeline_redirect'))
 
 def posts_by_tag(request, tag_name):
-    tag = get_object_or_404(Tag, name=tag_name)
-    posts = Post.objects.filter(tags=tag, status='published').order_by('-created_date')
-    paginator = Paginator(posts, 6)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Each family's shard has its own copy of the tag, so posts are matched on its name.
+    tags = across_families(Tag.objects.filter(name=tag_name)[:1])
+    if not tags:
+        raise Http404
+    tag = tags[0]
+    posts = Post.objects.for_listing().filter(tags__name=tag_name, status='published')
+    paginator = CursorPaginator(posts, 6, descending=request.GET.get('sort') != 'oldest', across_shards=True)
+    page_obj = paginator.get_page(after=request.GET.get('after'), before=request.GET.get('before'))
     context = {
         'page_obj': page_obj,
         'tag': tag,
@@ -684,16 +745,27 @@ class PortfolioListView(LoginRequiredMixin, ListView):
     def get_queryset(self):
         return Portfolio.objects.filter(author=self.request.user)
 
-class PortfolioDetailView(DetailView):
+class AcrossFamiliesObjectMixin:
+    """Find the object in whichever family's shard holds it, since the page isn't limited to one family."""
+
+    def get_object(self, queryset=None):
+        if queryset is None:
+            queryset = self.get_queryset()
+        return get_across_families_or_404(queryset, pk=self.kwargs['pk'])
+
+class PortfolioDetailView(AcrossFamiliesObjectMixin, DetailView):
     model = Portfolio
     template_name = 'blog/portfolio_detail.html'
     context_object_name = 'portfolio'
 
+    def get_queryset(self):
+        return Portfolio.objects.select_related('author')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        portfolio = self.get_object()
-        context['published_posts'] = portfolio.posts.filter(status='published')
-        context['draft_posts'] = portfolio.posts.filter(status='draft')
+        portfolio = self.object
+        context['published_posts'] = portfolio.posts.for_listing().filter(status='published')
+        context['draft_posts'] = portfolio.posts.for_listing().filter(status='draft')
         context['presentations'] = portfolio.presentations.all()
         return context
 
@@ -736,24 +808,24 @@ class PortfolioDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
         portfolio = self.get_object()
         return self.request.user == portfolio.author
 
-class PublicPortfolioDetailView(DetailView):
+class PublicPortfolioDetailView(AcrossFamiliesObjectMixin, DetailView):
     model = Portfolio
     template_name = 'blog/public_portfolio_detail.html'
     context_object_name = 'portfolio'
 
     def get_queryset(self):
-        return Portfolio.objects.filter(is_public=True)
+        return Portfolio.objects.filter(is_public=True).select_related('author')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        portfolio = self.get_object()
-        context['posts'] = portfolio.posts.filter(status='published')
+        portfolio = self.object
+        context['posts'] = portfolio.posts.for_listing().filter(status='published')
         context['presentations'] = portfolio.presentations.all()
         return context
 
 @login_required
 def family_create(request):
-    profile, _ = Profile.objects.get_or_create(user=request.user)
+    profile = request.user_context.profile
     # Users who are already in a family should not be able to create a new one.
     if profile.family:
         return redirect('timeline_redirect')
@@ -773,7 +845,7 @@ def family_create(request):
 
 @login_required
 def family_management(request):
-    profile, _ = Profile.objects.get_or_create(user=request.user)
+    profile = request.user_context.profile
     if not profile.family:
         return redirect('family_create')
 
@@ -791,11 +863,12 @@ def family_management(request):
                 break
         return redirect('family_management')
 
-    return render(request, 'blog/family_management.html', {'family': family})
+    members = family.members.select_related('user').order_by('user__username')
+    return render(request, 'blog/family_management.html', {'family': family, 'members': members})
 
 @login_required
 def join_or_create_family(request):
-    profile, _ = Profile.objects.get_or_create(user=request.user)
+    profile = request.user_context.profile
     # If the user is already in a family, redirect them away.
     if profile.family:
         return redirect('timeline_redirect')
@@ -807,7 +880,7 @@ def join_or_create_family(request):
 
 @login_required
 def join_family(request):
-    profile, _ = Profile.objects.get_or_create(user=request.user)
+    profile = request.user_context.profile
     # If user is already in a family, they shouldn't be here.
     if profile.family:
         messages.info(request, "You are already part of a family.")
@@ -833,13 +906,13 @@ def join_family(request):
     return render(request, 'blog/join_family_form.html', {'form': form})
 
 @login_required
-@user_passes_test(is_teacher)
+@teacher_required
 def rubric_list(request):
     rubrics = Rubric.objects.filter(author=request.user)
     return render(request, 'blog/rubric_list.html', {'rubrics': rubrics})
 
 @login_required
-@user_passes_test(is_teacher)
+@teacher_required
 def rubric_create(request):
     if request.method == 'POST':
         form = RubricForm(request.POST)
@@ -865,7 +938,7 @@ def rubric_create(request):
     })
 
 @login_required
-@user_passes_test(is_teacher)
+@teacher_required
 def rubric_edit(request, pk):
     rubric = get_object_or_404(Rubric, pk=pk, author=request.user)
     if request.method == 'POST':
@@ -890,7 +963,7 @@ def rubric_edit(request, pk):
     })
 
 @login_required
-@user_passes_test(is_teacher)
+@teacher_required
 def rubric_delete(request, pk):
     rubric = get_object_or_404(Rubric, pk=pk, author=request.user)
     if request.method == 'POST':
@@ -904,11 +977,11 @@ def rubric_detail(request, pk, post_pk=None):
     rubric = get_object_or_404(Rubric, pk=pk)
     
     # Teachers can see any rubric
-    if is_teacher(request.user):
+    if request.user_context.is_teacher:
         return render(request, 'blog/rubric_detail.html', {'rubric': rubric, 'post_pk': post_pk})
 
     # Students can see the rubric if it is attached to one of their posts
-    if request.user.groups.filter(name='Students').exists():
+    if request.user_context.is_student:
         if Post.objects.filter(author=request.user, rubric=rubric).exists():
             return render(request, 'blog/rubric_detail.html', {'rubric': rubric, 'post_pk': post_pk})
 
@@ -916,7 +989,7 @@ def rubric_detail(request, pk, post_pk=None):
     return redirect('timeline_redirect')
 
 @login_required
-@user_passes_test(is_teacher)
+@teacher_required
 def assess_post(request, pk):
     post = get_object_or_404(Post, pk=pk)
     rubric = post.rubric
@@ -947,3 +1020,44 @@ def assess_post(request, pk):
         'form': form,
         'formset': formset
     })
+
+MEDIA_POST_FIELDS = {
+    'photos/': 'photo',
+    'audio/': 'audio_file',
+    'videos/': 'video_file',
+}
+
+# Extensions a photo upload can have, for finding the source of a rendition by its exact name.
+PHOTO_EXTENSIONS = sorted(
+    {case(extension) for extension in get_available_image_extensions() for case in (str.lower, str.upper)}
+)
+
+def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    # Uploads attached to a post follow the same visibility rules as the post itself.
+    post_filter = None
+    if path.startswith('renditions/') and path.count('/') >= 2:
+        source_stem = os.path.splitext(path.split('/', 2)[2])[0]
+        if source_stem.startswith('photos/'):
+            post_filter = Q(photo__in=[f'{source_stem}.{extension}' for extension in PHOTO_EXTENSIONS])
+    else:
+        for prefix, field in MEDIA_POST_FIELDS.items():
+            if path.startswith(prefix):
+                post_filter = Q(**{field: path})
+                break
+
+    if post_filter is not None:
+        posts = Post.objects.filter(post_filter).values('status', 'family_id')[:2]
+        # Signed-in users can only see their own family's files, which are in their shard.
+        posts = list(posts) if request.user.is_authenticated else across_families(posts)
+        # A file shared by several posts has no one set of visibility rules to follow.
+        if len(posts) != 1 or not can_view_post(request, posts[0]['status'], posts[0]['family_id']):
+            raise Http404
+
+    return media_response(request, full_path, path)
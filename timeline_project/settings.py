@@ -51,11 +51,18 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'blog.middleware.MetricsMiddleware',
+    'blog.middleware.PythonProfilingMiddleware',
+    'blog.middleware.RequestProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'blog.middleware.SlowQueryOriginMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'blog.middleware.ReadOnlyRequestMiddleware',
+    'blog.middleware.UserContextMiddleware',
+    'blog.middleware.FamilyShardMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -64,7 +71,9 @@ ROOT_URLCONF = 'timeline_project.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, plus render timing for RequestProfilingMiddleware.
+        'BACKEND': 'blog.profiling.ProfiledDjangoTemplates',
+        'NAME': 'django',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -93,6 +102,73 @@ DATABASES = {
     }
 }
 
+# DATABASE_PROFILE=production tunes SQLite for several Gunicorn workers: WAL lets readers carry on
+# while a writer commits, writers wait out the busy timeout instead of failing with "database is
+# locked", and connections stay open between requests so the pragmas are only paid once.
+DATABASE_PROFILE = os.getenv('DATABASE_PROFILE', 'development')
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000')),  # milliseconds
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),  # bytes
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-65536')),  # negative means KiB
+}
+
+if DATABASE_PROFILE == 'production':
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '600')),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000,
+            # Take the write lock at BEGIN so a transaction never has to upgrade a read lock,
+            # which SQLite reports as busy immediately without honouring the timeout.
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': '; '.join(f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items()),
+        },
+    })
+
+# GET and HEAD requests read through a separate read-only connection (see blog.routers) when
+# DATABASE_READ_REPLICA is set: 'primary' opens db.sqlite3 itself read-only, anything else is the
+# path of a replica copy. Writes always go to 'default'.
+DATABASE_READ_REPLICA = os.getenv('DATABASE_READ_REPLICA', '')
+if DATABASE_READ_REPLICA:
+    read_path = DATABASES['default']['NAME'] if DATABASE_READ_REPLICA == 'primary' else Path(DATABASE_READ_REPLICA)
+    read_options = dict(DATABASES['default'].get('OPTIONS', {}))
+    read_options.pop('transaction_mode', None)
+    if 'init_command' in read_options:
+        # A read-only connection can't change the journal mode; it picks up WAL from the file.
+        read_options['init_command'] = '; '.join(
+            f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items() if name != 'journal_mode'
+        )
+    DATABASES['readonly'] = {
+        **DATABASES['default'],
+        'NAME': f'file:{read_path}?mode=ro',
+        'OPTIONS': read_options,
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Optionally give every family its own SQLite file under DATABASE_SHARD_DIR (see blog.sharding
+# and `manage.py migrate_shards`); shared tables stay in the database above.
+DATABASE_SHARDING = os.getenv('DATABASE_SHARDING', 'False') == 'True'
+DATABASE_SHARD_DIR = os.getenv('DATABASE_SHARD_DIR', str(BASE_DIR / 'shards'))
+
+DATABASE_ROUTERS = ['blog.sharding.FamilyShardRouter', 'blog.routers.ReadWriteRouter']
+
+# Raise instead of logging a warning when a GET request writes outside blog.routers.allow_writes().
+DATABASE_READ_ONLY_STRICT = os.getenv('DATABASE_READ_ONLY_STRICT', str(DEBUG)) == 'True'
+
+# One cache file shared by every Gunicorn worker and the task worker on this host (see
+# blog.sqlite_cache). Fragments are keyed by per-family generations (blog.caching), so
+# stale ones are never looked up again and age out under CACHE_MAX_ENTRIES.
+CACHES = {
+    'default': {
+        'BACKEND': 'blog.sqlite_cache.SQLiteCache',
+        'LOCATION': os.getenv('CACHE_LOCATION') or str(BASE_DIR / 'cache.sqlite3'),
+        'TIMEOUT': int(os.getenv('CACHE_TIMEOUT', '3600')),  # seconds
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', '10000'))},
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -140,8 +216,76 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# How blog.views.serve_media delivers files once permissions are checked: '' streams them from
+# Django, 'x-accel-redirect' hands off to nginx (internal location at MEDIA_ACCEL_PREFIX) and
+# 'x-sendfile' hands off to Apache/lighttpd.
+MEDIA_SERVE_MODE = os.getenv('MEDIA_SERVE_MODE', '')
+MEDIA_ACCEL_PREFIX = os.getenv('MEDIA_ACCEL_PREFIX', '/protected-media/')
+
 LOGIN_REDIRECT_URL = '/public-timeline/'
 LOGOUT_REDIRECT_URL = '/'
 
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
+
+# Seconds between the worker's flushes of buffered post views (see blog.view_counts).
+VIEW_COUNT_FLUSH_INTERVAL = int(os.getenv('VIEW_COUNT_FLUSH_INTERVAL', '60'))
+
+# Background task queue (see blog.task_queue). Eager mode runs tasks inline on commit, for
+# development without a `manage.py run_worker` process.
+TASK_QUEUE_EAGER = os.getenv('TASK_QUEUE_EAGER', 'False') == 'True'
+TASK_WORKER_CONCURRENCY = int(os.getenv('TASK_WORKER_CONCURRENCY', '2'))
+TASK_RETRY_BACKOFF = int(os.getenv('TASK_RETRY_BACKOFF', '10'))
+TASK_RETENTION_DAYS = int(os.getenv('TASK_RETENTION_DAYS', '7'))
+
+# Share of requests (0.0-1.0) profiled by blog.middleware.RequestProfilingMiddleware: those get a
+# Server-Timing header and a 'blog.profiling' log line. 0 removes the middleware altogether.
+REQUEST_PROFILING_SAMPLE_RATE = float(os.getenv('REQUEST_PROFILING_SAMPLE_RATE', '0'))
+# A profiled request running the same SQL this many times is logged as a warning (likely N+1).
+REQUEST_PROFILING_REPEAT_THRESHOLD = int(os.getenv('REQUEST_PROFILING_REPEAT_THRESHOLD', '5'))
+
+# cProfile a share of requests (0.0-1.0), plus any request carrying an X-Profile-Request header
+# from `manage.py profile_report --header` when PYTHON_PROFILE_HEADER is True. The newest
+# PYTHON_PROFILE_MAX_FILES .pstats files are kept in PYTHON_PROFILE_DIR.
+PYTHON_PROFILE_SAMPLE_RATE = float(os.getenv('PYTHON_PROFILE_SAMPLE_RATE', '0'))
+PYTHON_PROFILE_HEADER = os.getenv('PYTHON_PROFILE_HEADER', 'False') == 'True'
+PYTHON_PROFILE_HEADER_MAX_AGE = int(os.getenv('PYTHON_PROFILE_HEADER_MAX_AGE', '3600'))
+PYTHON_PROFILE_DIR = os.getenv('PYTHON_PROFILE_DIR', str(BASE_DIR / 'profiles'))
+PYTHON_PROFILE_MAX_FILES = int(os.getenv('PYTHON_PROFILE_MAX_FILES', '200'))
+
+# Request and business metrics served at /metrics (see blog.metrics) to staff users and to
+# requests with 'Authorization: Bearer <METRICS_TOKEN>'. With several worker processes, set
+# METRICS_DIR: each process writes its values there every METRICS_FLUSH_INTERVAL seconds
+# and /metrics adds them up.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+# Queries taking at least this many milliseconds are written, with their query plan, to
+# SLOW_QUERY_LOG (see blog.slow_queries and `manage.py slow_queries`). 0 turns the log off.
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '0'))
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', str(BASE_DIR / 'slow_queries.log'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+        'slow_queries': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': SLOW_QUERY_LOG,
+            'maxBytes': int(os.getenv('SLOW_QUERY_LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+            'backupCount': int(os.getenv('SLOW_QUERY_LOG_BACKUPS', '5')),
+            'formatter': 'message',
+            'delay': True,
+        },
+    },
+    'loggers': {
+        'blog.profiling': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+        'blog.slow_queries': {'handlers': ['slow_queries'], 'level': 'WARNING', 'propagate': False},
+    },
+}
@@ -17,12 +17,15 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
+from blog.metrics import metrics_view
+from blog.views import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('django.contrib.auth.urls')),
+    path(settings.MEDIA_URL.lstrip('/') + '<path:path>', serve_media, name='serve_media'),
+    path('metrics', metrics_view, name='metrics'),
     path('', include('blog.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
 
 